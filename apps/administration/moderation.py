@@ -0,0 +1,149 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from ..core.admission import known_uploaders
+from ..core.derivatives import schedule_variants
+from ..core.files import journal_file_deletions
+from ..core.gallery_cache import bump_gallery_version
+from ..core.models import Image
+
+MODERATION_ACTIONS = {
+    'approve': {'approved': True, 'rejected': False},
+    'reject': {'approved': False, 'rejected': True},
+}
+
+MODERATION_RESULTS = {
+    'approve': 'approved',
+    'reject': 'rejected',
+}
+
+PENDING = Q(approved=False, rejected=False)
+
+
+@transaction.atomic
+def apply_moderation(image_ids, action):
+    """
+    Approve or reject `image_ids`, and every identical copy of them, in one UPDATE.
+    Returns the number of rows updated.
+    """
+    same_content = (Image.objects.filter(pk__in=image_ids)
+                    .exclude(content_hash='').values('content_hash'))
+    updated = Image.objects.filter(Q(pk__in=image_ids) | Q(content_hash__in=same_content)) \
+        .update(**MODERATION_ACTIONS[action])
+
+    if action == 'approve':
+        for image in Image.objects.filter(pk__in=image_ids, variants={}).only('id', 'image'):
+            schedule_variants(image)
+    bump_gallery_version()
+    return updated
+
+
+def iter_batches(image_ids):
+    for start in range(0, len(image_ids), settings.BULK_MODERATION_BATCH_SIZE):
+        yield image_ids[start:start + settings.BULK_MODERATION_BATCH_SIZE]
+
+
+def bulk_moderate(image_ids, action):
+    """
+    Approve or reject `image_ids` one UPDATE per batch.
+    Returns {id: 'approved' | 'rejected' | 'not_found'}.
+    """
+    results = {}
+    for batch in iter_batches(image_ids):
+        found = set(Image.objects.filter(pk__in=batch).values_list('id', flat=True))
+        apply_moderation(list(found), action)
+        for image_id in batch:
+            results[image_id] = MODERATION_RESULTS[action] if image_id in found else 'not_found'
+    return results
+
+
+def bulk_delete_images(image_ids):
+    """
+    Delete `image_ids` one DELETE per batch; their files are journaled
+    and removed in the background after commit.
+    Returns {id: 'deleted' | 'not_found'}.
+    """
+    results = {}
+    for batch in iter_batches(image_ids):
+        with transaction.atomic():
+            rows = list(Image.objects.filter(pk__in=batch).values_list('id', 'image', 'ip_address'))
+            Image.objects.filter(pk__in=[image_id for image_id, _, _ in rows]).delete()
+            journal_file_deletions([name for _, name, _ in rows])
+            bump_gallery_version()
+
+        known_uploaders.discard_many([ip_address for _, _, ip_address in rows])
+        found = {image_id for image_id, _, _ in rows}
+        for image_id in batch:
+            results[image_id] = 'deleted' if image_id in found else 'not_found'
+    return results
+
+
+def live_claims(user_id, now=None):
+    return Image.objects.filter(PENDING, claimed_by_id=user_id, claim_expires_at__gt=now or timezone.now())
+
+
+@transaction.atomic
+def claim_pending_images(user_id, count):
+    """
+    Lease up to `count` pending images to a moderator, oldest first: the
+    ones they already hold, renewed, topped up with unclaimed or expired
+    ones. SKIP LOCKED lets concurrent claims pass each other's rows instead
+    of waiting, so every moderator gets a distinct batch. The held ones are
+    locked and renewed only while still live, so a lease that ran out into
+    another moderator's claim is never taken back.
+    Returns the claimed image ids and the lease expiry.
+    """
+    now = timezone.now()
+    expires_at = now + timedelta(seconds=settings.MODERATION_CLAIM_LEASE)
+    held = list(live_claims(user_id, now).select_for_update().order_by('upload_date', 'id')
+                .values_list('id', flat=True)[:count])
+    live_claims(user_id, now).filter(pk__in=held).update(claim_expires_at=expires_at)
+
+    free = []
+    if len(held) < count:
+        free = list(Image.objects.select_for_update(skip_locked=True)
+                    .filter(PENDING)
+                    .filter(Q(claim_expires_at__isnull=True) | Q(claim_expires_at__lte=now))
+                    .order_by('upload_date', 'id')
+                    .values_list('id', flat=True)[:count - len(held)])
+
+    Image.objects.filter(pk__in=free).update(claimed_by_id=user_id, claim_expires_at=expires_at)
+    return held + free, expires_at
+
+
+def release_claims(user_id, image_ids=None):
+    """
+    Give back a moderator's claims, all of them without `image_ids`.
+    Returns the number released.
+    """
+    claims = Image.objects.filter(claimed_by_id=user_id)
+    if image_ids is not None:
+        claims = claims.filter(pk__in=image_ids)
+    return claims.update(claimed_by=None, claim_expires_at=None)
+
+
+@transaction.atomic
+def decide_claimed(user_id, decisions):
+    """
+    Apply {'approve': ids, 'reject': ids}, restricted to images the moderator
+    holds a live claim on, one UPDATE per action.
+    Returns {id: 'approved' | 'rejected' | 'not_claimed'}.
+    """
+    requested = [image_id for image_ids in decisions.values() for image_id in image_ids]
+    # Locked so the leases can't expire into another moderator's claim meanwhile
+    claimed = set(live_claims(user_id).filter(pk__in=requested).select_for_update().values_list('id', flat=True))
+
+    results = {}
+    for action, image_ids in decisions.items():
+        decided = [image_id for image_id in image_ids if image_id in claimed]
+        if decided:
+            apply_moderation(decided, action)
+        for image_id in image_ids:
+            results[image_id] = MODERATION_RESULTS[action] if image_id in claimed else 'not_claimed'
+
+    Image.objects.filter(pk__in=claimed).update(claimed_by=None, claim_expires_at=None)
+    return results
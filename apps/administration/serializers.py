@@ -1,23 +1,96 @@
+from django.conf import settings
 from rest_framework import serializers
 
+from ..core.derivatives import get_variant_urls
+from ..core.media import get_media_url
 from ..core.models import Image, OrderForms
+from .moderation import MODERATION_ACTIONS
 
 
 class AdminImageSerializer(serializers.ModelSerializer):
     image_url = serializers.SerializerMethodField()
+    variants = serializers.SerializerMethodField()
 
     class Meta:
         model = Image
-        fields = ['id', 'image', 'ip_address',
-                  'upload_date', 'approved', 'image_url']
-        read_only_fields = ['id', 'image', 'ip_address', 'upload_date']
+        fields = ['id', 'image', 'original_filename', 'ip_address', 'upload_date', 'approved', 'rejected',
+                  'width', 'height', 'image_url', 'variants', 'claimed_by', 'claim_expires_at']
+        read_only_fields = ['id', 'image', 'original_filename', 'ip_address', 'upload_date', 'width', 'height',
+                            'claimed_by', 'claim_expires_at']
 
     def get_image_url(self, obj):
+        """
+        Signed, so pending images can be previewed before they are public
+        """
         request = self.context.get('request')
         if request and obj.image:
-            return request.build_absolute_uri(obj.image.url)
+            return get_media_url(obj.image.name, request, signed=True)
         return None
 
+    def get_variants(self, obj):
+        return get_variant_urls(obj, self.context.get('request'), signed=True)
+
+
+class SimilarImageSerializer(AdminImageSerializer):
+    distance = serializers.SerializerMethodField()
+
+    class Meta(AdminImageSerializer.Meta):
+        fields = AdminImageSerializer.Meta.fields + ['distance']
+
+    def get_distance(self, obj):
+        return self.context['distances'][obj.id]
+
+
+class SimilarQuerySerializer(serializers.Serializer):
+    max_distance = serializers.IntegerField(min_value=0, max_value=settings.SIMILAR_IMAGES_DISTANCE_LIMIT,
+                                            default=settings.SIMILAR_IMAGES_MAX_DISTANCE)
+
+
+class ModerateSimilarSerializer(SimilarQuerySerializer):
+    action = serializers.ChoiceField(choices=list(MODERATION_ACTIONS))
+
+
+class BulkModerationSerializer(serializers.Serializer):
+    """
+    Target either explicit `ids` or, with `all_matching`, every image matching
+    the request's filter/search query parameters
+    """
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1), required=False, allow_empty=False,
+                                max_length=settings.BULK_MODERATION_MAX_IDS)
+    all_matching = serializers.BooleanField(default=False)
+
+    def validate(self, attrs):
+        if bool(attrs.get('ids')) == attrs['all_matching']:
+            raise serializers.ValidationError("Provide either 'ids' or 'all_matching', not both.")
+        return attrs
+
+
+class QueueClaimSerializer(serializers.Serializer):
+    count = serializers.IntegerField(min_value=1, max_value=settings.MODERATION_CLAIM_MAX,
+                                     default=settings.MODERATION_CLAIM_BATCH_SIZE)
+
+
+class QueueReleaseSerializer(serializers.Serializer):
+    """
+    Release the given `ids`, or every claim of the moderator without them
+    """
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1), required=False, allow_empty=False,
+                                max_length=settings.MODERATION_CLAIM_MAX)
+
+
+class QueueDecisionSerializer(serializers.Serializer):
+    approve = serializers.ListField(child=serializers.IntegerField(min_value=1), default=list,
+                                    max_length=settings.MODERATION_CLAIM_MAX)
+    reject = serializers.ListField(child=serializers.IntegerField(min_value=1), default=list,
+                                   max_length=settings.MODERATION_CLAIM_MAX)
+
+    def validate(self, attrs):
+        if not attrs['approve'] and not attrs['reject']:
+            raise serializers.ValidationError("Provide 'approve' and/or 'reject' ids.")
+        if set(attrs['approve']) & set(attrs['reject']):
+            raise serializers.ValidationError("An image can't be both approved and rejected.")
+        return attrs
+
 
 class AdminOrderFormsSerializer(serializers.ModelSerializer):
     class Meta:
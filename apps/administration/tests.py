@@ -1,3 +1,348 @@
-from django.test import TestCase
+import csv
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+from PIL import Image as PILImage
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from .exports import escape_cell
+from ..authentication.models import User
+from ..core.admission import known_uploaders
+from ..core.models import Image, OrderForms
+from ..core.pagination import EstimatedCountPaginator
+from ..core.phash import get_hash_fields
+
+IMAGES_URL = '/api/v1/administration/images/'
+ORDER_FORMS_URL = '/api/v1/administration/order-forms/'
+
+
+def make_upload(color='red'):
+    buffer = BytesIO()
+    PILImage.new('RGB', (40, 30), color).save(buffer, 'PNG')
+    return SimpleUploadedFile('sticker.png', buffer.getvalue(), content_type='image/png')
+
+
+class AdminTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        media_root = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        cls.enterClassContext(override_settings(MEDIA_ROOT=media_root, IMAGE_VARIANT_WORKERS=0))
+        super().setUpClass()
+
+    def setUp(self):
+        self.client = self.get_client('moderator')
+
+    def get_client(self, username):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user(username, is_staff=True))
+        return client
+
+    def create_images(self, count, **kwargs):
+        now = timezone.now()
+        return [
+            Image.objects.create(image=f'images/{index}.png', ip_address=f'203.0.113.{index}',
+                                 upload_date=now - timedelta(minutes=count - index), **kwargs)
+            for index in range(count)
+        ]
+
+
+class AdminAccessTests(AdminTestCase):
+    def test_requires_staff(self):
+        self.assertEqual(APIClient().get(IMAGES_URL).status_code, 401)
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user('visitor'))
+        self.assertEqual(client.get(IMAGES_URL).status_code, 403)
+
+    @override_settings(QUERY_BUDGET_MODE='raise')
+    def test_lists_within_query_budget(self):
+        self.create_images(15)
+        for index in range(15):
+            OrderForms.objects.create(name=f'Customer {index}', phone=f'+99890123456{index:02}')
+
+        for url in (IMAGES_URL, ORDER_FORMS_URL):
+            for count_mode in ('estimated', 'exact', 'cached', 'none'):
+                response = self.client.get(url, {'page_size': 10, 'count_mode': count_mode})
+                self.assertEqual(response.status_code, 200)
+
+
+class ModerationTests(AdminTestCase):
+    def test_approval_renders_variants(self):
+        image = Image(image=make_upload(), ip_address='203.0.113.1')
+        image.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(f'{IMAGES_URL}{image.pk}/', {'approved': True}, format='json')
+        self.assertEqual(response.status_code, 200)
+        image.refresh_from_db()
+        self.assertEqual(set(image.variants), {'full', 'medium', 'thumbnail'})
+
+        response = self.client.get(f'{IMAGES_URL}{image.pk}/')
+        self.assertIn('/thumbnail.webp?signature=', response.json()['variants']['thumbnail']['webp'])
+
+
+    def test_approval_invalidates_gallery(self):
+        cache.clear()
+        image = Image(image=make_upload(), ip_address='203.0.113.1')
+        image.save()
+        self.assertEqual(self.client.get('/api/v1/core/images/').json(), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(f'{IMAGES_URL}{image.pk}/', {'approved': True}, format='json')
+        self.assertEqual([item['id'] for item in self.client.get('/api/v1/core/images/').json()], [image.pk])
+
+    def test_delete_forgets_uploader(self):
+        image = Image(image=make_upload(), ip_address='203.0.113.1')
+        image.save()
+        known_uploaders.add('203.0.113.1')
+        self.assertEqual(self.client.delete(f'{IMAGES_URL}{image.pk}/').status_code, 204)
+        self.assertNotIn('203.0.113.1', known_uploaders)
+        self.assertFalse(Image.objects.exists())
+
+
+    def test_bulk_approve(self):
+        images = self.create_images(3)
+        response = self.client.post(f'{IMAGES_URL}bulk-approve/', {'ids': [images[0].pk, images[1].pk, 999999]},
+                                    format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'], {
+            str(images[0].pk): 'approved', str(images[1].pk): 'approved', '999999': 'not_found',
+        })
+        self.assertEqual(Image.objects.filter(approved=True).count(), 2)
+
+    def test_bulk_reject_all_matching(self):
+        self.create_images(3)
+        Image.objects.filter(ip_address='203.0.113.0').update(approved=True)
+        response = self.client.post(f'{IMAGES_URL}bulk-reject/?approved=false', {'all_matching': True},
+                                    format='json')
+        self.assertEqual(response.json()['processed'], 2)
+        self.assertEqual(Image.objects.filter(rejected=True).count(), 2)
+
+    @override_settings(BULK_MODERATION_MAX_IDS=2)
+    def test_all_matching_is_capped(self):
+        self.create_images(3)
+        response = self.client.post(f'{IMAGES_URL}bulk-approve/', {'all_matching': True}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('all_matching', response.json())
+        self.assertFalse(Image.objects.filter(approved=True).exists())
+        response = self.client.post(f'{IMAGES_URL}bulk-approve/?search=203.0.113.1', {'all_matching': True},
+                                    format='json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_bulk_requires_ids_or_all_matching(self):
+        response = self.client.post(f'{IMAGES_URL}bulk-approve/', {}, format='json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(f'{IMAGES_URL}bulk-approve/', {'ids': [1], 'all_matching': True}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_bulk_delete_releases_unreferenced_files(self):
+        shared = make_upload()
+        first = Image(image=shared, ip_address='203.0.113.1')
+        first.save()
+        second = Image(image=make_upload(), ip_address='203.0.113.2')
+        second.save()
+        other = Image(image=make_upload('blue'), ip_address='203.0.113.3')
+        other.save()
+
+        with mock.patch('apps.core.files._reaper.submit', side_effect=lambda process: process()), \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f'{IMAGES_URL}bulk-delete/', {'ids': [first.pk, other.pk]}, format='json')
+        self.assertEqual(response.json()['processed'], 2)
+        self.assertEqual(list(Image.objects.all()), [second])
+        # Still referenced by the second, identical image
+        self.assertTrue(os.path.exists(second.image.path))
+        self.assertFalse(os.path.exists(other.image.path))
+
+
+class ModerationQueueTests(AdminTestCase):
+    def setUp(self):
+        super().setUp()
+        self.images = self.create_images(5)
+        self.other = self.get_client('second-moderator')
+
+    def claim(self, client, count):
+        response = client.post(f'{IMAGES_URL}queue/claim/', {'count': count}, format='json')
+        self.assertEqual(response.status_code, 200)
+        return [image['id'] for image in response.json()['results']]
+
+    def test_moderators_get_distinct_batches(self):
+        first = self.claim(self.client, 2)
+        second = self.claim(self.other, 2)
+        self.assertEqual(first, [image.pk for image in self.images[:2]])
+        self.assertEqual(second, [image.pk for image in self.images[2:4]])
+
+    def test_claim_renews_held_images(self):
+        held = self.claim(self.client, 2)
+        Image.objects.filter(pk__in=held).update(claim_expires_at=timezone.now() + timedelta(seconds=5))
+        self.assertEqual(self.claim(self.client, 3), held + [self.images[2].pk])
+        self.assertFalse(Image.objects.filter(pk__in=held, claim_expires_at__lt=timezone.now() + timedelta(
+            seconds=60)).exists())
+
+    def test_expired_claim_returns_to_queue(self):
+        held = self.claim(self.client, 1)
+        Image.objects.filter(pk__in=held).update(claim_expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self.claim(self.other, 1), held)
+        # The first moderator doesn't get it back
+        self.assertNotIn(held[0], self.claim(self.client, 1))
+
+    def test_decide_only_claimed(self):
+        held = self.claim(self.client, 2)
+        foreign = self.claim(self.other, 1)
+        response = self.client.post(f'{IMAGES_URL}queue/decide/',
+                                    {'approve': [held[0]], 'reject': [held[1], foreign[0]]}, format='json')
+        self.assertEqual(response.json()['results'], {
+            str(held[0]): 'approved', str(held[1]): 'rejected', str(foreign[0]): 'not_claimed',
+        })
+        self.assertTrue(Image.objects.get(pk=held[0]).approved)
+        self.assertFalse(Image.objects.get(pk=foreign[0]).rejected)
+        self.assertEqual(self.client.get(f'{IMAGES_URL}queue/').json()['results'], [])
+
+    def test_release(self):
+        self.claim(self.client, 2)
+        response = self.client.post(f'{IMAGES_URL}queue/release/', {}, format='json')
+        self.assertEqual(response.json()['released'], 2)
+        self.assertEqual(self.claim(self.other, 2), [image.pk for image in self.images[:2]])
+
+class SimilarImageTests(AdminTestCase):
+    def setUp(self):
+        super().setUp()
+        base = 0x0123_4567_89AB_CDEF
+        self.image, self.close, self.far = [
+            Image.objects.create(image=f'images/{index}.png', ip_address=f'203.0.113.{index}',
+                                 **get_hash_fields(value))
+            for index, value in enumerate([base, base ^ 0b1011, ~base & ((1 << 64) - 1)])
+        ]
+
+    def test_similar(self):
+        response = self.client.get(f'{IMAGES_URL}{self.image.pk}/similar/')
+        self.assertEqual([(item['id'], item['distance']) for item in response.json()], [(self.close.pk, 3)])
+        response = self.client.get(f'{IMAGES_URL}{self.image.pk}/similar/', {'max_distance': 2})
+        self.assertEqual(response.json(), [])
+        response = self.client.get(f'{IMAGES_URL}{self.image.pk}/similar/', {'max_distance': 64})
+        self.assertEqual(response.status_code, 400)
+
+    def test_moderate_similar(self):
+        response = self.client.post(f'{IMAGES_URL}{self.image.pk}/similar/moderate/', {'action': 'reject'},
+                                    format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['ids'], [self.image.pk, self.close.pk])
+        self.assertEqual(list(Image.objects.filter(rejected=True).order_by('id')), [self.image, self.close])
+        self.assertFalse(Image.objects.get(pk=self.far.pk).rejected)
+
+class SearchTests(AdminTestCase):
+    def search(self, url, term):
+        response = self.client.get(url, {'search': term})
+        self.assertEqual(response.status_code, 200)
+        return sorted(item['id'] for item in response.json()['results'])
+
+    def test_images(self):
+        first = Image.objects.create(image='images/a.png', original_filename='Summer Cat.png',
+                                     ip_address='203.0.113.1')
+        second = Image.objects.create(image='images/b.png', original_filename='dog.jpg', ip_address='203.0.113.12')
+        self.assertEqual(self.search(IMAGES_URL, 'cat'), [first.pk])
+        # IP addresses only match exactly
+        self.assertEqual(self.search(IMAGES_URL, '203.0.113.12'), [second.pk])
+        self.assertEqual(self.search(IMAGES_URL, '203.0.113'), [])
+
+    def test_default_original_filename(self):
+        image = Image(image=make_upload(), ip_address='203.0.113.1')
+        image.save()
+        self.assertTrue(image.original_filename.endswith('.png'))
+
+    def test_order_forms_by_phone_digits(self):
+        order = OrderForms.objects.create(name='Alice', phone='+998 (90) 123-45-67-89')
+        OrderForms.objects.create(name='Bob', phone='+7 (999) 123-45-67-00')
+        self.assertEqual(order.phone_digits, '99890123456789')
+        self.assertEqual(self.search(ORDER_FORMS_URL, '998-90-1'), [order.pk])
+        self.assertEqual(self.search(ORDER_FORMS_URL, 'alice'), [order.pk])
+        self.assertEqual(self.search(ORDER_FORMS_URL, 'nobody'), [])
+
+class CountModeTests(AdminTestCase):
+    def setUp(self):
+        super().setUp()
+        self.create_images(15)
+
+    def get_page(self, **params):
+        response = self.client.get(IMAGES_URL, {'page_size': 10, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_exact(self):
+        data = self.get_page(count_mode='exact')
+        self.assertEqual((data['count'], data['total_pages'], data['count_is_estimate']), (15, 2, False))
+        self.assertEqual(len(data['results']), 10)
+
+    def test_estimated_by_default(self):
+        with mock.patch.object(EstimatedCountPaginator, 'get_estimate', return_value=50_000):
+            data = self.get_page()
+        self.assertEqual((data['count'], data['total_pages'], data['count_is_estimate']), (50_000, 5000, True))
+        self.assertTrue(data['has_next'])
+
+    def test_estimate_below_threshold_is_exact(self):
+        with mock.patch.object(EstimatedCountPaginator, 'get_estimate', return_value=20):
+            data = self.get_page()
+        self.assertEqual((data['count'], data['count_is_estimate']), (15, False))
+
+    def test_switching_modes(self):
+        with mock.patch.object(EstimatedCountPaginator, 'get_estimate', return_value=50_000):
+            self.assertTrue(self.get_page()['count_is_estimate'])
+            self.assertEqual(self.get_page(count_mode='exact')['count'], 15)
+            # Unknown modes fall back to the view's default
+            self.assertEqual(self.get_page(count_mode='bogus')['count'], 50_000)
+
+    def test_cached(self):
+        cache.clear()
+        self.assertEqual(self.get_page(count_mode='cached')['count'], 15)
+        Image.objects.create(image='images/new.png', ip_address='203.0.113.200')
+        self.assertEqual(self.get_page(count_mode='cached')['count'], 15)
+        self.assertEqual(self.get_page(count_mode='exact')['count'], 16)
+
+    def test_none(self):
+        data = self.get_page(count_mode='none', page=2)
+        self.assertEqual((data['count'], data['total_pages'], data['has_next']), (None, None, False))
+        self.assertEqual(len(data['results']), 5)
+        self.assertEqual(self.client.get(IMAGES_URL, {'count_mode': 'none', 'page': 3}).status_code, 404)
+
+    def test_order_forms(self):
+        for index in range(3):
+            OrderForms.objects.create(name=f'Customer {index}', phone='+998901234567891')
+        data = self.client.get(ORDER_FORMS_URL, {'count_mode': 'exact'}).json()
+        self.assertEqual(data['count'], 3)
+
+
+class ExportTests(AdminTestCase):
+    def setUp(self):
+        super().setUp()
+        OrderForms.objects.create(name='=HYPERLINK("http://example.com")', phone='+998901234567891')
+        OrderForms.objects.create(name='Anna', phone='+998901234567892', contact_method=OrderForms.TELEGRAM)
+
+    def test_csv(self):
+        response = self.client.get(f'{ORDER_FORMS_URL}export/', {'ordering': 'id'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('attachment; filename="order-forms-', response['Content-Disposition'])
+        rows = list(csv.reader(StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual(rows[0], ['id', 'ingest_id', 'name', 'phone', 'contact_method', 'created_at'])
+        self.assertEqual([row[2] for row in rows[1:]], ['\'=HYPERLINK("http://example.com")', 'Anna'])
+
+    def test_filtered_gzipped_ndjson(self):
+        response = self.client.get(f'{ORDER_FORMS_URL}export/',
+                                   {'export_format': 'ndjson', 'gzip': '1', 'contact_method': 'telegram'})
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        lines = gzip.decompress(b''.join(response.streaming_content)).decode().splitlines()
+        self.assertEqual([json.loads(line)['name'] for line in lines], ['Anna'])
+
+    def test_invalid_format(self):
+        self.assertEqual(self.client.get(f'{ORDER_FORMS_URL}export/', {'export_format': 'xlsx'}).status_code, 400)
+
+    def test_escape_cell(self):
+        self.assertEqual(escape_cell('-1+2'), "'-1+2")
+        self.assertEqual(escape_cell('Anna'), 'Anna')
+        self.assertEqual(escape_cell(5), 5)
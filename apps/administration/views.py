@@ -1,48 +1,235 @@
 import logging
 
+from django.conf import settings
 from django.db import transaction
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import viewsets, filters, mixins
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
 
-from .serializers import AdminImageSerializer, AdminOrderFormsSerializer
+from .exports import ExportMixin
+from .moderation import (
+    apply_moderation,
+    bulk_delete_images,
+    bulk_moderate,
+    claim_pending_images,
+    decide_claimed,
+    live_claims,
+    release_claims,
+)
+from .serializers import (
+    AdminImageSerializer,
+    AdminOrderFormsSerializer,
+    BulkModerationSerializer,
+    ModerateSimilarSerializer,
+    QueueClaimSerializer,
+    QueueDecisionSerializer,
+    QueueReleaseSerializer,
+    SimilarImageSerializer,
+    SimilarQuerySerializer,
+)
+from ..core.admission import known_uploaders
+from ..core.derivatives import schedule_variants
+from ..core.files import journal_file_deletions
+from ..core.gallery_cache import bump_gallery_version
 from ..core.models import Image, OrderForms
-from ..core.pagination import CustomPagination
+from ..core.pagination import AdaptiveCountPagination
+from ..core.phash import find_similar
+from ..core.search import IndexedSearchFilter
 
 logger = logging.getLogger(__name__)
 
 
-class AdminImageViewSet(mixins.ListModelMixin,
+class AdminImageViewSet(ExportMixin,
+                        mixins.ListModelMixin,
                         mixins.RetrieveModelMixin,
                         mixins.UpdateModelMixin,
                         mixins.DestroyModelMixin,
                         viewsets.GenericViewSet):
     """
-    Admin viewset for Images with list, patch, and delete operations
+    Admin viewset for Images with list, patch, delete and export operations
     """
     queryset = Image.objects.all()
     serializer_class = AdminImageSerializer
     permission_classes = [IsAdminUser]
-    pagination_class = CustomPagination
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
-    filterset_fields = ['approved', 'upload_date']
-    search_fields = ['title', 'original_filename', 'ip_address']
-    ordering_fields = ['upload_date', 'id', 'title']
+    pagination_class = AdaptiveCountPagination
+    pagination_count_mode = 'estimated'
+    # Revocation list reload (every AUTH_REVOCATION_TTL), count estimate, exact count below the threshold, page
+    query_budget = {'GET': 4}
+    filter_backends = [DjangoFilterBackend, IndexedSearchFilter, filters.OrderingFilter]
+    filterset_fields = ['approved', 'rejected', 'upload_date']
+    search_fields = ['original_filename', '=ip_address', '^content_hash']
+    ordering_fields = ['upload_date', 'id', 'original_filename']
     ordering = ['-upload_date']
+    export_fields = ['id', 'image', 'original_filename', 'content_hash', 'ip_address', 'upload_date',
+                     'approved', 'rejected', 'width', 'height']
+    export_name = 'images'
+
+    def perform_update(self, serializer):
+        """
+        Apply approval to every copy of the same file and render variants
+        for newly approved images that don't have them yet
+        """
+        instance = serializer.save()
+        if instance.content_hash:
+            Image.objects.filter(content_hash=instance.content_hash).exclude(pk=instance.pk) \
+                .update(approved=instance.approved, rejected=instance.rejected)
+        bump_gallery_version()
+        if instance.approved and not instance.variants:
+            schedule_variants(instance)
+
+    def get_similar(self, image, max_distance):
+        """
+        Images perceptually similar to `image`, closest first, with their distances
+        """
+        distances = dict(find_similar(image, max_distance))
+        images = sorted(Image.objects.filter(pk__in=distances), key=lambda obj: distances[obj.id])
+        return images, distances
+
+    @action(detail=True, methods=['get'])
+    def similar(self, request, pk=None):
+        """
+        List near-duplicates of an image (`?max_distance=` in bits, default SIMILAR_IMAGES_MAX_DISTANCE)
+        """
+        serializer = SimilarQuerySerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+
+        images, distances = self.get_similar(self.get_object(), serializer.validated_data['max_distance'])
+        return Response(SimilarImageSerializer(
+            images, many=True, context={'request': request, 'distances': distances}
+        ).data)
+
+    @action(detail=True, methods=['post'], url_path='similar/moderate')
+    def moderate_similar(self, request, pk=None):
+        """
+        Approve or reject an image together with all of its near-duplicates
+        """
+        serializer = ModerateSimilarSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        image = self.get_object()
+        images, distances = self.get_similar(image, serializer.validated_data['max_distance'])
+        image_ids = [image.id] + [obj.id for obj in images]
+        updated = apply_moderation(image_ids, serializer.validated_data['action'])
+
+        logger.info(f"Admin applied {serializer.validated_data['action']} to image ID:{image.id} "
+                    f"and {len(images)} similar images")
+        return Response({'action': serializer.validated_data['action'], 'ids': image_ids, 'updated': updated})
+
+    def get_bulk_ids(self, request):
+        serializer = BulkModerationSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        if serializer.validated_data['all_matching']:
+            # Same cap as explicit ids: one row past it tells a too broad filter apart
+            limit = settings.BULK_MODERATION_MAX_IDS
+            queryset = self.filter_queryset(self.get_queryset()).order_by('id')
+            ids = list(queryset.values_list('id', flat=True)[:limit + 1])
+            if len(ids) > limit:
+                raise ValidationError({'all_matching': [f'More than {limit} images match, narrow the filters.']})
+            return ids
+        return list(dict.fromkeys(serializer.validated_data['ids']))
+
+    def bulk_response(self, action_name, results):
+        logger.info(f"Admin bulk {action_name}: {len(results)} images")
+        return Response({'action': action_name, 'processed': len(results), 'results': results})
+
+    @action(detail=False, methods=['post'], url_path='bulk-approve')
+    def bulk_approve(self, request):
+        """
+        Approve many images, by `ids` or by the current filters with `all_matching`
+        """
+        return self.bulk_response('approve', bulk_moderate(self.get_bulk_ids(request), 'approve'))
+
+    @action(detail=False, methods=['post'], url_path='bulk-reject')
+    def bulk_reject(self, request):
+        """
+        Reject many images, by `ids` or by the current filters with `all_matching`
+        """
+        return self.bulk_response('reject', bulk_moderate(self.get_bulk_ids(request), 'reject'))
+
+    @action(detail=False, methods=['post'], url_path='bulk-delete')
+    def bulk_delete(self, request):
+        """
+        Delete many images, by `ids` or by the current filters with `all_matching`.
+        Files are removed by a background reaper after commit.
+        """
+        return self.bulk_response('delete', bulk_delete_images(self.get_bulk_ids(request)))
+
+    def queue_response(self, request, image_ids, expires_at=None):
+        images = Image.objects.filter(pk__in=image_ids).order_by('upload_date', 'id')
+        return Response({
+            'lease_expires_at': expires_at,
+            'results': AdminImageSerializer(images, many=True, context={'request': request}).data,
+        })
+
+    @action(detail=False, methods=['get'])
+    def queue(self, request):
+        """
+        The pending images the moderator currently holds a claim on
+        """
+        claims = live_claims(request.user.pk).order_by('upload_date', 'id')
+        return Response({
+            'lease_expires_at': max((image.claim_expires_at for image in claims), default=None),
+            'results': AdminImageSerializer(claims, many=True, context={'request': request}).data,
+        })
+
+    @action(detail=False, methods=['post'], url_path='queue/claim')
+    def queue_claim(self, request):
+        """
+        Claim a batch of `count` pending images nobody else is moderating,
+        renewing the lease on those already held. Unfinished claims return
+        to the queue when the lease (MODERATION_CLAIM_LEASE) runs out.
+        """
+        serializer = QueueClaimSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        image_ids, expires_at = claim_pending_images(request.user.pk, serializer.validated_data['count'])
+        logger.info(f"Admin ID:{request.user.pk} claimed {len(image_ids)} images for moderation")
+        return self.queue_response(request, image_ids, expires_at)
+
+    @action(detail=False, methods=['post'], url_path='queue/release')
+    def queue_release(self, request):
+        """
+        Hand claimed images back to the queue, by `ids` or all of them
+        """
+        serializer = QueueReleaseSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        released = release_claims(request.user.pk, serializer.validated_data.get('ids'))
+        return Response({'released': released})
+
+    @action(detail=False, methods=['post'], url_path='queue/decide')
+    def queue_decide(self, request):
+        """
+        Approve and reject claimed images in one call. Ids the moderator
+        doesn't hold a live claim on are left alone and reported as `not_claimed`.
+        """
+        serializer = QueueDecisionSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        results = decide_claimed(request.user.pk, {
+            action_name: list(dict.fromkeys(serializer.validated_data[action_name]))
+            for action_name in ('approve', 'reject')
+        })
+        return self.bulk_response('decide', results)
 
     @transaction.atomic
     def perform_destroy(self, instance):
         """
-        When deleting an image, also delete the file from storage
+        When deleting an image, journal its file and variants for deletion.
+        They are removed after commit unless another image still shares them.
         """
         try:
             image_id = instance.id
-            image_path = instance.image.path if instance.image else "No file"
-
-            if instance.image:
-                instance.image.delete(save=False)
+            image_path = instance.image.name if instance.image else "No file"
 
             instance.delete()
+            journal_file_deletions([instance.image.name])
+            known_uploaders.discard(instance.ip_address)
+            bump_gallery_version()
 
             logger.info(f"Admin deleted image ID:{image_id}, Path:{image_path}")
 
@@ -51,23 +238,28 @@ class AdminImageViewSet(mixins.ListModelMixin,
             raise
 
 
-class AdminOrderFormsViewSet(mixins.ListModelMixin,
+class AdminOrderFormsViewSet(ExportMixin,
+                             mixins.ListModelMixin,
                              mixins.RetrieveModelMixin,
                              mixins.UpdateModelMixin,
                              mixins.DestroyModelMixin,
                              viewsets.GenericViewSet):
     """
-    Admin viewset for Order Forms with list, patch, and delete operations
+    Admin viewset for Order Forms with list, patch, delete and export operations
     """
     queryset = OrderForms.objects.all()
     serializer_class = AdminOrderFormsSerializer
     permission_classes = [IsAdminUser]
-    pagination_class = CustomPagination
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
+    pagination_class = AdaptiveCountPagination
+    pagination_count_mode = 'estimated'
+    query_budget = {'GET': 4}
+    filter_backends = [DjangoFilterBackend, IndexedSearchFilter, filters.OrderingFilter]
     filterset_fields = ['contact_method', 'created_at']
-    search_fields = ['name', 'phone']
+    search_fields = ['name', 'phone', '#phone_digits']
     ordering_fields = ['created_at', 'id', 'name']
     ordering = ['-created_at']
+    export_fields = ['id', 'ingest_id', 'name', 'phone', 'contact_method', 'created_at']
+    export_name = 'order-forms'
 
     def perform_destroy(self, instance):
         """
@@ -1,6 +1,14 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save, pre_save
 
 
 class AuthenticationConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.authentication'
+
+    def ready(self):
+        from .models import User
+        from .signals import remember_token_claims, revoke_changed_user_tokens, revoke_deleted_user_tokens
+        pre_save.connect(remember_token_claims, sender=User)
+        post_save.connect(revoke_changed_user_tokens, sender=User)
+        post_delete.connect(revoke_deleted_user_tokens, sender=User)
@@ -0,0 +1,68 @@
+import threading
+import time
+
+from django.conf import settings
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+
+from .revocation import revocation_list
+
+
+class UserCache:
+    """
+    Users resolved from the database for tokens without claims,
+    kept AUTH_USER_CACHE_TTL seconds per process
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # {user id: (expires, user)}
+        self.users = {}
+
+    def get(self, user_id):
+        entry = self.users.get(user_id)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        return None
+
+    def set(self, user_id, user):
+        with self.lock:
+            if len(self.users) >= settings.AUTH_USER_CACHE_SIZE:
+                self.users.clear()
+            self.users[user_id] = (time.monotonic() + settings.AUTH_USER_CACHE_TTL, user)
+
+
+user_cache = UserCache()
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication that trusts the user claims of the token instead of
+    loading the user: `request.user` is a TokenUser with `is_staff` and
+    `is_superuser` from the token, which is enough for IsAdminUser. Revoked
+    tokens are refused, see revocation.py. Tokens minted before the claims
+    existed still resolve the user from the database, through a short cache.
+    """
+
+    def get_user(self, validated_token):
+        if api_settings.USER_ID_CLAIM not in validated_token:
+            raise AuthenticationFailed(_('Token contained no recognizable user identification'),
+                                       code='token_not_valid')
+
+        if revocation_list.is_revoked(validated_token):
+            raise AuthenticationFailed(_('Token has been revoked'), code='token_revoked')
+
+        if 'is_staff' in validated_token:
+            if not validated_token.get('is_active', True):
+                raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+            return TokenUser(validated_token)
+
+        user_id = validated_token[api_settings.USER_ID_CLAIM]
+        user = user_cache.get(user_id)
+        if user is None:
+            user = super().get_user(validated_token)
+            user_cache.set(user_id, user)
+        return user
@@ -1,9 +1,36 @@
 from django.contrib.auth.models import AbstractUser
 from django.db import models
+from django.utils import timezone
 
 class User(AbstractUser):
     pass
     def __str__(self):
         return self.username
+
+    def check_password(self, raw_password):
+        # A successful check may re-hash and save the password; the raw
+        # password lets the token signals tell that from a real change
+        self._checked_password = raw_password
+        try:
+            return super().check_password(raw_password)
+        finally:
+            self._checked_password = None
+
     class Meta:
         db_table = 'user'
+
+
+class TokenRevocation(models.Model):
+    """
+    JWTs that stop working before they expire: the one with `jti`, or,
+    without a jti, every token of the user issued by a login before `revoked_at`.
+    `user_id` is not a foreign key so revocations outlive deleted users.
+    """
+    user_id = models.PositiveBigIntegerField(db_index=True)
+    jti = models.CharField(max_length=255, blank=True, db_index=True)
+    revoked_at = models.DateTimeField(default=timezone.now)
+    # Once every token it covers has expired the row can be dropped
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        db_table = 'token_revocation'
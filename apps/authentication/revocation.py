@@ -0,0 +1,101 @@
+"""
+Revocation list for the claims-carrying JWTs of ClaimsJWTAuthentication.
+
+Tokens are checked against an in-process copy of the unexpired
+TokenRevocation rows, reloaded at most every AUTH_REVOCATION_TTL seconds,
+so a request costs no query. The process that revokes a token reloads at
+once; other workers honour the revocation within AUTH_REVOCATION_TTL.
+"""
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.utils import timezone
+from rest_framework_simplejwt.settings import api_settings
+
+from .models import TokenRevocation
+
+# Claim holding when the login behind a token happened, with sub-second
+# precision like `revoked_at`; access tokens minted by a refresh keep the
+# one of their refresh token
+AUTH_TIME_CLAIM = 'auth_time'
+
+
+def get_auth_time(token):
+    return token.get(AUTH_TIME_CLAIM, token.get('iat', 0))
+
+
+class RevocationList:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded_at = None
+        self.jtis = frozenset()
+        # {user id: timestamp before which the user's logins are revoked}
+        self.users = {}
+
+    def load(self):
+        jtis, users = set(), {}
+        rows = TokenRevocation.objects.filter(expires_at__gt=timezone.now()).values_list(
+            'user_id', 'jti', 'revoked_at'
+        )
+        for user_id, jti, revoked_at in rows:
+            if jti:
+                jtis.add(jti)
+            else:
+                users[user_id] = max(users.get(user_id, 0), revoked_at.timestamp())
+        self.jtis, self.users = frozenset(jtis), users
+        self.loaded_at = time.monotonic()
+
+    def reload_if_stale(self):
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > settings.AUTH_REVOCATION_TTL:
+            with self.lock:
+                if self.loaded_at is None or time.monotonic() - self.loaded_at > settings.AUTH_REVOCATION_TTL:
+                    self.load()
+
+    def is_revoked(self, token):
+        self.reload_if_stale()
+        if token.get(api_settings.JTI_CLAIM) in self.jtis:
+            return True
+        revoked_at = self.users.get(token.get(api_settings.USER_ID_CLAIM))
+        return revoked_at is not None and get_auth_time(token) < revoked_at
+
+    def expire(self):
+        """
+        Make the next check reload, e.g. after a revocation in this process
+        """
+        self.loaded_at = None
+
+
+revocation_list = RevocationList()
+
+
+def prune_revocations():
+    TokenRevocation.objects.filter(expires_at__lte=timezone.now()).delete()
+
+
+def revoke_token(token):
+    """
+    Revoke one access or refresh token until it expires
+    """
+    TokenRevocation.objects.create(
+        user_id=token[api_settings.USER_ID_CLAIM],
+        jti=token[api_settings.JTI_CLAIM],
+        expires_at=datetime.fromtimestamp(token['exp'], dt_timezone.utc),
+    )
+    prune_revocations()
+    revocation_list.expire()
+
+
+def revoke_user_tokens(user_id):
+    """
+    Revoke every token issued to the user so far, refresh tokens included
+    """
+    now = timezone.now()
+    TokenRevocation.objects.create(
+        user_id=user_id,
+        revoked_at=now,
+        expires_at=now + max(api_settings.ACCESS_TOKEN_LIFETIME, api_settings.REFRESH_TOKEN_LIFETIME),
+    )
+    prune_revocations()
+    revocation_list.expire()
@@ -0,0 +1,41 @@
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+from rest_framework import serializers
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+
+from .revocation import AUTH_TIME_CLAIM, revocation_list
+
+# User fields copied into the tokens, read back by ClaimsJWTAuthentication
+USER_CLAIMS = ('username', 'is_staff', 'is_superuser', 'is_active')
+
+
+class ClaimsTokenObtainPairSerializer(TokenObtainPairSerializer):
+    """
+    Token pair carrying the user claims needed by the admin permission
+    checks, which access tokens minted by a refresh inherit
+    """
+
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        for claim in USER_CLAIMS:
+            token[claim] = getattr(user, claim)
+        token[AUTH_TIME_CLAIM] = timezone.now().timestamp()
+        return token
+
+
+class ClaimsTokenRefreshSerializer(TokenRefreshSerializer):
+    """
+    Refresh that refuses revoked refresh tokens
+    """
+
+    def validate(self, attrs):
+        if revocation_list.is_revoked(self.token_class(attrs['refresh'])):
+            raise AuthenticationFailed(_('Token has been revoked'), code='token_revoked')
+        return super().validate(attrs)
+
+
+class TokenRevokeSerializer(serializers.Serializer):
+    refresh = serializers.CharField(required=False)
+    all = serializers.BooleanField(default=False)
@@ -0,0 +1,45 @@
+from django.contrib.auth.hashers import check_password
+
+from .revocation import revoke_user_tokens
+
+# Changes that must invalidate the claims, or the sessions, of issued tokens
+REVOKING_FIELDS = ('username', 'is_staff', 'is_superuser', 'is_active', 'password')
+
+
+def remember_token_claims(sender, instance, **kwargs):
+    """
+    pre_save: note whether the save changes anything tokens depend on
+    """
+    instance._revokes_tokens = False
+    if instance.pk is None:
+        return
+    update_fields = kwargs.get('update_fields')
+    fields = [field for field in REVOKING_FIELDS if update_fields is None or field in update_fields]
+    if not fields:
+        return
+    previous = sender.objects.filter(pk=instance.pk).values(*fields).first()
+    instance._revokes_tokens = previous is not None and any(
+        password_changed(instance, previous[field]) if field == 'password'
+        else previous[field] != getattr(instance, field)
+        for field in fields
+    )
+
+
+def password_changed(instance, previous_hash):
+    """
+    A new hash of the same password, from a re-hash on login or
+    set_password() with the old password, is no change
+    """
+    if instance.password == previous_hash:
+        return False
+    raw_password = getattr(instance, '_password', None) or getattr(instance, '_checked_password', None)
+    return raw_password is None or not check_password(raw_password, previous_hash)
+
+
+def revoke_changed_user_tokens(sender, instance, created, **kwargs):
+    if getattr(instance, '_revokes_tokens', False):
+        revoke_user_tokens(instance.pk)
+
+
+def revoke_deleted_user_tokens(sender, instance, **kwargs):
+    revoke_user_tokens(instance.pk)
@@ -1,3 +1,101 @@
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
 from django.test import TestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .authentication import user_cache
+from .models import TokenRevocation, User
+from .revocation import AUTH_TIME_CLAIM, revocation_list, revoke_user_tokens
+
+ADMIN_URL = '/api/v1/administration/images/'
+
+
+class TokenRevocationTests(TestCase):
+    def setUp(self):
+        revocation_list.expire()
+        user_cache.users.clear()
+        self.user = User.objects.create_user('moderator', password='old-password', is_staff=True)
+        self.client = APIClient()
+
+    def login(self, password='old-password'):
+        response = self.client.post('/api/v1/auth/token/', {'username': 'moderator', 'password': password},
+                                    format='json')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def get_admin(self, access):
+        revocation_list.expire()
+        return self.client.get(ADMIN_URL, HTTP_AUTHORIZATION=f'Bearer {access}')
+
+    def test_login_tokens_carry_claims(self):
+        access = AccessToken(self.login()['access'])
+        self.assertTrue(access['is_staff'])
+        self.assertEqual(access['username'], 'moderator')
+        self.assertIsInstance(access[AUTH_TIME_CLAIM], float)
+
+    def test_rehash_on_login_keeps_tokens(self):
+        # An outdated hasher makes check_password() re-hash and save on login
+        self.user.password = make_password('old-password', hasher='pbkdf2_sha1')
+        self.user.save()
+        TokenRevocation.objects.all().delete()
+
+        tokens = self.login()
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.password.startswith('pbkdf2_sha256$'))
+        self.assertFalse(TokenRevocation.objects.exists())
+        self.assertEqual(self.get_admin(tokens['access']).status_code, 200)
+
+    def test_same_password_keeps_tokens(self):
+        tokens = self.login()
+        self.user.set_password('old-password')
+        self.user.save()
+        self.assertFalse(TokenRevocation.objects.exists())
+        self.assertEqual(self.get_admin(tokens['access']).status_code, 200)
+
+    def test_password_change_revokes_tokens(self):
+        tokens = self.login()
+        self.user.set_password('new-password')
+        self.user.save()
+        self.assertEqual(self.get_admin(tokens['access']).status_code, 401)
+        refresh = self.client.post('/api/v1/auth/token/refresh/', {'refresh': tokens['refresh']}, format='json')
+        self.assertEqual(refresh.status_code, 401)
+        # Logging in again after the change works straight away
+        self.assertEqual(self.get_admin(self.login('new-password')['access']).status_code, 200)
+
+    def test_claim_change_revokes_tokens(self):
+        tokens = self.login()
+        self.user.is_staff = False
+        self.user.save()
+        self.assertEqual(self.get_admin(tokens['access']).status_code, 401)
+
+    def test_revocation_compares_sub_second(self):
+        revoked_at = timezone.now()
+        TokenRevocation.objects.create(user_id=self.user.pk, revoked_at=revoked_at,
+                                       expires_at=revoked_at + timedelta(days=1))
+        revocation_list.expire()
+        token = AccessToken.for_user(self.user)
+        token[AUTH_TIME_CLAIM] = revoked_at.timestamp() - 0.001
+        self.assertTrue(revocation_list.is_revoked(token))
+        token[AUTH_TIME_CLAIM] = revoked_at.timestamp() + 0.001
+        self.assertFalse(revocation_list.is_revoked(token))
+
+    def test_revoke_view(self):
+        tokens = self.login()
+        response = self.client.post('/api/v1/auth/token/revoke/', {'refresh': tokens['refresh']}, format='json',
+                                    HTTP_AUTHORIZATION=f'Bearer {tokens["access"]}')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.get_admin(tokens['access']).status_code, 401)
+        refresh = self.client.post('/api/v1/auth/token/refresh/', {'refresh': tokens['refresh']}, format='json')
+        self.assertEqual(refresh.status_code, 401)
+
+    def test_deleted_user_tokens_revoked(self):
+        tokens = self.login()
+        self.user.delete()
+        self.assertEqual(self.get_admin(tokens['access']).status_code, 401)
 
-# Create your tests here.
+    def test_revoke_user_tokens_spares_later_logins(self):
+        revoke_user_tokens(self.user.pk)
+        self.assertEqual(self.get_admin(self.login()['access']).status_code, 200)
@@ -1,3 +1,43 @@
-from django.shortcuts import render
+from rest_framework import status
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
 
-# Create your views here.
+from .revocation import revoke_token, revoke_user_tokens
+from .serializers import TokenRevokeSerializer
+
+
+class TokenRevokeView(APIView):
+    """
+    API endpoint revoking tokens before they expire
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, format=None):
+        """
+        Revoke the access token of the request and the `refresh` token if
+        given, or with `all` every token of the user (logout everywhere)
+        """
+        serializer = TokenRevokeSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        if serializer.validated_data['all']:
+            revoke_user_tokens(request.user.pk)
+            return Response(status=status.HTTP_204_NO_CONTENT)
+
+        refresh = None
+        if 'refresh' in serializer.validated_data:
+            try:
+                refresh = RefreshToken(serializer.validated_data['refresh'])
+            except TokenError as e:
+                return Response({'refresh': [str(e)]}, status=status.HTTP_400_BAD_REQUEST)
+            if refresh.get(api_settings.USER_ID_CLAIM) != request.auth[api_settings.USER_ID_CLAIM]:
+                return Response({'refresh': ['Token belongs to another user.']}, status=status.HTTP_400_BAD_REQUEST)
+
+        revoke_token(request.auth)
+        if refresh is not None:
+            revoke_token(refresh)
+        return Response(status=status.HTTP_204_NO_CONTENT)
@@ -0,0 +1,78 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Image
+
+
+class KnownUploaders:
+    """
+    Set of IP addresses known to have uploaded an image, kept in the default
+    cache so an upload, or the deletion of an image, in one worker is seen by
+    the others. Only positive answers are cached: an IP missing here is
+    checked in the database. Entries expire after UPLOAD_ADMISSION_CACHE_TIMEOUT
+    seconds, which bounds how long a per-process cache backend keeps
+    rejecting an IP whose image was deleted in another worker.
+    """
+
+    def get_key(self, ip_address):
+        return f'admission:uploaded:{ip_address}'
+
+    def __contains__(self, ip_address):
+        return cache.get(self.get_key(ip_address)) is not None
+
+    async def acontains(self, ip_address):
+        return await cache.aget(self.get_key(ip_address)) is not None
+
+    def add(self, ip_address):
+        cache.set(self.get_key(ip_address), True, settings.UPLOAD_ADMISSION_CACHE_TIMEOUT)
+
+    async def aadd(self, ip_address):
+        await cache.aset(self.get_key(ip_address), True, settings.UPLOAD_ADMISSION_CACHE_TIMEOUT)
+
+    def discard(self, ip_address):
+        cache.delete(self.get_key(ip_address))
+
+    def discard_many(self, ip_addresses):
+        cache.delete_many([self.get_key(ip_address) for ip_address in ip_addresses])
+
+
+known_uploaders = KnownUploaders()
+
+
+def has_uploaded(ip_address):
+    """
+    Whether `ip_address` already uploaded an image, answered from the cache when possible.
+    The unique index on Image.ip_address makes the fallback an index lookup and
+    settles the race between two concurrent first uploads.
+    """
+    if ip_address in known_uploaders:
+        return True
+
+    if Image.objects.filter(ip_address=ip_address).exists():
+        known_uploaders.add(ip_address)
+        return True
+    return False
+
+
+async def ahas_uploaded(ip_address):
+    """
+    Async version of `has_uploaded` for the ASGI views
+    """
+    if await known_uploaders.acontains(ip_address):
+        return True
+
+    if await Image.objects.filter(ip_address=ip_address).aexists():
+        await known_uploaders.aadd(ip_address)
+        return True
+    return False
+
+
+def is_oversized_request(request):
+    """
+    Reject bodies that can't hold a valid image before they are read
+    """
+    try:
+        content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return False
+    return content_length > settings.IMAGE_MAX_UPLOAD_SIZE + settings.UPLOAD_MULTIPART_OVERHEAD
@@ -1,6 +1,17 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.models.signals import post_migrate
 
 
 class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.core'
+
+    def ready(self):
+        from .search import create_search_indexes
+        post_migrate.connect(create_search_indexes, sender=self)
+
+        if settings.ORDER_FORM_INGEST_MODE == 'spool':
+            # Segments of crashed processes go in as soon as a process starts
+            from .ingest import start_replay
+            start_replay()
@@ -0,0 +1,145 @@
+"""
+Async-native versions of the public core endpoints for ASGI deployments.
+
+Enabled with CORE_ASYNC_VIEWS=1; they keep the URLs, payloads and rules of
+the views in views.py. Under an ASGI server the request body is received
+without holding a thread. Parsing the body, decoding the image and the
+final INSERT + file write of an upload block, so they hop to worker threads.
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.exceptions import NotFound, ParseError
+from rest_framework.parsers import FormParser, JSONParser, MultiPartParser
+from rest_framework.request import Request
+
+from .admission import ahas_uploaded, is_oversized_request
+from .gallery_cache import acached_gallery_response
+from .ingest import order_ingester
+from .metrics import record_rejection
+from .models import Image, OrderForms
+from .pagination import GalleryCursorPagination
+from .serializers import ImageSerializer, OrderFormsSerializer
+from .validators import inspect_image
+from .views import (
+    ALREADY_UPLOADED_MESSAGE,
+    ORDER_ACCEPTED_MESSAGE,
+    ORDER_SUBMITTED_MESSAGE,
+    UPLOADED_MESSAGE,
+    get_client_ip,
+    save_image,
+)
+
+
+def read_upload(request):
+    """
+    Parse the multipart body and inspect the image: (file, image info, error message)
+    """
+    image_file = request.FILES.get('image')
+    if image_file is None:
+        return None, None, None
+    image_info, error_message = inspect_image(image_file)
+    return image_file, image_info, error_message
+
+
+def parse_data(request, parsers):
+    return Request(request, parsers=parsers).data
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncImageListCreateView(View):
+    """
+    Async endpoint for listing and creating images
+    """
+    pagination_class = GalleryCursorPagination
+
+    async def get(self, request):
+        """
+        List only approved images, see ImageListCreateView.get
+        """
+        try:
+            return await acached_gallery_response(request, lambda: self.list_approved(Request(request)))
+        except NotFound as e:
+            return JsonResponse({'detail': str(e.detail)}, status=404)
+
+    async def list_approved(self, request):
+        queryset = Image.objects.filter(approved=True)
+
+        paginator = self.pagination_class()
+        if paginator.is_requested(request):
+            page = await paginator.apaginate_queryset(queryset, request, view=self)
+            serializer = ImageSerializer(page, many=True, context={'request': request})
+            return paginator.get_paginated_response(serializer.data).data
+
+        images = [image async for image in queryset]
+        return ImageSerializer(images, many=True, context={'request': request}).data
+
+    async def post(self, request):
+        """
+        Create a new image with IP check (one image per IP), see ImageListCreateView.post
+        """
+        ip_address = get_client_ip(request)
+
+        if await ahas_uploaded(ip_address):
+            record_rejection(request, 'already_uploaded')
+            return JsonResponse({'detail': ALREADY_UPLOADED_MESSAGE}, status=403)
+
+        if is_oversized_request(request):
+            record_rejection(request, 'too_large')
+            return JsonResponse(
+                {'detail': f'Image file size must be under {settings.IMAGE_MAX_UPLOAD_SIZE // (1024 * 1024)}MB.'},
+                status=413
+            )
+
+        image_file, image_info, error_message = await sync_to_async(read_upload, thread_sensitive=False)(request)
+        if image_file is None:
+            record_rejection(request, 'missing_file')
+            return JsonResponse({'detail': 'No image file provided.'}, status=400)
+
+        if error_message:
+            record_rejection(request, image_file.rejection_reason)
+            return JsonResponse({'detail': error_message}, status=400)
+
+        serializer = ImageSerializer(data={'image': image_file}, context={'request': request})
+        if await sync_to_async(serializer.is_valid, thread_sensitive=False)():
+            if await sync_to_async(save_image)(serializer, ip_address, image_info) is None:
+                record_rejection(request, 'already_uploaded')
+                return JsonResponse({'detail': ALREADY_UPLOADED_MESSAGE}, status=403)
+            return JsonResponse({'detail': UPLOADED_MESSAGE, 'data': serializer.data}, status=201)
+        record_rejection(request, 'invalid_data')
+        return JsonResponse(serializer.errors, status=400)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncOrderFormListCreateView(View):
+    """
+    Async endpoint for order forms
+    """
+    parser_classes = [JSONParser, FormParser, MultiPartParser]
+
+    async def post(self, request):
+        """
+        Create a new order form from POST data
+        """
+        try:
+            data = await sync_to_async(parse_data, thread_sensitive=False)(
+                request, [parser() for parser in self.parser_classes]
+            )
+        except ParseError as e:
+            record_rejection(request, 'invalid_data')
+            return JsonResponse({'detail': str(e.detail)}, status=400)
+
+        serializer = OrderFormsSerializer(data=data)
+        if serializer.is_valid():
+            if settings.ORDER_FORM_INGEST_MODE == 'spool':
+                submission_id = await sync_to_async(order_ingester.submit, thread_sensitive=False)(
+                    serializer.validated_data
+                )
+                return JsonResponse({'message': ORDER_ACCEPTED_MESSAGE, 'submission_id': submission_id}, status=202)
+            await OrderForms.objects.acreate(**serializer.validated_data)
+            return JsonResponse({'message': ORDER_SUBMITTED_MESSAGE}, status=201)
+        record_rejection(request, 'invalid_data')
+        return JsonResponse(serializer.errors, status=400)
@@ -0,0 +1,89 @@
+"""
+Client IP resolution behind reverse proxies.
+
+X-Forwarded-For is read right to left, starting from REMOTE_ADDR: each hop
+is trusted only while it belongs to TRUSTED_PROXIES, and the first
+untrusted address is the client. Entries left of it were written by the
+client and are ignored, so they can't be spoofed.
+"""
+import ipaddress
+from functools import lru_cache
+
+from django.conf import settings
+
+
+def parse_address(value):
+    """
+    ip_address from an XFF entry or REMOTE_ADDR, tolerating ports
+    ('1.2.3.4:80', '[::1]:80'). Returns None for anything else.
+    """
+    value = value.strip()
+    if value.startswith('['):
+        value = value[1:value.find(']')]
+    elif value.count(':') == 1:
+        value = value.split(':')[0]
+    try:
+        address = ipaddress.ip_address(value)
+    except ValueError:
+        return None
+    if address.version == 6 and address.ipv4_mapped:
+        return address.ipv4_mapped
+    return address
+
+
+class TrustedNetworks:
+    """
+    Set of CIDRs with one hash lookup per distinct prefix length, instead
+    of scanning every network
+    """
+
+    def __init__(self, cidrs):
+        # {version: {prefix length: {network address >> host bits}}}
+        self.tables = {4: {}, 6: {}}
+        for cidr in cidrs:
+            network = ipaddress.ip_network(cidr.strip(), strict=False)
+            host_bits = network.max_prefixlen - network.prefixlen
+            self.tables[network.version].setdefault(network.prefixlen, set()).add(
+                int(network.network_address) >> host_bits
+            )
+
+    def __contains__(self, address):
+        value = int(address)
+        for prefixlen, networks in self.tables[address.version].items():
+            if value >> (address.max_prefixlen - prefixlen) in networks:
+                return True
+        return False
+
+
+class TrustedProxyResolver:
+    def __init__(self, trusted_proxies):
+        self.trusted = TrustedNetworks(trusted_proxies)
+
+    def resolve(self, remote_addr, forwarded_for=None):
+        """
+        Client address as a normalized string, from REMOTE_ADDR and X-Forwarded-For
+        """
+        client = parse_address(remote_addr or '')
+        if client is None:
+            return remote_addr
+        if not forwarded_for or client not in self.trusted:
+            return str(client)
+
+        for entry in reversed(forwarded_for.split(',')):
+            address = parse_address(entry)
+            if address is None:
+                # A trusted proxy passed on garbage: stop at that proxy
+                break
+            client = address
+            if client not in self.trusted:
+                break
+        return str(client)
+
+
+@lru_cache(maxsize=1)
+def get_resolver():
+    return TrustedProxyResolver(settings.TRUSTED_PROXIES)
+
+
+def resolve_client_ip(request):
+    return get_resolver().resolve(request.META.get('REMOTE_ADDR'), request.META.get('HTTP_X_FORWARDED_FOR'))
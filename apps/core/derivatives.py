@@ -0,0 +1,86 @@
+import logging
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from .gallery_cache import bump_gallery_version
+from .media import get_media_url
+from .models import Image
+from .phash import get_hash_fields
+from .rendering import get_variant_dir, render_variants
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        # Forking a process that runs request threads and holds database
+        # connections is unsafe; the workers only need rendering.py
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        _executor = ProcessPoolExecutor(max_workers=settings.IMAGE_VARIANT_WORKERS, mp_context=context)
+    return _executor
+
+
+def store_variants(image_name, rendered):
+    """
+    Save the output of `render_variants` on every image sharing the file
+    """
+    variants, phash = rendered
+    Image.objects.filter(image=image_name).update(variants=variants, **get_hash_fields(phash))
+    if Image.objects.filter(image=image_name, approved=True).exists():
+        bump_gallery_version()
+
+
+def _on_variants_rendered(image_id, image_name, future):
+    try:
+        store_variants(image_name, future.result())
+    except Exception as e:
+        logger.error(f"Error generating variants for image ID:{image_id}: {str(e)}")
+    finally:
+        # Runs on the executor's management thread, which owns its own connection
+        close_old_connections()
+
+
+def _submit(image_id, image_name):
+    if not settings.IMAGE_VARIANT_WORKERS:
+        try:
+            store_variants(image_name, render_variants(image_name, settings.MEDIA_ROOT))
+        except Exception as e:
+            logger.error(f"Error generating variants for image ID:{image_id}: {str(e)}")
+        return
+
+    future = get_executor().submit(render_variants, image_name, settings.MEDIA_ROOT)
+    future.add_done_callback(partial(_on_variants_rendered, image_id, image_name))
+
+
+def schedule_variants(image):
+    """
+    Render variants of `image` in the worker pool once the current transaction commits.
+    With IMAGE_VARIANT_WORKERS = 0 they are rendered inline instead.
+    """
+    if not image.image:
+        return
+    transaction.on_commit(partial(_submit, image.pk, image.image.name))
+
+
+def delete_variants(image_name):
+    shutil.rmtree(os.path.join(settings.MEDIA_ROOT, get_variant_dir(image_name)), ignore_errors=True)
+
+
+def get_variant_urls(image, request, signed=False):
+    """
+    {variant: {format: url}} for the serializers
+    """
+    urls = {}
+    for variant, formats in (image.variants or {}).items():
+        urls[variant] = {key: get_media_url(name, request, signed) for key, name in formats.items()}
+    return urls
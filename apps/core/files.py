@@ -0,0 +1,153 @@
+import logging
+import os
+import posixpath
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .derivatives import delete_variants
+from .models import Image, MediaDeletion
+
+logger = logging.getLogger(__name__)
+
+_reaper = ThreadPoolExecutor(max_workers=1, thread_name_prefix='media-reaper')
+
+
+def journal_file_deletions(names):
+    """
+    Record files to delete in the current transaction. They are removed after
+    commit by the background reaper (or `collect_media_garbage`), and never if
+    the transaction rolls back.
+    """
+    names = sorted({name for name in names if name})
+    if not names:
+        return
+
+    MediaDeletion.objects.bulk_create([MediaDeletion(name=name) for name in names])
+    transaction.on_commit(lambda: _reaper.submit(_process_in_background))
+
+
+def _process_in_background():
+    try:
+        process_deletion_journal()
+    except Exception as e:
+        logger.error(f"Error processing media deletion journal: {str(e)}")
+    finally:
+        close_old_connections()
+
+
+def claim_journal_entries():
+    """
+    Take a batch of due entries for MEDIA_GC_CLAIM_TIMEOUT seconds, in a
+    short transaction, so no row lock is held while files are deleted.
+    Entries of a worker that dies are due again once the claim runs out.
+    """
+    with transaction.atomic():
+        entries = list(
+            MediaDeletion.objects.select_for_update(skip_locked=True)
+            .filter(attempts__lt=settings.MEDIA_GC_MAX_ATTEMPTS, next_attempt_at__lte=timezone.now())
+            .order_by('id')[:settings.MEDIA_GC_BATCH_SIZE]
+        )
+        MediaDeletion.objects.filter(id__in=[entry.id for entry in entries]).update(
+            next_attempt_at=timezone.now() + timedelta(seconds=settings.MEDIA_GC_CLAIM_TIMEOUT)
+        )
+    return entries
+
+
+def process_deletion_journal():
+    """
+    Delete journaled files, with their variants, in batches.
+    Files that an Image references again (e.g. a re-upload of the same content)
+    are kept. Failures are retried with exponential backoff up to
+    MEDIA_GC_MAX_ATTEMPTS times. Returns (deleted, failed).
+    """
+    storage = Image._meta.get_field('image').storage
+    deleted = failed = 0
+
+    while True:
+        entries = claim_journal_entries()
+        if not entries:
+            return deleted, failed
+
+        referenced = set(Image.objects.filter(image__in={entry.name for entry in entries})
+                         .values_list('image', flat=True))
+        done, retry = [], []
+        for entry in entries:
+            try:
+                if entry.name not in referenced and storage.delete_unreferenced(
+                        entry.name, Image.objects.filter(image=entry.name).exists):
+                    delete_variants(entry.name)
+                done.append(entry.id)
+            except Exception as e:
+                entry.attempts += 1
+                entry.last_error = str(e)
+                entry.next_attempt_at = timezone.now() + timedelta(
+                    seconds=settings.MEDIA_GC_RETRY_DELAY * 2 ** entry.attempts
+                )
+                retry.append(entry)
+
+        with transaction.atomic():
+            MediaDeletion.objects.filter(id__in=done).delete()
+            MediaDeletion.objects.bulk_update(retry, ['attempts', 'last_error', 'next_attempt_at'])
+
+        deleted += len(done)
+        failed += len(retry)
+        if retry:
+            logger.error(f"Could not delete {len(retry)} media files, will retry")
+
+
+def _is_old(path):
+    return os.path.getmtime(path) < time.time() - settings.MEDIA_GC_ORPHAN_GRACE
+
+
+def find_orphaned_files():
+    """
+    Yield names of files under MEDIA_ROOT/images/ that no Image references,
+    skipping anything younger than MEDIA_GC_ORPHAN_GRACE (uploads in flight)
+    """
+    images_root = os.path.join(settings.MEDIA_ROOT, 'images')
+    for directory, _, filenames in os.walk(images_root):
+        candidates = {}
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            if _is_old(path):
+                name = os.path.relpath(path, settings.MEDIA_ROOT).replace(os.sep, '/')
+                candidates[name] = path
+
+        for start in range(0, len(candidates), settings.MEDIA_GC_BATCH_SIZE):
+            chunk = list(candidates)[start:start + settings.MEDIA_GC_BATCH_SIZE]
+            referenced = set(Image.objects.filter(image__in=chunk).values_list('image', flat=True))
+            yield from (name for name in chunk if name not in referenced)
+
+
+def find_orphaned_variant_dirs():
+    """
+    Yield variant directories whose source image is gone
+    """
+    variants_root = os.path.join(settings.MEDIA_ROOT, 'variants')
+    for directory, subdirectories, filenames in os.walk(variants_root):
+        if subdirectories or not filenames or not _is_old(directory):
+            continue
+        source_stem = posixpath.relpath(directory.replace(os.sep, '/'), variants_root.replace(os.sep, '/'))
+        if not Image.objects.filter(image__startswith=f'{source_stem}.').exists():
+            yield directory
+
+
+def collect_orphans(dry_run=False):
+    """
+    Journal orphaned image files and remove orphaned variant directories.
+    Returns (orphaned files, orphaned variant directories).
+    """
+    names = list(find_orphaned_files())
+    variant_dirs = list(find_orphaned_variant_dirs())
+    if not dry_run:
+        with transaction.atomic():
+            journal_file_deletions(names)
+        for directory in variant_dirs:
+            shutil.rmtree(directory, ignore_errors=True)
+    return names, variant_dirs
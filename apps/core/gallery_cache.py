@@ -0,0 +1,110 @@
+import hashlib
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+
+from .pagination import GalleryCursorPagination
+
+GALLERY_VERSION_KEY = 'gallery:version'
+
+
+def get_gallery_version():
+    """
+    Current gallery version, part of every page cache key.
+    Seeded from the clock so a flushed cache never reuses an old version.
+    """
+    version = cache.get(GALLERY_VERSION_KEY)
+    if version is None:
+        cache.add(GALLERY_VERSION_KEY, time.time_ns(), None)
+        version = cache.get(GALLERY_VERSION_KEY)
+    return version
+
+
+def _bump():
+    try:
+        cache.incr(GALLERY_VERSION_KEY)
+    except ValueError:
+        cache.set(GALLERY_VERSION_KEY, time.time_ns(), None)
+
+
+def bump_gallery_version():
+    """
+    Invalidate every cached gallery page once the current transaction commits
+    """
+    transaction.on_commit(_bump)
+
+
+def get_page_cache_key(request, version):
+    """
+    Cache key of a gallery page: the version, the origin the absolute URLs
+    of the page are built for, and the normalized cursor and page size.
+    Other query parameters can't add cache entries.
+    """
+    if not isinstance(request, Request):
+        request = Request(request)
+    query = GalleryCursorPagination().get_cache_key(request)
+    digest = hashlib.md5(f'{version}|{request.scheme}://{request.get_host()}|{query}'.encode()).hexdigest()
+    return f'gallery:page:{digest}'
+
+
+def get_content_etag(content):
+    """
+    ETag of a gallery page, from its body: with a per-process cache every
+    worker has its own version, so an ETag taken from the version could
+    answer 304 for a page another worker has since changed
+    """
+    return f'"{hashlib.md5(content).hexdigest()}"'
+
+
+def is_not_modified(request, etag):
+    if_none_match = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    return etag in if_none_match or '*' in if_none_match
+
+
+def build_gallery_response(request, content):
+    etag = get_content_etag(content)
+    if is_not_modified(request, etag):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(content, content_type='application/json')
+    response['ETag'] = etag
+    patch_cache_control(response, public=True, no_cache=True)
+    return response
+
+
+def cached_gallery_response(request, build_data):
+    """
+    Serve a gallery page from the cache as pre-rendered JSON.
+    `build_data` is only called on a miss; a matching If-None-Match gets a 304
+    without touching the database.
+    """
+    key = get_page_cache_key(request, get_gallery_version())
+    content = cache.get(key)
+    if content is None:
+        content = JSONRenderer().render(build_data())
+        cache.set(key, content, settings.GALLERY_CACHE_TIMEOUT)
+    return build_gallery_response(request, content)
+
+
+async def acached_gallery_response(request, build_data):
+    """
+    Async version of `cached_gallery_response`, `build_data` is a coroutine function
+    """
+    version = await cache.aget(GALLERY_VERSION_KEY)
+    if version is None:
+        version = await sync_to_async(get_gallery_version)()
+
+    key = get_page_cache_key(request, version)
+    content = await cache.aget(key)
+    if content is None:
+        content = JSONRenderer().render(await build_data())
+        await cache.aset(key, content, settings.GALLERY_CACHE_TIMEOUT)
+    return build_gallery_response(request, content)
@@ -0,0 +1,242 @@
+"""
+Batched ingestion of order forms through a local spool.
+
+Each accepted submission is appended as one JSON line to the process's
+active segment file in ORDER_FORM_SPOOL_DIR before the client gets its
+submission id. A flusher thread rotates the segment every
+ORDER_FORM_FLUSH_INTERVAL ms, or once it holds ORDER_FORM_FLUSH_ROWS rows,
+and loads the closed segment with one bulk_create.
+
+A segment is locked (flock) by whoever is writing or loading it, so any
+unlocked segment on disk belongs to a process that died: it is replayed
+when a process starts in spool mode (CoreConfig.ready) and by
+`replay_order_spool`. Rows carry their `ingest_id`, so a segment loaded
+twice (crash between INSERT and unlink) inserts nothing new. A segment
+whose rows can't be inserted is renamed to <name>.bad and left for an
+operator, instead of blocking the segments after it.
+"""
+import atexit
+import fcntl
+import json
+import logging
+import os
+import threading
+import uuid
+
+from django.conf import settings
+from django.db import DataError, IntegrityError, close_old_connections, connections, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import OrderForms, normalize_phone
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = '.ndjson'
+QUARANTINE_SUFFIX = '.bad'
+# Raised by rows that will never load, as opposed to the database being unavailable
+INVALID_SEGMENT_ERRORS = (ValueError, KeyError, TypeError, DataError, IntegrityError)
+
+
+def _open_locked(path, flags):
+    """
+    Open `path` and take its lock without waiting. Returns None when another
+    process holds it or the file is gone.
+    """
+    try:
+        fd = os.open(path, flags)
+    except FileNotFoundError:
+        return None
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    if os.fstat(fd).st_nlink == 0:
+        # Loaded and unlinked by someone else while we were opening it
+        os.close(fd)
+        return None
+    return fd
+
+
+def to_order_form(row):
+    return OrderForms(
+        ingest_id=row['ingest_id'],
+        name=row['name'],
+        phone=row['phone'],
+        phone_digits=normalize_phone(row['phone']),
+        contact_method=row['contact_method'],
+        created_at=parse_datetime(row['created_at']),
+    )
+
+
+def load_segment(path):
+    """
+    Insert the rows of a closed segment and delete it, or quarantine it if
+    its rows are invalid. Returns the number of rows inserted, or None when
+    the segment is in use.
+    """
+    fd = _open_locked(path, os.O_RDONLY)
+    if fd is None:
+        return None
+    try:
+        with os.fdopen(os.dup(fd), 'rb') as segment:
+            lines = [line for line in segment if line.endswith(b'\n')]
+        try:
+            with transaction.atomic():
+                OrderForms.objects.bulk_create(
+                    [to_order_form(json.loads(line)) for line in lines],
+                    batch_size=settings.ORDER_FORM_FLUSH_ROWS,
+                    ignore_conflicts=True,
+                )
+        except INVALID_SEGMENT_ERRORS as e:
+            quarantined = path[:-len(SEGMENT_SUFFIX)] + QUARANTINE_SUFFIX
+            os.rename(path, quarantined)
+            logger.error(f"Invalid order form segment moved to {quarantined}: {str(e)}")
+            return 0
+        os.unlink(path)
+        return len(lines)
+    finally:
+        os.close(fd)
+
+
+def replay_spool():
+    """
+    Load every segment left behind by a process that is gone.
+    Returns (segments, rows) loaded; a segment that fails is logged and skipped.
+    """
+    if not os.path.isdir(settings.ORDER_FORM_SPOOL_DIR):
+        return 0, 0
+
+    segments = rows = 0
+    for filename in sorted(os.listdir(settings.ORDER_FORM_SPOOL_DIR)):
+        if not filename.endswith(SEGMENT_SUFFIX):
+            continue
+        try:
+            loaded = load_segment(os.path.join(settings.ORDER_FORM_SPOOL_DIR, filename))
+        except Exception as e:
+            logger.error(f"Error replaying order form segment {filename}: {str(e)}")
+            continue
+        if loaded is not None:
+            segments += 1
+            rows += loaded
+    return segments, rows
+
+
+def _replay_in_background():
+    try:
+        replay_spool()
+    finally:
+        connections.close_all()
+
+
+def start_replay():
+    """
+    Replay the spool on a background thread, so a process starting in
+    spool mode neither waits for it nor needs a first submission to trigger it
+    """
+    threading.Thread(target=_replay_in_background, name='order-spool-replay', daemon=True).start()
+
+
+class OrderFormIngester:
+    """
+    Per-process spool writer and flusher, started on first use
+    """
+
+    def __init__(self):
+        self.reset()
+        # A forked worker starts its own segment and flusher; the parent's
+        # segment must not stay locked through the inherited descriptor
+        os.register_at_fork(after_in_child=self.reset)
+
+    def reset(self):
+        if getattr(self, 'fd', None) is not None:
+            os.close(self.fd)
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.fd = None
+        self.path = None
+        self.rows = 0
+        self.closed = []
+
+    def start(self):
+        os.makedirs(settings.ORDER_FORM_SPOOL_DIR, exist_ok=True)
+        self.open_segment()
+        threading.Thread(target=self.run, name='order-form-flusher', daemon=True).start()
+        atexit.register(self.flush)
+
+    def open_segment(self):
+        """
+        Create the next segment under a temporary name and lock it before it
+        becomes visible, so replay can never take a segment still being written
+        """
+        name = os.path.join(settings.ORDER_FORM_SPOOL_DIR, f'{os.getpid()}-{uuid.uuid4().hex}')
+        fd = os.open(f'{name}.tmp', os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_EXCL, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        os.rename(f'{name}.tmp', f'{name}{SEGMENT_SUFFIX}')
+        self.fd, self.path, self.rows = fd, f'{name}{SEGMENT_SUFFIX}', 0
+
+    def submit(self, validated_data):
+        """
+        Spool a validated order form and return its submission id
+        """
+        row = {
+            'ingest_id': str(uuid.uuid4()),
+            'name': validated_data['name'],
+            'phone': validated_data['phone'],
+            'contact_method': validated_data.get('contact_method', OrderForms.WHATSAPP),
+            'created_at': timezone.now().isoformat(),
+        }
+        line = (json.dumps(row, ensure_ascii=False) + '\n').encode()
+
+        with self.lock:
+            if self.fd is None:
+                self.start()
+            os.write(self.fd, line)
+            if settings.ORDER_FORM_SPOOL_FSYNC:
+                os.fsync(self.fd)
+            self.rows += 1
+            if self.rows >= settings.ORDER_FORM_FLUSH_ROWS:
+                self.wakeup.set()
+        return row['ingest_id']
+
+    def rotate(self):
+        with self.lock:
+            if not self.rows:
+                return
+            fd, path = self.fd, self.path
+            self.open_segment()
+        # Closing releases the lock: the segment is now ready to load
+        os.close(fd)
+        self.closed.append(path)
+
+    def flush(self):
+        """
+        Load the active segment and any earlier ones that failed to load
+        """
+        with self.flush_lock:
+            self.rotate()
+            while self.closed:
+                try:
+                    load_segment(self.closed[0])
+                except Exception as e:
+                    logger.error(f"Error flushing order forms from {self.closed[0]}: {str(e)}")
+                    return False
+                self.closed.pop(0)
+            return True
+
+    def run(self):
+        interval = settings.ORDER_FORM_FLUSH_INTERVAL / 1000
+        delay = interval
+        while True:
+            self.wakeup.wait(delay)
+            self.wakeup.clear()
+            try:
+                # Back off while the database is unavailable
+                delay = interval if self.flush() else min(delay * 2, 30)
+            finally:
+                close_old_connections()
+
+
+order_ingester = OrderFormIngester()
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from ...uploads import delete_expired_sessions
+
+
+class Command(BaseCommand):
+    help = ('Delete resumable upload sessions older than UPLOAD_SESSION_TTL or idle for '
+            'UPLOAD_SESSION_IDLE_TTL, and their partial files')
+
+    def handle(self, *args, **options):
+        count = delete_expired_sessions()
+        self.stdout.write(self.style.SUCCESS(f'Deleted {count} expired upload sessions'))
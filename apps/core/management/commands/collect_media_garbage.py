@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from ...files import collect_orphans, process_deletion_journal
+
+
+class Command(BaseCommand):
+    help = 'Delete journaled media files and, with --orphans, files no image references'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--orphans',
+            action='store_true',
+            help='Also scan MEDIA_ROOT/images/ and the variants for files without an image',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report orphaned files, delete nothing',
+        )
+
+    def handle(self, *args, **options):
+        if options['orphans']:
+            names, variant_dirs = collect_orphans(dry_run=options['dry_run'])
+            for name in names:
+                self.stdout.write(f'Orphaned file: {name}')
+            for directory in variant_dirs:
+                self.stdout.write(f'Orphaned variants: {directory}')
+            self.stdout.write(f'Found {len(names)} orphaned files and {len(variant_dirs)} orphaned variant directories')
+
+        if options['dry_run']:
+            return
+
+        deleted, failed = process_deletion_journal()
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} files, {failed} failed and will be retried'))
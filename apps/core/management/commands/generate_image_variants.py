@@ -0,0 +1,40 @@
+from concurrent.futures import as_completed
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from ...derivatives import get_executor, render_variants, store_variants
+from ...models import Image
+
+
+class Command(BaseCommand):
+    help = 'Render thumbnail/medium/full variants and perceptual hashes for images that are missing them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Re-render variants for every image')
+
+    def handle(self, *args, **options):
+        queryset = Image.objects.exclude(image='')
+        if not options['all']:
+            queryset = queryset.filter(Q(variants={}) | Q(phash__isnull=True))
+
+        # Images with identical content share one file and one set of variants
+        names = {name: image_id for image_id, name in queryset.values_list('id', 'image').iterator()}
+
+        executor = get_executor()
+        futures = {
+            executor.submit(render_variants, name, settings.MEDIA_ROOT): (image_id, name)
+            for name, image_id in names.items()
+        }
+
+        done = 0
+        for future in as_completed(futures):
+            image_id, name = futures[future]
+            try:
+                store_variants(name, future.result())
+                done += 1
+            except Exception as e:
+                self.stderr.write(f"Error generating variants for image ID:{image_id}: {str(e)}")
+
+        self.stdout.write(self.style.SUCCESS(f'Rendered variants for {done} of {len(futures)} images'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from ...ingest import replay_spool
+
+
+class Command(BaseCommand):
+    help = 'Insert order forms left in ORDER_FORM_SPOOL_DIR by processes that stopped before flushing'
+
+    def handle(self, *args, **options):
+        segments, rows = replay_spool()
+        self.stdout.write(self.style.SUCCESS(f'Replayed {rows} order forms from {segments} spool segments'))
@@ -0,0 +1,136 @@
+import ipaddress
+import random
+from datetime import timedelta
+from io import BytesIO
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from PIL import Image as PILImage
+
+from ...gallery_cache import bump_gallery_version
+from ...models import Image, OrderForms, normalize_phone
+from ...storage import content_addressed_storage, get_content_hash
+
+# Uploader addresses of seeded images (RFC 6598 shared address space, never a real client)
+BENCHMARK_NETWORK = ipaddress.ip_network('100.64.0.0/10')
+# Seeded rows, and those created by benchmarks/load.py, are recognised by these prefixes
+BENCHMARK_FILENAME_PREFIXES = ('benchmark-', 'load-')
+BENCHMARK_ORDER_NAME = 'Benchmark'
+
+# (width, height, format, extension) of the generated files, from phone shots to screenshots
+FILE_SHAPES = [
+    (4032, 3024, 'JPEG', 'jpg'),
+    (1920, 1440, 'JPEG', 'jpg'),
+    (1280, 960, 'JPEG', 'jpg'),
+    (1080, 1920, 'WEBP', 'webp'),
+    (800, 800, 'PNG', 'png'),
+]
+
+
+def render_file(rng, width, height, image_format):
+    """
+    Photo-like image: smooth colour fields from an upscaled random thumbnail,
+    so files compress to realistic sizes instead of pure noise
+    """
+    thumbnail = PILImage.frombytes('RGB', (16, 12), rng.randbytes(16 * 12 * 3))
+    image = thumbnail.resize((width, height), PILImage.BICUBIC)
+    noise = PILImage.frombytes('L', (width, height), rng.randbytes(width * height)).convert('RGB')
+    image = PILImage.blend(image, noise, 0.1)
+    output = BytesIO()
+    image.save(output, image_format, quality=85)
+    return output.getvalue()
+
+
+class Command(BaseCommand):
+    help = 'Seed synthetic images, image files and order forms for benchmarks/load.py'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--images', type=int, default=10000, help='Image rows to create')
+        parser.add_argument('--files', type=int, default=50,
+                            help='Distinct image files written to storage and shared by the rows')
+        parser.add_argument('--orders', type=int, default=50000, help='Order forms to create')
+        parser.add_argument('--approved', type=float, default=0.8, help='Share of approved images')
+        parser.add_argument('--batch-size', type=int, default=2000)
+        parser.add_argument('--seed', type=int, default=1, help='Seed making the dataset reproducible')
+        parser.add_argument('--admin-username', default='benchmark')
+        parser.add_argument('--admin-password', required=True, help='Password of the staff user to create')
+        parser.add_argument('--clear', action='store_true', help='Delete previously seeded rows first')
+        parser.add_argument('--force', action='store_true', help='Run even though DEBUG is off')
+
+    def handle(self, *args, **options):
+        if not settings.DEBUG and not options['force']:
+            raise CommandError('Refusing to seed benchmark data and a staff user with DEBUG off, pass --force')
+
+        rng = random.Random(options['seed'])
+        batch_size = options['batch_size']
+
+        if options['clear']:
+            deleted = 0
+            for prefix in BENCHMARK_FILENAME_PREFIXES:
+                deleted += Image.objects.filter(original_filename__startswith=prefix).delete()[0]
+            deleted_orders, _ = OrderForms.objects.filter(name__startswith=BENCHMARK_ORDER_NAME).delete()
+            self.stdout.write(f'Deleted {deleted} images and {deleted_orders} order forms')
+
+        files = []
+        for index in range(options['files']):
+            width, height, image_format, extension = FILE_SHAPES[index % len(FILE_SHAPES)]
+            name = content_addressed_storage.save(
+                f'images/benchmark-{index}.{extension}',
+                ContentFile(render_file(rng, width, height, image_format)),
+            )
+            files.append((name, f'benchmark-{index}.{extension}', width, height))
+        if files:
+            self.stdout.write(f'Stored {len(files)} image files')
+
+        first_address = int(BENCHMARK_NETWORK.network_address) + Image.objects.filter(
+            original_filename__startswith='benchmark-').count()
+        now = timezone.now()
+        images = []
+        for index in range(options['images'] if files else 0):
+            name, filename, width, height = files[index % len(files)]
+            approved = rng.random() < options['approved']
+            images.append(Image(
+                image=name,
+                content_hash=get_content_hash(name),
+                original_filename=filename,
+                ip_address=str(ipaddress.ip_address(first_address + index)),
+                upload_date=now - timedelta(seconds=rng.randrange(365 * 24 * 60 * 60)),
+                approved=approved,
+                rejected=not approved and rng.random() < 0.5,
+                width=width,
+                height=height,
+            ))
+            if len(images) == batch_size:
+                Image.objects.bulk_create(images)
+                images = []
+        Image.objects.bulk_create(images)
+        self.stdout.write(f'Created {options["images"] if files else 0} images')
+
+        orders = []
+        contact_methods = [choice for choice, _ in OrderForms.CONTACT_METHOD_CHOICES]
+        for index in range(options['orders']):
+            phone = f'+998 {rng.randrange(10, 100)} {rng.randrange(10 ** 6, 10 ** 7)} {rng.randrange(100, 1000)}'
+            orders.append(OrderForms(
+                name=f'{BENCHMARK_ORDER_NAME} {index}',
+                phone=phone,
+                # bulk_create doesn't call save()
+                phone_digits=normalize_phone(phone),
+                contact_method=rng.choice(contact_methods),
+                created_at=now - timedelta(seconds=rng.randrange(365 * 24 * 60 * 60)),
+            ))
+            if len(orders) == batch_size:
+                OrderForms.objects.bulk_create(orders)
+                orders = []
+        OrderForms.objects.bulk_create(orders)
+        self.stdout.write(f'Created {options["orders"]} order forms')
+
+        User = get_user_model()
+        if not User.objects.filter(username=options['admin_username']).exists():
+            User.objects.create_superuser(username=options['admin_username'], password=options['admin_password'])
+            self.stdout.write(f'Created staff user {options["admin_username"]}')
+
+        bump_gallery_version()
+        self.stdout.write(self.style.SUCCESS('Benchmark data ready'))
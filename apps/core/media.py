@@ -0,0 +1,206 @@
+"""
+Serving of uploaded media.
+
+Only files of approved images are public; staff get signed URLs for the
+rest (see `get_media_url`). With MEDIA_ACCEL set, the bytes are sent by
+the front proxy (nginx X-Accel-Redirect or X-Sendfile) and Python only
+runs the access check. Otherwise FileResponse serves them, with single
+byte-range and conditional request support.
+"""
+import mimetypes
+import os
+import posixpath
+import re
+import stat
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+from django.views.decorators.http import require_safe
+
+from .gallery_cache import get_gallery_version
+from .models import Image
+from .storage import get_content_hash
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+READ_SIZE = 64 * 1024
+
+_signer = signing.TimestampSigner(salt='core.media')
+
+
+def get_source_filter(name):
+    """
+    Lookup of the images a media file belongs to: the original itself or,
+    for variants/<image name without ext>/..., the image it was rendered from
+    """
+    if name.startswith('variants/'):
+        stem = posixpath.dirname(name)[len('variants/'):]
+        content_hash = get_content_hash(stem)
+        return {'content_hash': content_hash} if content_hash else {'image__startswith': f'{stem}.'}
+    if name.startswith('images/'):
+        content_hash = get_content_hash(name)
+        return {'content_hash': content_hash} if content_hash else {'image': name}
+    return None
+
+
+def is_public(name):
+    """
+    Whether `name` belongs to an approved image, cached until the gallery changes
+    """
+    source_filter = get_source_filter(name)
+    if source_filter is None:
+        return False
+
+    cache_key = f'media:public:{get_gallery_version()}:{name}'
+    public = cache.get(cache_key)
+    if public is None:
+        public = Image.objects.filter(approved=True, **source_filter).exists()
+        cache.set(cache_key, public, settings.GALLERY_CACHE_TIMEOUT)
+    return public
+
+
+def sign_media_name(name):
+    return _signer.sign(name)[len(name) + 1:]
+
+
+def has_valid_signature(name, signature):
+    try:
+        _signer.unsign(f'{name}:{signature}', max_age=settings.MEDIA_SIGNED_URL_MAX_AGE)
+    except signing.BadSignature:
+        return False
+    return True
+
+
+def get_media_url(name, request=None, signed=False):
+    """
+    URL of a stored file; `signed` ones also work before the image is approved
+    """
+    url = f'{settings.MEDIA_URL}{quote(name)}'
+    if signed:
+        url = f'{url}?signature={sign_media_name(name)}'
+    return request.build_absolute_uri(url) if request else url
+
+
+def is_hashed(name):
+    """
+    Content-addressed files, and their variants, never change under the same name
+    """
+    return bool(get_content_hash(posixpath.dirname(name) if name.startswith('variants/') else name))
+
+
+def parse_range(header, size):
+    """
+    (start, end) of a single `bytes=` range, None to send the whole file,
+    or False when the range can't be satisfied
+    """
+    match = RANGE_RE.match(header or '')
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    else:
+        start, end = max(size - int(last), 0), size - 1
+    if start > end or start >= size:
+        return False
+    return start, end
+
+
+def iter_range(path, start, length):
+    with open(path, 'rb') as file:
+        file.seek(start)
+        while length > 0:
+            data = file.read(min(READ_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+
+
+def build_file_response(request, path, size, etag):
+    """
+    FileResponse for the whole file, or a 206 for a `Range` request
+    """
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    byte_range = None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range or if_range == etag:
+        byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    if byte_range is None:
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(iter_range(path, start, end - start + 1),
+                                         status=206, content_type=content_type)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = str(end - start + 1)
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def build_accel_response(name, path):
+    response = HttpResponse(content_type=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+    if settings.MEDIA_ACCEL == 'nginx':
+        response['X-Accel-Redirect'] = f'{settings.MEDIA_ACCEL_PREFIX}{quote(name)}'
+    else:
+        response['X-Sendfile'] = path
+    return response
+
+
+@require_safe
+def serve_media(request, path):
+    """
+    Serve a file from MEDIA_ROOT if it belongs to an approved image,
+    or to staff and signed URLs
+    """
+    name = posixpath.normpath(path).lstrip('/')
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, name)
+    except SuspiciousFileOperation:
+        raise Http404
+
+    private = False
+    if not is_public(name):
+        signature = request.GET.get('signature')
+        user = getattr(request, 'user', None)
+        if not (signature and has_valid_signature(name, signature)) and not (user and user.is_staff):
+            raise Http404
+        private = True
+
+    try:
+        file_stat = os.stat(full_path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise Http404
+    if not stat.S_ISREG(file_stat.st_mode):
+        raise Http404
+
+    etag = quote_etag(f'{int(file_stat.st_mtime)}-{file_stat.st_size}')
+    response = get_conditional_response(request, etag=etag, last_modified=int(file_stat.st_mtime))
+    if response is None:
+        if settings.MEDIA_ACCEL:
+            response = build_accel_response(name, full_path)
+        else:
+            response = build_file_response(request, full_path, file_stat.st_size, etag)
+
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(file_stat.st_mtime)
+    if private:
+        patch_cache_control(response, private=True, max_age=settings.MEDIA_SIGNED_URL_MAX_AGE)
+    elif is_hashed(name):
+        patch_cache_control(response, public=True, max_age=settings.MEDIA_CACHE_MAX_AGE, immutable=True)
+    else:
+        patch_cache_control(response, public=True, max_age=settings.GALLERY_CACHE_TIMEOUT)
+    return response
@@ -0,0 +1,323 @@
+"""
+In-process metrics, served in the Prometheus text format by `metrics_view`.
+
+Each process keeps its counters and histograms in memory, so recording
+costs a dict update under a lock and no I/O. A background thread writes
+them to METRICS_DIR/<pid>-<start time>.json every METRICS_FLUSH_INTERVAL
+seconds and the endpoint sums the files of all workers; files of exited
+workers are folded into archive.json so counters never go backwards. The
+start time keeps a new process that reuses a pid, e.g. after a container
+restart, from being taken for the old one. METRICS_DIR must be local to
+the host, a tmpfs by default; without it only the process answering the
+scrape is reported.
+"""
+import atexit
+import bisect
+import fcntl
+import glob
+import hmac
+import json
+import os
+import threading
+import time
+from functools import lru_cache
+
+from django.conf import settings
+from django.http import Http404, HttpResponse
+from django.views.decorators.http import require_safe
+
+from .client_ip import TrustedNetworks, parse_address
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128)
+# 16KB to 8MB
+SIZE_BUCKETS = tuple(2 ** n * 1024 for n in range(4, 14))
+# Any other method is counted as OTHER, so clients can't add label values
+METHODS = frozenset({'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS', 'TRACE', 'CONNECT'})
+# Set by a reverse proxy: the peer is the proxy, not the client
+PROXY_HEADERS = ('HTTP_X_FORWARDED_FOR', 'HTTP_FORWARDED', 'HTTP_X_REAL_IP')
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'http_requests_total': (
+        'counter', 'Responses by route, method and status code.', None),
+    'http_request_duration_seconds': (
+        'histogram', 'Time to build the response, middleware included, by route and method.', LATENCY_BUCKETS),
+    'db_queries_per_request': (
+        'histogram', 'Database queries made by a request, by route.', QUERY_COUNT_BUCKETS),
+    'db_query_duration_seconds_total': (
+        'counter', 'Time spent in database queries, by route.', None),
+    'upload_bytes_total': (
+        'counter', 'Request body bytes received by the upload endpoints, by route.', None),
+    'upload_size_bytes': (
+        'histogram', 'Request body size of the upload endpoints, by route.', SIZE_BUCKETS),
+    'rejected_requests_total': (
+        'counter', 'Requests refused by admission checks, throttling or validation, by route and reason.', None),
+}
+
+ARCHIVE_FILE = 'archive.json'
+
+
+class Registry:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        # {(name, labels): value}
+        self.counters = {}
+        # {(name, labels): [per bucket counts, sum, count]}
+        self.histograms = {}
+
+    def inc(self, name, labels, value=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][2]
+        index = bisect.bisect_left(buckets, value)
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(buckets) + 1), 0, 0]
+            histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': [[name, labels, value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, labels, list(counts), total, count]
+                               for (name, labels), (counts, total, count) in self.histograms.items()],
+            }
+
+
+registry = Registry()
+
+
+def get_start_time(pid):
+    """
+    Start time of the process in clock ticks since boot, 0 without /proc
+    """
+    try:
+        with open(f'/proc/{pid}/stat') as stat_file:
+            # Fields after the parenthesised command name start at the 3rd, starttime is the 22nd
+            return int(stat_file.read().rsplit(')', 1)[1].split()[19])
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+class _Exporter:
+    """
+    The process's thread writing `registry` to METRICS_DIR. Started on the
+    first record and restarted in forked workers, which also start counting
+    from zero.
+    """
+
+    def __init__(self):
+        self.reset()
+        os.register_at_fork(after_in_child=self.reset)
+        atexit.register(self.write)
+
+    def reset(self):
+        registry.reset()
+        self.thread = None
+        self.start_lock = threading.Lock()
+        pid = os.getpid()
+        self.filename = f'{pid}-{get_start_time(pid)}.json'
+
+    def ensure_started(self):
+        if self.thread is None and settings.METRICS_DIR:
+            with self.start_lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, name='metrics-exporter', daemon=True)
+                    self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(settings.METRICS_FLUSH_INTERVAL)
+            self.write()
+
+    def write(self):
+        if not settings.METRICS_DIR or self.thread is None:
+            return
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)
+        path = os.path.join(settings.METRICS_DIR, self.filename)
+        with open(f'{path}.tmp', 'w') as snapshot_file:
+            json.dump(registry.snapshot(), snapshot_file)
+        os.replace(f'{path}.tmp', path)
+
+
+_exporter = _Exporter()
+
+
+def inc(name, labels, value=1):
+    _exporter.ensure_started()
+    registry.inc(name, labels, value)
+
+
+def observe(name, labels, value):
+    _exporter.ensure_started()
+    registry.observe(name, labels, value)
+
+
+def get_route(request):
+    resolver_match = getattr(request, 'resolver_match', None)
+    return resolver_match.view_name if resolver_match else 'unmatched'
+
+
+def get_method(request):
+    return request.method if request.method in METHODS else 'OTHER'
+
+
+def record_rejection(request, reason):
+    inc('rejected_requests_total', (('route', get_route(request)), ('reason', reason)))
+
+
+def merge(totals, snapshot):
+    counters, histograms = totals
+    for name, labels, value in snapshot['counters']:
+        key = (name, tuple(map(tuple, labels)))
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, counts, total, count in snapshot['histograms']:
+        key = (name, tuple(map(tuple, labels)))
+        if key in histograms:
+            merged = histograms[key]
+            histograms[key] = [[a + b for a, b in zip(merged[0], counts)], merged[1] + total, merged[2] + count]
+        else:
+            histograms[key] = [list(counts), total, count]
+    return totals
+
+
+def to_snapshot(totals):
+    counters, histograms = totals
+    return {
+        'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+        'histograms': [[name, labels, *histogram] for (name, labels), histogram in histograms.items()],
+    }
+
+
+def load_snapshot(path):
+    try:
+        with open(path) as snapshot_file:
+            return json.load(snapshot_file)
+    except (FileNotFoundError, ValueError):
+        return {'counters': [], 'histograms': []}
+
+
+def is_running(pid, start_time):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return get_start_time(pid) == start_time
+
+
+def collect():
+    """
+    Totals of every worker on the host, as ({key: value}, {key: histogram})
+    """
+    totals = ({}, {})
+    if not settings.METRICS_DIR:
+        return merge(totals, registry.snapshot())
+
+    _exporter.write()
+    os.makedirs(settings.METRICS_DIR, exist_ok=True)
+    archive_path = os.path.join(settings.METRICS_DIR, ARCHIVE_FILE)
+    with open(os.path.join(settings.METRICS_DIR, '.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        archive = merge(({}, {}), load_snapshot(archive_path))
+        exited = []
+        for path in glob.glob(os.path.join(settings.METRICS_DIR, '*.json')):
+            pid, _, start_time = os.path.basename(path)[:-len('.json')].partition('-')
+            if not pid.isdigit() or not start_time.isdigit():
+                continue
+            snapshot = load_snapshot(path)
+            if is_running(int(pid), int(start_time)):
+                merge(totals, snapshot)
+            else:
+                merge(archive, snapshot)
+                exited.append(path)
+
+        if exited:
+            with open(f'{archive_path}.tmp', 'w') as archive_file:
+                json.dump(to_snapshot(archive), archive_file)
+            os.replace(f'{archive_path}.tmp', archive_path)
+            for path in exited:
+                os.unlink(path)
+
+    return merge(totals, to_snapshot(archive))
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for key, value in labels
+    )
+    return f'{{{pairs}}}'
+
+
+def format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render(totals):
+    """
+    Prometheus text exposition format 0.0.4
+    """
+    counters, histograms = totals
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        if kind == 'counter':
+            for (_, labels), value in sorted(item for item in counters.items() if item[0][0] == name):
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+            continue
+        for (_, labels), (counts, total, count) in sorted(item for item in histograms.items() if item[0][0] == name):
+            cumulative = 0
+            for bound, bucket_count in zip((*map(format_value, buckets), '+Inf'), counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{format_labels((*labels, ("le", bound)))} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {format_value(total)}')
+            lines.append(f'{name}_count{format_labels(labels)} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+@lru_cache(maxsize=1)
+def get_allowed_networks():
+    return TrustedNetworks(settings.METRICS_ALLOWED_CIDRS)
+
+
+def is_scraper(request):
+    """
+    The peer itself must be in METRICS_ALLOWED_CIDRS, X-Forwarded-For is not
+    considered; scrapers behind a proxy send METRICS_TOKEN as a bearer token.
+    A proxied request needs the token even from an allowed peer, which is
+    then the proxy rather than the client.
+    """
+    if settings.METRICS_TOKEN:
+        authorization = request.META.get('HTTP_AUTHORIZATION', '')
+        if hmac.compare_digest(authorization.encode(), f'Bearer {settings.METRICS_TOKEN}'.encode()):
+            return True
+    if any(header in request.META for header in PROXY_HEADERS):
+        return False
+    address = parse_address(request.META.get('REMOTE_ADDR', ''))
+    return address is not None and address in get_allowed_networks()
+
+
+@require_safe
+def metrics_view(request):
+    """
+    Metrics of all workers for a Prometheus scraper, see `is_scraper`
+    """
+    if not settings.METRICS_ENABLED or not is_scraper(request):
+        raise Http404
+    return HttpResponse(render(collect()), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,242 @@
+import logging
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.http import JsonResponse
+from django.utils.module_loading import import_string
+
+from . import metrics
+from .client_ip import resolve_client_ip
+from .throttling import ConcurrencyLimit, get_retry_after, parse_rate
+
+logger = logging.getLogger(__name__)
+
+THROTTLED_METHODS = {'POST', 'PUT', 'PATCH', 'DELETE'}
+
+# Views receiving image bytes, counted against UPLOAD_CONCURRENCY_LIMIT
+UPLOAD_URL_NAMES = {'image-list-create', 'upload-session-detail', 'upload-session-finalize'}
+
+
+def too_many_requests(detail, retry_after):
+    response = JsonResponse({'detail': detail}, status=429)
+    response['Retry-After'] = str(retry_after)
+    return response
+
+
+class SyncAndAsyncMiddleware:
+    """
+    Base of the middleware below, which runs natively under WSGI and ASGI:
+    `__call__` handles sync requests and `__acall__` async ones, so an
+    async stack never hops to a thread for them
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+
+class ClientIPMiddleware(SyncAndAsyncMiddleware):
+    """
+    Resolve the client IP once per request as `request.client_ip`,
+    shared by admission checks, throttling and logging
+    """
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        request.client_ip = resolve_client_ip(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        request.client_ip = resolve_client_ip(request)
+        return await self.get_response(request)
+
+
+class RateLimitMiddleware(SyncAndAsyncMiddleware):
+    """
+    Per-IP token buckets (THROTTLE_RULES, by URL name) for writes to the public
+    endpoints, plus a cap on uploads in flight. Runs in process_view, after
+    URL resolution but before anything reads the request body; under ASGI
+    Django runs process_view in a thread, as the stores may do network I/O.
+    Must come after ClientIPMiddleware.
+    """
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.rules = {name: parse_rate(rate) for name, rate in settings.THROTTLE_RULES.items() if rate}
+        self.store = import_string(settings.THROTTLE_STORE)()
+        self.uploads = ConcurrencyLimit('uploads', settings.UPLOAD_CONCURRENCY_LIMIT, settings.UPLOAD_SLOT_TIMEOUT)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        request._upload_slot = None
+        try:
+            return self.get_response(request)
+        finally:
+            if request._upload_slot is not None:
+                self.uploads.release(request._upload_slot)
+
+    async def __acall__(self, request):
+        request._upload_slot = None
+        try:
+            return await self.get_response(request)
+        finally:
+            if request._upload_slot is not None:
+                await sync_to_async(self.uploads.release, thread_sensitive=False)(request._upload_slot)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.method not in THROTTLED_METHODS:
+            return None
+
+        url_name = request.resolver_match.url_name
+        rule = self.rules.get(url_name)
+        if rule:
+            delay = self.store.consume(f'{url_name}:{request.client_ip}', *rule)
+            if delay:
+                logger.warning(f"Throttled {request.method} {url_name} from {request.client_ip}")
+                metrics.record_rejection(request, 'throttled')
+                retry_after = get_retry_after(delay)
+                return too_many_requests(
+                    f'Request was throttled. Expected available in {retry_after} seconds.', retry_after
+                )
+
+        if url_name in UPLOAD_URL_NAMES:
+            slot = self.uploads.acquire()
+            if slot is None:
+                metrics.record_rejection(request, 'upload_concurrency')
+                return too_many_requests('Too many uploads in progress, try again shortly.', 1)
+            request._upload_slot = slot
+        return None
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryCounter:
+    """
+    execute_wrapper counting queries and their time
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - start
+
+
+def get_query_budget(view_func, method):
+    """
+    `query_budget` of a view: a number of queries, or {method: number}
+    """
+    view = getattr(view_func, 'view_class', None) or getattr(view_func, 'cls', None) or view_func
+    budget = getattr(view, 'query_budget', None)
+    if isinstance(budget, dict):
+        return budget.get(method)
+    return budget
+
+
+class QueryBudgetMiddleware(SyncAndAsyncMiddleware):
+    """
+    Count the queries and DB time of each request and compare them with the
+    view's `query_budget`. Over budget is logged, or raised with
+    QUERY_BUDGET_MODE = 'raise' (the default under `manage.py test`) so
+    N+1 regressions fail the tests. Queries made while a streaming response
+    is consumed are not counted.
+    """
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if settings.QUERY_BUDGET_MODE == 'off':
+            return self.get_response(request)
+
+        request.query_budget = None
+        counter = QueryCounter()
+        with connection.execute_wrapper(counter):
+            response = self.get_response(request)
+        self.check(request, counter)
+        return response
+
+    async def __acall__(self, request):
+        if settings.QUERY_BUDGET_MODE == 'off':
+            return await self.get_response(request)
+
+        request.query_budget = None
+        counter = QueryCounter()
+        # The async ORM runs queries on this same connection, in a thread
+        with connection.execute_wrapper(counter):
+            response = await self.get_response(request)
+        self.check(request, counter)
+        return response
+
+    def check(self, request, counter):
+        if request.query_budget is not None and counter.count > request.query_budget:
+            message = (f"{request.method} {request.path} made {counter.count} queries "
+                       f"({counter.duration * 1000:.1f} ms), budget is {request.query_budget}")
+            if settings.QUERY_BUDGET_MODE == 'raise':
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.query_budget = get_query_budget(view_func, request.method)
+        return None
+
+
+class MetricsMiddleware(SyncAndAsyncMiddleware):
+    """
+    Latency, status code and DB queries of each request by route, plus the
+    body size of uploads, for apps.core.metrics. Goes first in MIDDLEWARE
+    so the latency includes the other middleware.
+    """
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        counter = QueryCounter()
+        start = time.perf_counter()
+        with connection.execute_wrapper(counter):
+            response = self.get_response(request)
+        self.record(request, response, time.perf_counter() - start, counter)
+        return response
+
+    async def __acall__(self, request):
+        counter = QueryCounter()
+        start = time.perf_counter()
+        with connection.execute_wrapper(counter):
+            response = await self.get_response(request)
+        self.record(request, response, time.perf_counter() - start, counter)
+        return response
+
+    def record(self, request, response, duration, counter):
+        route, method = metrics.get_route(request), metrics.get_method(request)
+        metrics.inc('http_requests_total', (('route', route), ('method', method), ('status', response.status_code)))
+        metrics.observe('http_request_duration_seconds', (('route', route), ('method', method)), duration)
+        metrics.observe('db_queries_per_request', (('route', route),), counter.count)
+        if counter.duration:
+            metrics.inc('db_query_duration_seconds_total', (('route', route),), counter.duration)
+
+        if request.resolver_match and request.resolver_match.url_name in UPLOAD_URL_NAMES:
+            size = request.META.get('CONTENT_LENGTH', '')
+            if size.isdigit() and int(size):
+                metrics.inc('upload_bytes_total', (('route', route),), int(size))
+                metrics.observe('upload_size_bytes', (('route', route),), int(size))
@@ -1,21 +1,140 @@
-from django.db import models
+import os
+import re
+import uuid
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Q
 from django.utils import timezone
 
+from .storage import content_addressed_storage, get_content_hash
+
+PHASH_FIELDS = ['phash', 'phash_0', 'phash_1', 'phash_2', 'phash_3']
+
+NON_DIGITS_RE = re.compile(r'\D')
+
+
+def normalize_phone(phone):
+    """
+    Digits of a phone number, e.g. '+7 (999) 123-45-67' -> '79991234567'
+    """
+    return NON_DIGITS_RE.sub('', phone or '')
+
 
 class Image(models.Model):
-    image = models.ImageField(upload_to='images/%Y/%m/%d')
-    ip_address = models.GenericIPAddressField()
+    image = models.ImageField(upload_to='images', storage=content_addressed_storage)
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True)
+    original_filename = models.CharField(max_length=255, blank=True)
+    ip_address = models.GenericIPAddressField(unique=True)
     upload_date = models.DateTimeField(default=timezone.now)
     approved = models.BooleanField(default=False)
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    rejected = models.BooleanField(default=False)
+    variants = models.JSONField(default=dict, blank=True)
+    # Perceptual hash, and its 16-bit bands indexed for near-duplicate lookups (see phash.py)
+    phash = models.BigIntegerField(null=True, blank=True)
+    phash_0 = models.PositiveIntegerField(null=True, blank=True, db_index=True)
+    phash_1 = models.PositiveIntegerField(null=True, blank=True, db_index=True)
+    phash_2 = models.PositiveIntegerField(null=True, blank=True, db_index=True)
+    phash_3 = models.PositiveIntegerField(null=True, blank=True, db_index=True)
+    # Moderation queue lease (see administration/moderation.py); expired claims are free again
+    claimed_by = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL,
+                                   related_name='claimed_images', db_index=False)
+    claim_expires_at = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         ordering = ['-upload_date']
         db_table = 'image'
+        indexes = [
+            models.Index(
+                fields=['-upload_date', '-id'],
+                condition=Q(approved=True),
+                name='image_approved_gallery_idx',
+            ),
+            models.Index(
+                fields=['upload_date', 'id'],
+                condition=Q(approved=False, rejected=False),
+                name='image_pending_queue_idx',
+            ),
+            models.Index(
+                fields=['claimed_by', 'claim_expires_at'],
+                condition=Q(claimed_by__isnull=False),
+                name='image_claimed_idx',
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        """
+        Store the file first so its content hash is known, then let a new
+        image inherit the rejection, variants and perceptual hash of an
+        identical one. Approval is never inherited, a moderator gives it.
+        """
+        content = None
+        if self.image and not self.image._committed:
+            self.original_filename = self.original_filename or os.path.basename(self.image.name)[:255]
+            content = self.image.file
+            self.image.save(self.image.name, content, save=False)
+        if self.image and not self.content_hash:
+            self.content_hash = get_content_hash(self.image.name)
+
+        if self._state.adding and self.content_hash:
+            twin = (Image.objects.filter(content_hash=self.content_hash)
+                    .order_by('-rejected').values('rejected', 'variants', *PHASH_FIELDS).first())
+            if twin:
+                self.rejected = not self.approved and (self.rejected or twin['rejected'])
+                self.variants = self.variants or twin['variants']
+                for field in PHASH_FIELDS:
+                    setattr(self, field, twin[field])
+
+        super().save(*args, **kwargs)
+
+        if content is not None:
+            # The deletion journal may have removed the stored file, reused
+            # from an identical one, before this row was visible to it
+            name = self.image.name
+            transaction.on_commit(lambda: self.image.storage.restore(name, content))
+
+
+class UploadSession(models.Model):
+    """
+    A resumable image upload whose chunks are being appended to a file
+    in UPLOAD_SESSIONS_DIR, at most one per IP address
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    ip_address = models.GenericIPAddressField(unique=True)
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100)
+    size = models.PositiveBigIntegerField()
+    offset = models.PositiveBigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Last chunk received, for the idle expiry
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'upload_session'
+
+
+class MediaDeletion(models.Model):
+    """
+    A stored file to remove once the transaction that released it has
+    committed, see files.process_deletion_journal
+    """
+    name = models.CharField(max_length=255, db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        db_table = 'media_deletion'
 
 
 class OrderForms(models.Model):
     name = models.CharField(max_length=100)
     phone = models.CharField(max_length=100)
+    # Kept in sync by save(); db_index also gives a pattern_ops index for prefix search on Postgres
+    phone_digits = models.CharField(max_length=100, blank=True, editable=False, db_index=True)
     TELEGRAM = 'telegram'
     WHATSAPP = 'whatsapp'
     BOTH = 'both'
@@ -33,11 +152,19 @@ class OrderForms(models.Model):
         verbose_name='Preferred contact method'
     )
 
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    # Submission id handed to the client; makes replaying the ingestion spool idempotent
+    ingest_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
 
     def __str__(self):
         return f"Order form {self.id} - {self.name}"
 
+    def save(self, *args, **kwargs):
+        self.phone_digits = normalize_phone(self.phone)
+        if kwargs.get('update_fields') and 'phone' in kwargs['update_fields']:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'phone_digits'}
+        super().save(*args, **kwargs)
+
     class Meta:
         ordering = ['-created_at']
         db_table = 'order_forms'
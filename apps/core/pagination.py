@@ -1,7 +1,19 @@
+import hashlib
+import json
 import math
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 
-from rest_framework.pagination import PageNumberPagination
+from django.conf import settings
+from django.core.cache import cache
+from django.core.paginator import EmptyPage, Page, PageNotAnInteger, Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination, _positive_int
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
 
 class CustomPagination(PageNumberPagination):
@@ -20,3 +32,285 @@ class CustomPagination(PageNumberPagination):
             'current_page': self.page.number,
             'results': data
         })
+
+
+class CountlessPage(Page):
+    def __init__(self, object_list, number, paginator, has_next):
+        super().__init__(object_list, number, paginator)
+        self._has_next = has_next
+
+    def has_next(self):
+        return self._has_next
+
+
+class CountlessPaginator(Paginator):
+    """
+    Paginator that never counts the queryset.
+    It fetches one row past the page to find out whether a next page exists.
+    """
+    count_is_estimate = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.last_known_page = 1
+
+    @property
+    def count(self):
+        return None
+
+    @property
+    def num_pages(self):
+        return self.last_known_page
+
+    def validate_number(self, number):
+        try:
+            if isinstance(number, float) and not number.is_integer():
+                raise ValueError
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger(self.error_messages['invalid_page'])
+        if number < 1:
+            raise EmptyPage(self.error_messages['min_page'])
+        return number
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        rows = list(self.object_list[bottom:bottom + self.per_page + 1])
+        if not rows and number > 1:
+            raise EmptyPage(self.error_messages['no_results'])
+
+        has_next = len(rows) > self.per_page
+        self.last_known_page = number + 1 if has_next else number
+        return CountlessPage(rows[:self.per_page], number, self, has_next)
+
+
+class CachedCountPaginator(CountlessPaginator):
+    """
+    Reports a count cached per query for PAGINATION_COUNT_CACHE_TIMEOUT seconds
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list.order_by()
+        sql, params = queryset.query.sql_with_params()
+        key = hashlib.md5(repr((sql, params)).encode()).hexdigest()
+        return cache.get_or_set(
+            f'pagination:count:{key}',
+            queryset.count,
+            settings.PAGINATION_COUNT_CACHE_TIMEOUT
+        )
+
+
+class EstimatedCountPaginator(CountlessPaginator):
+    """
+    Reports the Postgres planner row estimate for large querysets.
+    Estimates below PAGINATION_ESTIMATE_THRESHOLD are cheap to verify, so
+    those (and every count on other databases) are exact.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list.order_by()
+        estimate = self.get_estimate(queryset)
+        if estimate is None or estimate < settings.PAGINATION_ESTIMATE_THRESHOLD:
+            return queryset.count()
+
+        self.count_is_estimate = True
+        return estimate
+
+    def get_estimate(self, queryset):
+        if connections[queryset.db].vendor != 'postgresql':
+            return None
+        plan = json.loads(queryset.explain(format='json'))
+        return int(plan[0]['Plan']['Plan Rows'])
+
+
+class AdaptiveCountPagination(CustomPagination):
+    """
+    CustomPagination with a selectable way of producing `count`:
+
+    - exact: COUNT(*) on every request (CustomPagination behaviour)
+    - cached: COUNT(*) cached per query
+    - estimated: planner estimate above a threshold
+    - none: no count at all, only `has_next`
+
+    Views pick a default with `pagination_count_mode`, clients can override
+    it per request with `?count_mode=`.
+    """
+    count_mode_query_param = 'count_mode'
+    default_count_mode = 'exact'
+    count_mode_paginators = {
+        'exact': Paginator,
+        'cached': CachedCountPaginator,
+        'estimated': EstimatedCountPaginator,
+        'none': CountlessPaginator,
+    }
+
+    def get_count_mode(self, request, view=None):
+        count_mode = request.query_params.get(self.count_mode_query_param)
+        if count_mode in self.count_mode_paginators:
+            return count_mode
+        return getattr(view, 'pagination_count_mode', self.default_count_mode)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count_mode = self.get_count_mode(request, view)
+        self.django_paginator_class = self.count_mode_paginators[self.count_mode]
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        paginator = self.page.paginator
+        count = paginator.count
+        total_pages = math.ceil(count / paginator.per_page) if count is not None else None
+
+        return Response({
+            'count': count,
+            'count_is_estimate': getattr(paginator, 'count_is_estimate', False),
+            'total_pages': total_pages,
+            'has_next': self.page.has_next(),
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'current_page': self.page.number,
+            'results': data
+        })
+
+
+class GalleryCursorPagination(BasePagination):
+    """
+    Keyset pagination over (upload_date, id), newest first.
+
+    The cursor holds the position of the last row of the previous page, so
+    every page is an index range scan starting at the cursor's upload_date
+    (see `image_approved_gallery_idx`) no matter how deep the client is, and
+    no COUNT(*) is ever issued.
+    """
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+    ordering = ('-upload_date', '-id')
+
+    def is_requested(self, request):
+        """
+        Gallery mode is opt-in so clients expecting a plain list keep working
+        """
+        return (self.cursor_query_param in request.query_params
+                or self.page_size_query_param in request.query_params)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = self.get_base_url(request)
+        self.page_size = self.get_page_size(request)
+
+        position = self.decode_cursor(request)
+        rows = list(self.get_page_queryset(queryset, position, self.page_size))
+        return self.set_page(rows)
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """
+        Async version of `paginate_queryset` using the async ORM
+        """
+        self.request = request
+        self.base_url = self.get_base_url(request)
+        self.page_size = self.get_page_size(request)
+
+        position = self.decode_cursor(request)
+        rows = [row async for row in self.get_page_queryset(queryset, position, self.page_size)]
+        return self.set_page(rows)
+
+    def get_base_url(self, request):
+        """
+        Gallery URL keeping only the page size, so the links of a cached
+        page don't carry another client's query parameters
+        """
+        url = request.build_absolute_uri(request.path)
+        if self.page_size_query_param in request.query_params:
+            url = replace_query_param(url, self.page_size_query_param, self.get_page_size(request))
+        return url
+
+    def get_cache_key(self, request):
+        """
+        What a gallery response depends on besides the host: the cursor and
+        page size in gallery mode, nothing for the plain list
+        """
+        if not self.is_requested(request):
+            return 'all'
+        return f'{request.query_params.get(self.cursor_query_param, "")}|{self.get_page_size(request)}'
+
+    def get_page_queryset(self, queryset, position, page_size):
+        """
+        Lazy queryset for one page, with one extra row to detect a next page
+        """
+        queryset = queryset.order_by(*self.ordering)
+        if position is not None:
+            upload_date, pk = position
+            # The redundant upload_date <= bound is what the planner turns into
+            # the start of the index range; the OR alone is a filter on a full scan
+            queryset = queryset.filter(
+                Q(upload_date__lt=upload_date) | Q(upload_date=upload_date, id__lt=pk),
+                upload_date__lte=upload_date,
+            )
+        return queryset[:page_size + 1]
+
+    def set_page(self, rows):
+        self.has_next = len(rows) > self.page_size
+        self.page = rows[:self.page_size]
+        return self.page
+
+    def get_page_size(self, request):
+        try:
+            return _positive_int(
+                request.query_params[self.page_size_query_param],
+                strict=True,
+                cutoff=self.max_page_size
+            )
+        except (KeyError, ValueError):
+            return self.page_size
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+
+        try:
+            raw = urlsafe_b64decode(encoded.encode('ascii')).decode('ascii')
+            upload_date, pk = raw.rsplit('|', 1)
+            upload_date = parse_datetime(upload_date)
+            pk = int(pk)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+        if upload_date is None:
+            raise NotFound(self.invalid_cursor_message)
+        return upload_date, pk
+
+    def encode_cursor(self, instance):
+        raw = f"{instance.upload_date.isoformat()}|{instance.pk}"
+        return urlsafe_b64encode(raw.encode('ascii')).decode('ascii')
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return replace_query_param(self.base_url, self.cursor_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_first_link(self):
+        return replace_query_param(self.base_url, self.cursor_query_param, '')
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'first': self.get_first_link(),
+            'results': data
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'first': {'type': 'string', 'format': 'uri'},
+                'results': schema,
+            },
+        }
@@ -0,0 +1,80 @@
+from itertools import combinations
+
+from django.db.models import Q
+
+from .models import Image
+
+HASH_BITS = 64
+BANDS = 4
+BAND_BITS = HASH_BITS // BANDS
+BAND_MASK = (1 << BAND_BITS) - 1
+
+
+def to_signed(value):
+    """
+    Fit an unsigned 64-bit hash into a BigIntegerField
+    """
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+
+def to_unsigned(value):
+    return value + (1 << HASH_BITS) if value < 0 else value
+
+
+def split_bands(value):
+    return [(value >> (BAND_BITS * band)) & BAND_MASK for band in range(BANDS)]
+
+
+def get_hash_fields(value):
+    """
+    Model field values for the hash and its indexed bands
+    """
+    fields = {'phash': to_signed(value)}
+    for band, band_value in enumerate(split_bands(value)):
+        fields[f'phash_{band}'] = band_value
+    return fields
+
+
+def hamming_distance(a, b):
+    return (to_unsigned(a) ^ to_unsigned(b)).bit_count()
+
+
+def band_neighbours(band_value, radius):
+    """
+    Every band value within `radius` flipped bits of `band_value`
+    """
+    values = [band_value]
+    for flips in range(1, radius + 1):
+        for bits in combinations(range(BAND_BITS), flips):
+            flipped = band_value
+            for bit in bits:
+                flipped ^= 1 << bit
+            values.append(flipped)
+    return values
+
+
+def find_similar(image, max_distance, queryset=None):
+    """
+    Images within `max_distance` bits of `image`'s hash as [(id, distance)], closest first.
+
+    Multi-index hashing: the hash is split into 4 indexed 16-bit bands. Two
+    hashes within `max_distance` bits must have some band within
+    max_distance // 4 bits of each other, so only rows matching one of those
+    band values are fetched and compared in full.
+    """
+    if image.phash is None:
+        return []
+
+    queryset = Image.objects.all() if queryset is None else queryset
+    radius = max_distance // BANDS
+
+    condition = Q()
+    for band, band_value in enumerate(split_bands(to_unsigned(image.phash))):
+        condition |= Q(**{f'phash_{band}__in': band_neighbours(band_value, radius)})
+
+    similar = []
+    for image_id, phash in queryset.filter(condition).exclude(pk=image.pk).values_list('id', 'phash'):
+        distance = hamming_distance(image.phash, phash)
+        if distance <= max_distance:
+            similar.append((image_id, distance))
+    return sorted(similar, key=lambda item: item[1])
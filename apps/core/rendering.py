@@ -0,0 +1,85 @@
+"""
+Variant rendering for the worker pool of derivatives.py. The workers are
+started with forkserver or spawn and import this module fresh, so it must
+only depend on Pillow: no Django settings, models or database.
+"""
+import os
+import posixpath
+
+from PIL import Image as PILImage, ImageOps
+
+# Longest side in pixels, largest first: each variant is resized from the previous one
+VARIANT_SIZES = {
+    'full': 1920,
+    'medium': 960,
+    'thumbnail': 320,
+}
+
+VARIANT_FORMATS = {
+    'webp': ('WEBP', 'webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+
+def get_variant_dir(image_name):
+    """
+    Variants of images/a/b.png live in variants/images/a/b/
+    """
+    return posixpath.join('variants', posixpath.splitext(image_name)[0])
+
+
+def _flatten(image):
+    """
+    Drop alpha onto a white background for formats without transparency
+    """
+    if image.mode in ('RGB', 'L'):
+        return image
+    image = image.convert('RGBA')
+    background = PILImage.new('RGB', image.size, (255, 255, 255))
+    background.paste(image, mask=image.getchannel('A'))
+    return background
+
+
+def dhash(image):
+    """
+    64-bit difference hash: one bit per horizontally adjacent pixel pair
+    of a 9x8 grayscale thumbnail
+    """
+    pixels = list(image.convert('L').resize((9, 8), PILImage.LANCZOS).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+
+def render_variants(image_name, media_root):
+    """
+    Write every variant of `image_name` to disk and return their storage names
+    along with the perceptual hash of the image, taken from the smallest variant.
+    Runs inside the worker pool, so it must not touch the database.
+    """
+    target_dir = get_variant_dir(image_name)
+    os.makedirs(os.path.join(media_root, target_dir), exist_ok=True)
+
+    variants = {}
+    with PILImage.open(os.path.join(media_root, image_name)) as original:
+        current = ImageOps.exif_transpose(original)
+        if current.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            current = current.convert('RGBA')
+
+        for variant, max_side in VARIANT_SIZES.items():
+            current = current.copy()
+            current.thumbnail((max_side, max_side), PILImage.LANCZOS)
+
+            for key, (pil_format, extension, options) in VARIANT_FORMATS.items():
+                name = posixpath.join(target_dir, f'{variant}.{extension}')
+                path = os.path.join(media_root, name)
+                output = _flatten(current) if pil_format == 'JPEG' else current
+                output.save(f'{path}.tmp', pil_format, **options)
+                os.replace(f'{path}.tmp', path)
+                variants.setdefault(variant, {})[key] = name
+
+        phash = dhash(_flatten(current))
+
+    return variants, phash
@@ -0,0 +1,103 @@
+"""
+Index-backed search for the admin API.
+
+On Postgres, `create_search_indexes` (run after migrate) adds pg_trgm GIN
+indexes on UPPER(column), which is what Django's `icontains` compiles to,
+so substring search stops scanning the whole table. Other databases run
+the same lookups without the extra indexes.
+"""
+import logging
+import operator
+from functools import reduce
+
+from django.core.exceptions import ValidationError
+from django.db import connections
+from django.db.models import Q
+from rest_framework import filters
+
+from .models import normalize_phone
+
+logger = logging.getLogger(__name__)
+
+# (index name, table, column) for case-insensitive substring search
+TRIGRAM_INDEXES = [
+    ('order_forms_name_trgm_idx', 'order_forms', 'name'),
+    ('order_forms_phone_trgm_idx', 'order_forms', 'phone'),
+    ('image_original_filename_trgm_idx', 'image', 'original_filename'),
+]
+
+
+def create_search_indexes(using='default', **kwargs):
+    """
+    Create the pg_trgm extension and trigram indexes, without locking writes
+    """
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for name, table, column in TRIGRAM_INDEXES:
+            concurrently = '' if connection.in_atomic_block else 'CONCURRENTLY'
+            cursor.execute(
+                f'CREATE INDEX {concurrently} IF NOT EXISTS {name} '
+                f'ON {table} USING gin (UPPER({column}) gin_trgm_ops)'
+            )
+    logger.info(f"Search indexes ensured on {using}")
+
+
+class IndexedSearchFilter(filters.SearchFilter):
+    """
+    SearchFilter whose lookups match the indexes that exist.
+    Prefixes in `search_fields`:
+      none  case-insensitive substring (trigram index)
+      '^'   case-sensitive prefix (btree / pattern_ops index)
+      '='   exact match; terms the field can't hold are skipped
+      '#'   prefix of the digits in the term, e.g. for `phone_digits`
+    """
+    lookup_prefixes = {
+        '^': 'startswith',
+        '=': 'exact',
+        '#': 'startswith',
+    }
+
+    def get_field_lookups(self, queryset, search_fields):
+        lookups = []
+        for search_field in search_fields:
+            prefix = search_field[0] if search_field[0] in self.lookup_prefixes else ''
+            field_name = search_field[len(prefix):]
+            lookups.append((prefix, field_name, queryset.model._meta.get_field(field_name)))
+        return lookups
+
+    def get_term_condition(self, prefix, field_name, field, term):
+        if prefix == '#':
+            term = normalize_phone(term)
+            if not term:
+                return None
+        elif prefix == '=':
+            try:
+                term = field.clean(term, None)
+            except ValidationError:
+                return None
+
+        lookup = self.lookup_prefixes.get(prefix, 'icontains')
+        return Q(**{f'{field_name}__{lookup}': term})
+
+    def filter_queryset(self, request, queryset, view):
+        search_fields = self.get_search_fields(view, request)
+        search_terms = self.get_search_terms(request)
+        if not search_fields or not search_terms:
+            return queryset
+
+        lookups = self.get_field_lookups(queryset, search_fields)
+        for term in search_terms:
+            conditions = [
+                condition for condition in (
+                    self.get_term_condition(prefix, field_name, field, term)
+                    for prefix, field_name, field in lookups
+                ) if condition is not None
+            ]
+            if not conditions:
+                return queryset.none()
+            queryset = queryset.filter(reduce(operator.or_, conditions))
+        return queryset
@@ -1,15 +1,36 @@
+import os
+
+from django.conf import settings
+from django.core.validators import get_available_image_extensions
+from django.db import IntegrityError, transaction
 from rest_framework import serializers
 
-from .models import Image, OrderForms
+from .derivatives import get_variant_urls
+from .files import journal_file_deletions
+from .models import Image, OrderForms, UploadSession
+
+
+class InspectedImageField(serializers.ImageField):
+    """
+    ImageField that reuses the header inspection done by `inspect_image`
+    instead of opening and verifying the upload with Pillow a second time
+    """
+
+    def to_internal_value(self, data):
+        if getattr(data, 'image_info', None) is not None:
+            return serializers.FileField.to_internal_value(self, data)
+        return super().to_internal_value(data)
 
 
 class ImageSerializer(serializers.ModelSerializer):
+    image = InspectedImageField()
     image_url = serializers.SerializerMethodField()
+    variants = serializers.SerializerMethodField()
 
     class Meta:
         model = Image
-        fields = ['id', 'upload_date', 'approved', 'image_url', 'image']
-        read_only_fields = ['ip_address', 'upload_date', 'approved']
+        fields = ['id', 'upload_date', 'approved', 'image_url', 'image', 'width', 'height', 'variants']
+        read_only_fields = ['ip_address', 'upload_date', 'approved', 'width', 'height']
 
     def get_image_url(self, obj):
         request = self.context.get('request')
@@ -17,6 +38,55 @@ class ImageSerializer(serializers.ModelSerializer):
             return request.build_absolute_uri(obj.image.url)
         return None
 
+    def get_variants(self, obj):
+        return get_variant_urls(obj, self.context.get('request'))
+
+    def create(self, validated_data):
+        """
+        Journal the stored file for deletion when the insert fails, e.g. on the unique ip_address
+        """
+        instance = Image(**validated_data)
+        try:
+            with transaction.atomic():
+                instance.save()
+        except IntegrityError:
+            with transaction.atomic():
+                journal_file_deletions([instance.image.name])
+            raise
+        return instance
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    chunk_size = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UploadSession
+        fields = ['id', 'filename', 'content_type', 'size', 'offset', 'chunk_size', 'created_at']
+        read_only_fields = ['id', 'offset', 'created_at']
+
+    def get_chunk_size(self, obj):
+        return settings.UPLOAD_CHUNK_SIZE
+
+    def validate_filename(self, value):
+        extension = os.path.splitext(value)[1][1:].lower()
+        if extension not in get_available_image_extensions():
+            raise serializers.ValidationError(f"File extension '{extension}' is not allowed.")
+        return value
+
+    def validate_content_type(self, value):
+        if not value.startswith('image/'):
+            raise serializers.ValidationError("File must be an image.")
+        return value
+
+    def validate_size(self, value):
+        if not value:
+            raise serializers.ValidationError("File is empty.")
+        if value > settings.IMAGE_MAX_UPLOAD_SIZE:
+            raise serializers.ValidationError(
+                f"Image file size must be under {settings.IMAGE_MAX_UPLOAD_SIZE // (1024 * 1024)}MB."
+            )
+        return value
+
 
 class OrderFormsSerializer(serializers.ModelSerializer):
     class Meta:
@@ -0,0 +1,134 @@
+import errno
+import hashlib
+import os
+import posixpath
+import re
+import uuid
+
+from django.core.files.storage import FileSystemStorage
+
+HASHED_NAME_RE = re.compile(r'^(?:.*/)?[0-9a-f]{2}/[0-9a-f]{2}/(?P<digest>[0-9a-f]{64})(?:\.\w+)?$')
+
+EXTENSION_ALIASES = {
+    '.jpeg': '.jpg',
+}
+
+
+class _HashingContent:
+    """
+    Wraps an uploaded file so its bytes are hashed while they are written
+    """
+
+    def __init__(self, content):
+        self.content = content
+        self.hash = hashlib.sha256()
+
+    def chunks(self, chunk_size=None):
+        for chunk in self.content.chunks():
+            self.hash.update(chunk)
+            yield chunk
+
+
+def get_content_hash(name):
+    """
+    SHA-256 of a file saved by ContentAddressedStorage, taken from its name
+    """
+    match = HASHED_NAME_RE.match(name or '')
+    return match.group('digest') if match else ''
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Stores every distinct file once, under <upload_to>/ab/cd/<sha256><ext>.
+    Saving bytes that are already stored returns the existing name, so
+    files are only deleted through `delete_unreferenced`, and a saver
+    calls `restore` once its reference is committed.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        # The final name only depends on the content, see _save
+        return name
+
+    def get_hashed_name(self, directory, digest, extension):
+        return posixpath.join(directory, digest[:2], digest[2:4], f'{digest}{extension}')
+
+    def _save(self, name, content):
+        directory, filename = posixpath.split(name)
+        extension = os.path.splitext(filename)[1].lower()
+        extension = EXTENSION_ALIASES.get(extension, extension)
+
+        if hasattr(content, 'temporary_file_path'):
+            # Already on disk: hash it and link it into place, unless it is on another filesystem
+            digest = hashlib.sha256()
+            with open(content.temporary_file_path(), 'rb') as source:
+                for chunk in iter(lambda: source.read(64 * 1024), b''):
+                    digest.update(chunk)
+            hashed_name = self.get_hashed_name(directory, digest.hexdigest(), extension)
+            try:
+                self._link(content.temporary_file_path(), hashed_name)
+                return hashed_name
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+
+        temp_name, digest = self._save_part(directory, content)
+        hashed_name = self.get_hashed_name(directory, digest, extension)
+        try:
+            self._link(self.path(temp_name), hashed_name)
+        finally:
+            os.remove(self.path(temp_name))
+        return hashed_name
+
+    def _link(self, path, name):
+        """
+        Hard-link the file at `path` to `name`, keeping the file already stored under it
+        """
+        target = self.path(name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if self.file_permissions_mode is not None:
+            os.chmod(path, self.file_permissions_mode)
+        try:
+            os.link(path, target)
+        except FileExistsError:
+            # Same name, same bytes
+            pass
+
+    def _save_part(self, directory, content):
+        """
+        Write `content` to a temporary name in `directory`; returns the name and the SHA-256
+        """
+        hashing_content = _HashingContent(content)
+        temp_name = super()._save(posixpath.join(directory, f'.{uuid.uuid4().hex}.part'), hashing_content)
+        return temp_name, hashing_content.hash.hexdigest()
+
+    def restore(self, name, content):
+        """
+        Write `content` back under `name` if the file has been deleted
+        since it was saved, see `delete_unreferenced`
+        """
+        if self.exists(name):
+            return
+        temp_name, _ = self._save_part(posixpath.dirname(name), content)
+        os.replace(self.path(temp_name), self.path(name))
+
+    def delete_unreferenced(self, name, is_referenced):
+        """
+        Delete the file unless `is_referenced()`; returns whether it is gone.
+        The file is moved aside before the check, so a save reusing it is
+        either seen by the check, which puts the file back, or finds it
+        missing once its reference is committed and restores it.
+        """
+        path = self.path(name)
+        aside = f'{path}.{uuid.uuid4().hex}.deleting'
+        try:
+            os.rename(path, aside)
+        except FileNotFoundError:
+            return not is_referenced()
+        if is_referenced():
+            os.replace(aside, path)
+            return False
+        os.remove(aside)
+        return True
+
+
+content_addressed_storage = ContentAddressedStorage()
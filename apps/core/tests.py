@@ -1,3 +1,1172 @@
-from django.test import TestCase
+import errno
+import json
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import zlib
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+from PIL import Image as PILImage
+from asgiref.sync import iscoroutinefunction
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.core.management import call_command
+from django.db import OperationalError, connection, transaction
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from config import logging_handlers
+from config.logging_handlers import LazyRotatingFileHandler, QueueListenerHandler
+from config.schema import CachedSchemaView
+
+from . import derivatives, metrics
+from .async_views import AsyncImageListCreateView, AsyncOrderFormListCreateView
+from .admission import KnownUploaders, has_uploaded, known_uploaders
+from .client_ip import TrustedNetworks, TrustedProxyResolver, parse_address
+from .files import claim_journal_entries, collect_orphans, journal_file_deletions, process_deletion_journal
+from .gallery_cache import bump_gallery_version, get_gallery_version, get_page_cache_key
+from .ingest import OrderFormIngester, replay_spool
+from .media import get_media_url, parse_range
+from .middleware import ClientIPMiddleware, QueryBudgetExceeded
+from .models import Image, MediaDeletion, OrderForms, UploadSession
+from .phash import band_neighbours, find_similar, get_hash_fields, hamming_distance, to_signed
+from .rendering import dhash, render_variants
+from .serializers import InspectedImageField
+from .storage import ContentAddressedStorage, content_addressed_storage
+from .throttling import CacheBucketStore, ConcurrencyLimit, LocalBucketStore, parse_rate
+from .validators import inspect_image, sniff_image_format
+from .views import ImageListCreateView
+
+IMAGES_URL = '/api/v1/core/images/'
+ORDER_FORMS_URL = '/api/v1/core/order-forms/'
+UPLOADS_URL = '/api/v1/core/uploads/'
+
+
+def make_png(color='red', size=(40, 30), mode='RGB'):
+    buffer = BytesIO()
+    PILImage.new(mode, size, color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def make_upload(content, name='sticker.png'):
+    return SimpleUploadedFile(name, content, content_type='image/png')
+
+
+def make_png_header(width, height):
+    """
+    A PNG that only has a header, claiming `width` x `height` pixels
+    """
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + struct.pack('>I', len(header)) + b'IHDR' + header
+            + struct.pack('>I', zlib.crc32(b'IHDR' + header))
+            + struct.pack('>I', 0) + b'IEND' + struct.pack('>I', zlib.crc32(b'IEND')))
+
+
+class MediaTestCase(TestCase):
+    """
+    TestCase with MEDIA_ROOT and UPLOAD_SESSIONS_DIR in a temporary directory
+    and variants rendered inline
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        media_root = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        cls.enterClassContext(override_settings(
+            MEDIA_ROOT=media_root,
+            UPLOAD_SESSIONS_DIR=os.path.join(media_root, 'upload_sessions'),
+            IMAGE_VARIANT_WORKERS=0,
+            METRICS_DIR='',
+        ))
+        super().setUpClass()
+
+    def setUp(self):
+        cache.clear()
+
+
+class ClientIPTests(SimpleTestCase):
+    def setUp(self):
+        self.resolver = TrustedProxyResolver(['10.0.0.0/8', '127.0.0.1/32'])
+
+    def test_untrusted_peer_ignores_forwarded_for(self):
+        self.assertEqual(self.resolver.resolve('203.0.113.5', '198.51.100.1'), '203.0.113.5')
+
+    def test_forwarded_for_read_right_to_left(self):
+        # The left-most entry was written by the client and can't be believed
+        self.assertEqual(self.resolver.resolve('10.0.0.1', '1.1.1.1, 198.51.100.7, 10.0.0.2'), '198.51.100.7')
+
+    def test_garbage_stops_at_the_proxy(self):
+        self.assertEqual(self.resolver.resolve('127.0.0.1', '198.51.100.7, unknown'), '127.0.0.1')
+
+    def test_parse_address(self):
+        self.assertEqual(str(parse_address('203.0.113.5:8080')), '203.0.113.5')
+        self.assertEqual(str(parse_address('[::ffff:203.0.113.5]:80')), '203.0.113.5')
+        self.assertIsNone(parse_address('not-an-ip'))
+
+    def test_trusted_networks(self):
+        networks = TrustedNetworks(['10.0.0.0/8', '192.168.1.0/24', 'fc00::/7'])
+        self.assertIn(parse_address('10.200.0.1'), networks)
+        self.assertIn(parse_address('192.168.1.9'), networks)
+        self.assertNotIn(parse_address('192.168.2.9'), networks)
+        self.assertIn(parse_address('fd00::1'), networks)
+        self.assertNotIn(parse_address('2001:db8::1'), networks)
+
+    def test_only_loopback_trusted_by_default(self):
+        resolver = TrustedProxyResolver(settings.TRUSTED_PROXIES)
+        self.assertEqual(resolver.resolve('127.0.0.1', '198.51.100.7'), '198.51.100.7')
+        self.assertEqual(resolver.resolve('10.0.0.5', '198.51.100.7'), '10.0.0.5')
+
+    def test_upload_keyed_by_resolved_ip(self):
+        with mock.patch('apps.core.views.has_uploaded', return_value=True) as has_uploaded_mock:
+            self.client.post(IMAGES_URL, {'image': make_upload(make_png())},
+                             HTTP_X_FORWARDED_FOR='1.1.1.1, 198.51.100.7')
+        has_uploaded_mock.assert_called_once_with('198.51.100.7')
+
+class AsyncMiddlewareTests(SimpleTestCase):
+    async def test_runs_natively_under_asgi(self):
+        async def get_response(request):
+            return request.client_ip
+
+        middleware = ClientIPMiddleware(get_response)
+        self.assertTrue(iscoroutinefunction(middleware))
+        request = AsyncRequestFactory().get('/', headers={'X-Forwarded-For': '198.51.100.7'})
+        self.assertEqual(await middleware(request), '198.51.100.7')
+
+    def test_runs_under_wsgi(self):
+        middleware = ClientIPMiddleware(lambda request: request.client_ip)
+        self.assertFalse(iscoroutinefunction(middleware))
+        self.assertEqual(middleware(RequestFactory().get('/', REMOTE_ADDR='203.0.113.5')), '203.0.113.5')
+
+class ThrottlingTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_parse_rate(self):
+        self.assertEqual(parse_rate('10/min'), (10, 60))
+        self.assertEqual(parse_rate('300/hour'), (300, 3600))
+
+    def test_local_bucket_store(self):
+        store = LocalBucketStore()
+        self.assertEqual(store.consume('key', 2, 60), 0)
+        self.assertEqual(store.consume('key', 2, 60), 0)
+        self.assertAlmostEqual(store.consume('key', 2, 60), 30, delta=1)
+        self.assertEqual(store.consume('other', 2, 60), 0)
+
+    def test_local_bucket_store_is_bounded(self):
+        store = LocalBucketStore()
+        store.max_keys = 2
+        for key in ('a', 'b', 'c', 'd'):
+            store.consume(key, 10, 60)
+        self.assertEqual(len(store.arrivals), 2)
+        self.assertIn('d', store.arrivals)
+
+    def test_local_bucket_store_evicts_refilled_buckets(self):
+        store = LocalBucketStore()
+        store.max_keys = 2
+        with mock.patch('apps.core.throttling.time.monotonic', return_value=1000):
+            store.consume('a', 10, 60)
+            store.consume('b', 10, 60)
+        with mock.patch('apps.core.throttling.time.monotonic', return_value=2000):
+            store.consume('c', 10, 60)
+            store.consume('d', 10, 60)
+        self.assertEqual(set(store.arrivals), {'c', 'd'})
+
+    def test_cache_bucket_store(self):
+        store = CacheBucketStore()
+        self.assertEqual(store.consume('key', 2, 60), 0)
+        self.assertEqual(store.consume('key', 2, 60), 0)
+        self.assertGreater(store.consume('key', 2, 60), 0)
+        self.assertEqual(store.consume('other', 2, 60), 0)
+
+    def test_concurrency_limit(self):
+        limit = ConcurrencyLimit('test', 2, 60)
+        first, second = limit.acquire(), limit.acquire()
+        self.assertNotEqual(first, second)
+        self.assertIsNone(limit.acquire())
+        limit.release(first)
+        self.assertEqual(limit.acquire()[0], first[0])
+        self.assertIs(ConcurrencyLimit('unlimited', 0, 60).acquire(), True)
+
+    def test_concurrency_limit_keeps_slot_taken_over(self):
+        limit = ConcurrencyLimit('test', 1, 60)
+        slot, token = limit.acquire()
+        # The slot timed out and another request took it
+        cache.set(slot, 'other', 60)
+        limit.release((slot, token))
+        self.assertEqual(cache.get(slot), 'other')
+        self.assertIsNone(limit.acquire())
+
+    def test_concurrency_limit_shared_between_workers(self):
+        self.assertIsNotNone(ConcurrencyLimit('test', 1, 60).acquire())
+        self.assertIsNone(ConcurrencyLimit('test', 1, 60).acquire())
+
+
+class OrderFormTests(MediaTestCase):
+    data = {'name': 'Anna', 'phone': '+998 (90) 123-45-67-89', 'contact_method': 'telegram'}
+
+    @override_settings(QUERY_BUDGET_MODE='raise')
+    def test_create_within_query_budget(self):
+        with self.assertNumQueries(1):
+            response = self.client.post(ORDER_FORMS_URL, self.data, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(OrderForms.objects.get().phone_digits, '99890123456789')
+
+    @override_settings(THROTTLE_RULES={'orderform-list-create': '2/min'})
+    def test_throttled_per_ip(self):
+        for _ in range(2):
+            response = self.client.post(ORDER_FORMS_URL, self.data, content_type='application/json')
+            self.assertEqual(response.status_code, 201)
+
+        with self.assertLogs('apps.core.middleware', 'WARNING'):
+            response = self.client.post(ORDER_FORMS_URL, self.data, content_type='application/json')
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response['Retry-After']), 0)
+
+        response = self.client.post(ORDER_FORMS_URL, self.data, content_type='application/json',
+                                    REMOTE_ADDR='203.0.113.5')
+        self.assertEqual(response.status_code, 201)
+        # Reads are never throttled
+        self.assertEqual(self.client.get(IMAGES_URL).status_code, 200)
+
+    @override_settings(UPLOAD_CONCURRENCY_LIMIT=1)
+    def test_uploads_in_flight_are_capped(self):
+        with mock.patch.object(ConcurrencyLimit, 'acquire', return_value=None):
+            response = self.client.post(IMAGES_URL, {'image': make_upload(make_png())}, REMOTE_ADDR='203.0.113.5')
+        self.assertEqual(response.status_code, 429)
+        self.assertFalse(Image.objects.exists())
+        # The slot is given back after each upload
+        for ip_address in ('203.0.113.5', '203.0.113.6'):
+            response = self.client.post(IMAGES_URL, {'image': make_upload(make_png())}, REMOTE_ADDR=ip_address)
+            self.assertEqual(response.status_code, 201)
+
+
+class GalleryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        now = timezone.now()
+        for index in range(5):
+            Image.objects.create(image=f'images/{index}.png', ip_address=f'203.0.113.{index}', approved=True,
+                                 upload_date=now - timedelta(minutes=index))
+        Image.objects.create(image='images/pending.png', ip_address='203.0.113.100')
+
+    def get_gallery_ids(self, url):
+        ids = []
+        while url:
+            data = self.client.get(url).json()
+            ids += [image['id'] for image in data['results']]
+            url = data['next']
+        return ids
+
+    def test_lists_approved_only(self):
+        response = self.client.get(IMAGES_URL)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 5)
+
+    def test_cursor_pages(self):
+        expected = list(Image.objects.filter(approved=True).order_by('-upload_date', '-id')
+                        .values_list('id', flat=True))
+        self.assertEqual(self.get_gallery_ids(f'{IMAGES_URL}?page_size=2'), expected)
+
+    def test_cursor_pages_break_ties_by_id(self):
+        Image.objects.update(upload_date=timezone.now())
+        expected = list(Image.objects.filter(approved=True).order_by('-id').values_list('id', flat=True))
+        self.assertEqual(self.get_gallery_ids(f'{IMAGES_URL}?page_size=2'), expected)
+
+    def test_cursor_bounds_index_range(self):
+        url = self.client.get(f'{IMAGES_URL}?page_size=2').json()['next']
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        self.assertRegex(queries[0]['sql'], r'AND "image"."upload_date" <= ')
+
+    def test_first_page(self):
+        data = self.client.get(f'{IMAGES_URL}?cursor=').json()
+        self.assertEqual(len(data['results']), 5)
+        self.assertIsNone(data['next'])
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get(f'{IMAGES_URL}?cursor=garbage').status_code, 404)
+
+    def test_served_from_cache(self):
+        response = self.client.get(f'{IMAGES_URL}?page_size=2')
+        with self.assertNumQueries(0):
+            cached = self.client.get(f'{IMAGES_URL}?page_size=2')
+            not_modified = self.client.get(f'{IMAGES_URL}?page_size=2', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.content, response.content)
+        self.assertEqual(cached['ETag'], response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertNotEqual(self.client.get(f'{IMAGES_URL}?page_size=3')['ETag'], response['ETag'])
+
+    def test_cache_key_ignores_other_parameters(self):
+        response = self.client.get(IMAGES_URL, {'page_size': 2})
+        with self.assertNumQueries(0):
+            cached = self.client.get(IMAGES_URL, {'page_size': 2, 'utm_source': 'flood'})
+        self.assertEqual(cached['ETag'], response['ETag'])
+        self.assertNotIn('utm_source', cached.json()['next'])
+        # Page sizes over the maximum are clamped like the paginator does
+        self.assertEqual(self.client.get(IMAGES_URL, {'page_size': 1000})['ETag'],
+                         self.client.get(IMAGES_URL, {'page_size': 100})['ETag'])
+
+    def test_version_bump_invalidates(self):
+        response = self.client.get(IMAGES_URL)
+        Image.objects.create(image='images/new.png', ip_address='203.0.113.200', approved=True)
+        self.assertEqual(len(self.client.get(IMAGES_URL).json()), 5)
+        with self.captureOnCommitCallbacks(execute=True):
+            bump_gallery_version()
+        fresh = self.client.get(IMAGES_URL, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(fresh.status_code, 200)
+        self.assertEqual(len(fresh.json()), 6)
+
+    def test_etag_follows_content_without_bump(self):
+        # A change bumped in another process: this one only sees its page expire
+        response = self.client.get(IMAGES_URL)
+        Image.objects.create(image='images/new.png', ip_address='203.0.113.200', approved=True)
+        cache.delete(get_page_cache_key(RequestFactory().get(IMAGES_URL), get_gallery_version()))
+        fresh = self.client.get(IMAGES_URL, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(fresh.status_code, 200)
+        self.assertEqual(len(fresh.json()), 6)
+        self.assertEqual(self.client.get(IMAGES_URL, HTTP_IF_NONE_MATCH=fresh['ETag']).status_code, 304)
+
+    @override_settings(QUERY_BUDGET_MODE='raise')
+    def test_within_query_budget(self):
+        self.assertEqual(self.client.get(IMAGES_URL, {'page_size': 100}).status_code, 200)
+        self.assertEqual(self.client.get(IMAGES_URL).status_code, 200)
+
+    @override_settings(QUERY_BUDGET_MODE='raise')
+    def test_over_query_budget_raises(self):
+        with mock.patch.object(ImageListCreateView, 'query_budget', {'GET': 0}):
+            with self.assertRaises(QueryBudgetExceeded):
+                self.client.get(IMAGES_URL)
+
+
+class VariantTests(MediaTestCase):
+    def test_rendered_on_upload(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(IMAGES_URL, {'image': make_upload(make_png(size=(1000, 500)))},
+                                        REMOTE_ADDR='203.0.113.5')
+        self.assertEqual(response.status_code, 201)
+
+        variants = Image.objects.get().variants
+        self.assertEqual(set(variants), {'full', 'medium', 'thumbnail'})
+        for formats in variants.values():
+            self.assertEqual(set(formats), {'webp', 'jpeg'})
+            for name in formats.values():
+                self.assertTrue(os.path.exists(os.path.join(settings.MEDIA_ROOT, name)))
+        with PILImage.open(os.path.join(settings.MEDIA_ROOT, variants['thumbnail']['webp'])) as thumbnail:
+            self.assertEqual(thumbnail.size, (320, 160))
+        with PILImage.open(os.path.join(settings.MEDIA_ROOT, variants['full']['jpeg'])) as full:
+            # Never upscaled
+            self.assertEqual(full.size, (1000, 500))
+
+    def test_render_flattens_alpha_for_jpeg(self):
+        os.makedirs(os.path.join(settings.MEDIA_ROOT, 'images'), exist_ok=True)
+        with open(os.path.join(settings.MEDIA_ROOT, 'images', 'alpha.png'), 'wb') as image_file:
+            image_file.write(make_png((0, 0, 0, 0), mode='RGBA'))
+
+        variants, phash = render_variants('images/alpha.png', settings.MEDIA_ROOT)
+        self.assertEqual(phash, 0)
+        with PILImage.open(os.path.join(settings.MEDIA_ROOT, variants['thumbnail']['jpeg'])) as jpeg:
+            self.assertEqual(jpeg.mode, 'RGB')
+            self.assertEqual(jpeg.getpixel((0, 0)), (255, 255, 255))
+
+    @override_settings(IMAGE_VARIANT_WORKERS=1)
+    def test_pool_does_not_fork(self):
+        self.addCleanup(setattr, derivatives, '_executor', None)
+        with mock.patch.object(derivatives, 'ProcessPoolExecutor') as pool:
+            derivatives.get_executor()
+        self.assertIn(pool.call_args.kwargs['mp_context'].get_start_method(), ('forkserver', 'spawn'))
+
+
+class KnownUploadersTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_shared_between_workers(self):
+        KnownUploaders().add('203.0.113.1')
+        self.assertIn('203.0.113.1', known_uploaders)
+        KnownUploaders().discard_many(['203.0.113.1', '203.0.113.2'])
+        self.assertNotIn('203.0.113.1', known_uploaders)
+
+    @override_settings(UPLOAD_ADMISSION_CACHE_TIMEOUT=60)
+    def test_entries_expire(self):
+        with mock.patch('django.core.cache.backends.locmem.time.time', return_value=1000):
+            known_uploaders.add('203.0.113.1')
+        with mock.patch('django.core.cache.backends.locmem.time.time', return_value=1061):
+            self.assertNotIn('203.0.113.1', known_uploaders)
+
+
+class PerceptualHashTests(TestCase):
+    def create_image(self, value, index):
+        return Image.objects.create(image=f'images/{index}.png', ip_address=f'203.0.113.{index}',
+                                    **get_hash_fields(value))
+
+    def test_dhash(self):
+        # Brightness rising left to right: every pixel is darker than its right neighbour
+        gradient = PILImage.linear_gradient('L').rotate(90).resize((90, 80))
+        self.assertEqual(dhash(gradient), 0)
+        self.assertEqual(dhash(gradient.resize((180, 160))), 0)
+        self.assertEqual(dhash(gradient.transpose(PILImage.Transpose.FLIP_LEFT_RIGHT)), (1 << 64) - 1)
+
+    def test_hash_fits_bigint(self):
+        value = (1 << 64) - 1
+        fields = get_hash_fields(value)
+        self.assertEqual(fields['phash'], -1)
+        self.assertEqual([fields[f'phash_{band}'] for band in range(4)], [0xFFFF] * 4)
+        self.assertEqual(hamming_distance(to_signed(value), 0), 64)
+
+    def test_band_neighbours(self):
+        self.assertEqual(band_neighbours(0, 0), [0])
+        self.assertEqual(len(band_neighbours(0, 2)), 1 + 16 + 120)
+        self.assertIn(0b101, band_neighbours(0, 2))
+
+    def test_find_similar(self):
+        base = 0x0123_4567_89AB_CDEF
+        image = self.create_image(base, 1)
+        close = self.create_image(base ^ 0b11, 2)
+        # 6 bits apart but all in one band: still found through the other three
+        spread = self.create_image(base ^ 0b111111, 3)
+        far = self.create_image(base ^ ((1 << 64) - 1), 4)
+        unhashed = Image.objects.create(image='images/5.png', ip_address='203.0.113.5')
+
+        self.assertEqual(find_similar(image, 6), [(close.id, 2), (spread.id, 6)])
+        self.assertEqual(find_similar(image, 4), [(close.id, 2)])
+        self.assertEqual(find_similar(far, 6), [])
+        self.assertEqual(find_similar(unhashed, 6), [])
+
+class ImageValidationTests(SimpleTestCase):
+    def test_sniff_image_format(self):
+        buffer = BytesIO()
+        PILImage.new('RGB', (4, 4)).save(buffer, 'WEBP')
+        self.assertEqual(sniff_image_format(buffer.getvalue()[:32]), 'webp')
+        self.assertEqual(sniff_image_format(make_png()[:32]), 'png')
+        self.assertEqual(sniff_image_format(b'\xff\xd8\xff\xe0'), 'jpeg')
+        self.assertEqual(sniff_image_format(b'GIF89a'), 'gif')
+        self.assertIsNone(sniff_image_format(b'<?php echo 1; ?>'))
+
+    def test_accepts_image(self):
+        upload = make_upload(make_png(size=(40, 30)))
+        image_info, error_message = inspect_image(upload)
+        self.assertIsNone(error_message)
+        self.assertEqual(tuple(image_info), ('png', 40, 30))
+        self.assertIs(upload.image_info, image_info)
+
+    def test_rejects_wrong_magic_bytes(self):
+        image_info, error_message = inspect_image(make_upload(b'<?php echo 1; ?>' * 4))
+        self.assertIsNone(image_info)
+        self.assertIn('does not contain valid image data', error_message)
+
+    def test_rejects_disallowed_extension(self):
+        image_info, error_message = inspect_image(make_upload(make_png(), name='sticker.php'))
+        self.assertIsNone(image_info)
+        self.assertIn('Invalid image file', error_message)
+
+    def test_dimension_guard_reads_only_the_header(self):
+        image_info, error_message = inspect_image(make_upload(make_png_header(12_000, 1000)))
+        self.assertIsNone(image_info)
+        self.assertIn('dimensions', error_message)
+
+    def test_decompression_bomb_guard(self):
+        # Decoding 50000x50000 pixels would take gigabytes, the header alone gets rejected
+        image_info, error_message = inspect_image(make_upload(make_png_header(50_000, 50_000)))
+        self.assertIsNone(image_info)
+        self.assertIn('pixels', error_message)
+
+    @override_settings(IMAGE_MAX_PIXELS=1000)
+    def test_pixel_guard(self):
+        image_info, error_message = inspect_image(make_upload(make_png(size=(40, 30))))
+        self.assertIsNone(image_info)
+        self.assertIn('1000 pixels', error_message)
+
+    def test_inspected_field_reuses_inspection(self):
+        upload = make_upload(make_png())
+        inspect_image(upload)
+        with mock.patch.object(PILImage, 'open') as pil_open:
+            self.assertIs(InspectedImageField().to_internal_value(upload), upload)
+        pil_open.assert_not_called()
+
+    def test_uninspected_field_verifies_with_pillow(self):
+        upload = make_upload(make_png())
+        with mock.patch.object(PILImage, 'open', wraps=PILImage.open) as pil_open:
+            InspectedImageField().to_internal_value(upload)
+        pil_open.assert_called()
+
+
+class ImageUploadTests(MediaTestCase):
+    def upload(self, content, ip_address='203.0.113.5'):
+        return self.client.post(IMAGES_URL, {'image': make_upload(content)}, REMOTE_ADDR=ip_address)
+
+    def test_one_image_per_ip(self):
+        self.assertEqual(self.upload(make_png()).status_code, 201)
+        response = self.upload(make_png('blue'))
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(Image.objects.count(), 1)
+        self.assertEqual(self.upload(make_png('blue'), '203.0.113.6').status_code, 201)
+
+    def test_known_uploader_answered_from_cache(self):
+        self.upload(make_png())
+        with self.assertNumQueries(0):
+            self.assertTrue(has_uploaded('203.0.113.5'))
+        known_uploaders.discard('203.0.113.5')
+        with self.assertNumQueries(1):
+            self.assertTrue(has_uploaded('203.0.113.5'))
+        self.assertFalse(has_uploaded('203.0.113.6'))
+
+    def test_oversized_request_rejected_before_reading(self):
+        response = self.client.post(IMAGES_URL, {'image': make_upload(make_png())}, REMOTE_ADDR='203.0.113.5',
+                                    CONTENT_LENGTH=str(settings.IMAGE_MAX_UPLOAD_SIZE * 2))
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(Image.objects.exists())
+
+    def test_concurrent_upload_from_same_ip(self):
+        Image.objects.create(image='images/first.png', ip_address='203.0.113.5')
+        # The other upload committed after this one passed the admission check
+        with mock.patch('apps.core.views.has_uploaded', return_value=False):
+            response = self.upload(make_png())
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(Image.objects.count(), 1)
+        # The stored file is journaled for deletion
+        self.assertEqual(process_deletion_journal(), (1, 0))
+        self.assertEqual([files for _, _, files in os.walk(os.path.join(settings.MEDIA_ROOT, 'images'))
+                          if files], [])
+
+    def test_stores_dimensions(self):
+        response = self.upload(make_png(size=(40, 30)))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((response.json()['data']['width'], response.json()['data']['height']), (40, 30))
+        image = Image.objects.get()
+        self.assertEqual((image.width, image.height), (40, 30))
+
+    def test_rejects_non_image_data(self):
+        response = self.upload(b'not an image at all')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Image.objects.exists())
+
+
+    def test_identical_uploads_share_the_file(self):
+        content = make_png()
+        self.assertEqual(self.upload(content).status_code, 201)
+        self.assertEqual(self.upload(content, '203.0.113.6').status_code, 201)
+
+        first, second = Image.objects.order_by('id')
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertEqual(first.content_hash, second.content_hash)
+        self.assertEqual(second.variants, first.variants)
+        self.assertTrue(os.path.exists(first.image.path))
+
+        # The file goes with the last image that references it
+        first.delete()
+        journal_file_deletions([first.image.name])
+        process_deletion_journal()
+        self.assertTrue(os.path.exists(second.image.path))
+        path = second.image.path
+        second.delete()
+        journal_file_deletions([second.image.name])
+        process_deletion_journal()
+        self.assertFalse(os.path.exists(path))
+
+    def test_twin_inherits_rejection_but_not_approval(self):
+        content = make_png()
+        self.upload(content)
+        Image.objects.update(rejected=True)
+        self.upload(content, '203.0.113.6')
+        self.assertTrue(Image.objects.get(ip_address='203.0.113.6').rejected)
+
+        Image.objects.update(approved=True, rejected=False)
+        self.upload(content, '203.0.113.7')
+        twin = Image.objects.get(ip_address='203.0.113.7')
+        self.assertFalse(twin.approved)
+        self.assertFalse(twin.rejected)
+
+class AsyncViewTests(MediaTestCase):
+    order_form = {'name': 'Anna', 'phone': '+998 (90) 123-45-67-89', 'contact_method': 'telegram'}
+
+    def setUp(self):
+        super().setUp()
+        self.factory = AsyncRequestFactory()
+        self.images = AsyncImageListCreateView.as_view()
+        self.order_forms = AsyncOrderFormListCreateView.as_view()
+        now = timezone.now()
+        for index in range(3):
+            Image.objects.create(image=f'images/{index}.png', ip_address=f'203.0.113.{index}', approved=True,
+                                 upload_date=now - timedelta(minutes=index))
+
+    def upload(self, content, ip_address='203.0.113.50'):
+        # As forwarded by a proxy on the factory's loopback peer
+        return self.images(self.factory.post(IMAGES_URL, {'image': make_upload(content)},
+                                             headers={'X-Forwarded-For': ip_address}))
+
+    async def test_gallery(self):
+        response = await self.images(self.factory.get(IMAGES_URL))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.content)), 3)
+
+        response = await self.images(self.factory.get(IMAGES_URL, {'page_size': 2}))
+        data = json.loads(response.content)
+        self.assertEqual(len(data['results']), 2)
+        response = await self.images(self.factory.get(data['next']))
+        self.assertEqual(len(json.loads(response.content)['results']), 1)
+
+    async def test_gallery_not_modified(self):
+        response = await self.images(self.factory.get(IMAGES_URL))
+        response = await self.images(self.factory.get(IMAGES_URL, headers={'If-None-Match': response['ETag']}))
+        self.assertEqual(response.status_code, 304)
+
+    async def test_invalid_cursor(self):
+        response = await self.images(self.factory.get(IMAGES_URL, {'cursor': 'garbage'}))
+        self.assertEqual(response.status_code, 404)
+
+    async def test_upload(self):
+        response = await self.upload(make_png())
+        self.assertEqual(response.status_code, 201)
+        image = await Image.objects.aget(ip_address='203.0.113.50')
+        self.assertEqual((image.width, image.height), (40, 30))
+
+        self.assertEqual((await self.upload(make_png('blue'))).status_code, 403)
+        self.assertEqual((await self.upload(b'not an image', '203.0.113.51')).status_code, 400)
+
+    async def test_upload_decoded_off_the_event_loop(self):
+        threads = []
+
+        def inspect(image_file):
+            threads.append(threading.current_thread())
+            return inspect_image(image_file)
+
+        with mock.patch('apps.core.async_views.inspect_image', side_effect=inspect):
+            self.assertEqual((await self.upload(make_png())).status_code, 201)
+        self.assertNotIn(threading.current_thread(), threads)
+
+    async def test_order_form(self):
+        response = await self.order_forms(self.factory.post(ORDER_FORMS_URL, self.order_form,
+                                                            content_type='application/json'))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(await OrderForms.objects.acount(), 1)
+
+        response = await self.order_forms(self.factory.post(ORDER_FORMS_URL, {'name': 'Anna'},
+                                                            content_type='application/json'))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('phone', json.loads(response.content))
+
+        response = await self.order_forms(self.factory.post(ORDER_FORMS_URL, '{', content_type='application/json'))
+        self.assertEqual(response.status_code, 400)
+
+
+class UploadSessionTests(MediaTestCase):
+    ip_address = '203.0.113.5'
+
+    def setUp(self):
+        super().setUp()
+        self.content = make_png(size=(200, 100))
+
+    def create_session(self, ip_address=None):
+        response = self.client.post(UPLOADS_URL, {
+            'filename': 'sticker.png', 'content_type': 'image/png', 'size': len(self.content),
+        }, content_type='application/json', REMOTE_ADDR=ip_address or self.ip_address)
+        self.assertEqual(response.status_code, 201)
+        return response.json()['id']
+
+    def put_chunk(self, session_id, start, end):
+        return self.client.put(f'{UPLOADS_URL}{session_id}/', self.content[start:end + 1],
+                               content_type='application/octet-stream', REMOTE_ADDR=self.ip_address,
+                               HTTP_CONTENT_RANGE=f'bytes {start}-{end}/{len(self.content)}')
+
+    def test_chunked_upload(self):
+        session_id = self.create_session()
+        middle = len(self.content) // 2
+        self.assertEqual(self.put_chunk(session_id, 0, middle - 1).json()['offset'], middle)
+        # A retried chunk is refused with the offset to resume from
+        response = self.put_chunk(session_id, 0, middle - 1)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['offset'], middle)
+        self.assertEqual(self.put_chunk(session_id, middle, len(self.content) - 1).status_code, 200)
+
+        response = self.client.post(f'{UPLOADS_URL}{session_id}/finalize/', REMOTE_ADDR=self.ip_address)
+        self.assertEqual(response.status_code, 201)
+        image = Image.objects.get()
+        self.assertEqual((image.width, image.height), (200, 100))
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_finalize_incomplete_upload(self):
+        session_id = self.create_session()
+        self.put_chunk(session_id, 0, 99)
+        response = self.client.post(f'{UPLOADS_URL}{session_id}/finalize/', REMOTE_ADDR=self.ip_address)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['offset'], 100)
+
+    def test_invalid_content_range(self):
+        session_id = self.create_session()
+        response = self.client.put(f'{UPLOADS_URL}{session_id}/', self.content[:10],
+                                   content_type='application/octet-stream', REMOTE_ADDR=self.ip_address,
+                                   HTTP_CONTENT_RANGE='bytes 0-9/*')
+        self.assertEqual(response.status_code, 400)
+
+    def test_session_only_visible_to_its_ip(self):
+        session_id = self.create_session()
+        response = self.client.get(f'{UPLOADS_URL}{session_id}/', REMOTE_ADDR='203.0.113.6')
+        self.assertEqual(response.status_code, 404)
+
+    def test_expired_sessions_are_deleted(self):
+        session_id = self.create_session()
+        self.put_chunk(session_id, 0, 99)
+        UploadSession.objects.update(created_at=timezone.now() - timedelta(seconds=settings.UPLOAD_SESSION_TTL + 1))
+        call_command('clear_expired_uploads', stdout=StringIO())
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertNotIn(f'{session_id}.part', os.listdir(settings.UPLOAD_SESSIONS_DIR))
+
+    def test_new_session_replaces_previous(self):
+        first = self.create_session()
+        self.put_chunk(first, 0, 99)
+        second = self.create_session()
+        self.assertEqual(self.client.get(f'{UPLOADS_URL}{first}/', REMOTE_ADDR=self.ip_address).status_code, 404)
+        self.assertEqual(self.client.get(f'{UPLOADS_URL}{second}/', REMOTE_ADDR=self.ip_address).status_code, 200)
+        self.assertEqual(UploadSession.objects.count(), 1)
+        self.assertNotIn(f'{first}.part', os.listdir(settings.UPLOAD_SESSIONS_DIR))
+
+    @override_settings(UPLOAD_SESSION_IDLE_TTL=60)
+    def test_idle_session_expires(self):
+        session_id = self.create_session()
+        self.put_chunk(session_id, 0, 99)
+        UploadSession.objects.update(updated_at=timezone.now() - timedelta(seconds=61))
+        response = self.client.get(f'{UPLOADS_URL}{session_id}/', REMOTE_ADDR=self.ip_address)
+        self.assertEqual(response.status_code, 404)
+        call_command('clear_expired_uploads', stdout=StringIO())
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_ip_that_uploaded_cannot_open_session(self):
+        Image.objects.create(image='images/sticker.png', ip_address=self.ip_address)
+        response = self.client.post(UPLOADS_URL, {
+            'filename': 'sticker.png', 'content_type': 'image/png', 'size': len(self.content),
+        }, content_type='application/json', REMOTE_ADDR=self.ip_address)
+        self.assertEqual(response.status_code, 403)
+
+
+@override_settings(METRICS_DIR='', METRICS_TOKEN='scrape-token')
+class MetricsTests(TestCase):
+    def setUp(self):
+        metrics.registry.reset()
+
+    def test_served_to_allowed_peers(self):
+        self.client.get(IMAGES_URL)
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('http_requests_total{route="image-list-create",method="GET",status="200"} 1',
+                      response.content.decode())
+        self.assertIn('db_queries_per_request_bucket{route="image-list-create",le="+Inf"} 1',
+                      response.content.decode())
+
+    def test_hidden_from_other_peers(self):
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='203.0.113.5').status_code, 404)
+        # X-Forwarded-For from a trusted proxy doesn't make an outside client a scraper
+        response = self.client.get('/metrics', REMOTE_ADDR='203.0.113.5', HTTP_X_FORWARDED_FOR='127.0.0.1')
+        self.assertEqual(response.status_code, 404)
+        # Nor does a local proxy forwarding an outside client
+        response = self.client.get('/metrics', HTTP_X_FORWARDED_FOR='203.0.113.5')
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get('/metrics', HTTP_X_FORWARDED_FOR='203.0.113.5',
+                                   HTTP_AUTHORIZATION='Bearer scrape-token')
+        self.assertEqual(response.status_code, 200)
+
+    def test_token(self):
+        response = self.client.get('/metrics', REMOTE_ADDR='203.0.113.5', HTTP_AUTHORIZATION='Bearer scrape-token')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get('/metrics', REMOTE_ADDR='203.0.113.5', HTTP_AUTHORIZATION='Bearer wrong')
+        self.assertEqual(response.status_code, 404)
+
+    def test_unknown_methods_share_a_label(self):
+        for method in ('PURGE', 'X-MADE-UP'):
+            self.client.generic(method, IMAGES_URL)
+        key = ('http_requests_total', (('route', 'image-list-create'), ('method', 'OTHER'), ('status', 405)))
+        self.assertEqual(metrics.registry.counters.get(key), 2)
+
+    def test_reused_pid_is_not_the_same_worker(self):
+        self.assertTrue(metrics.is_running(os.getpid(), metrics.get_start_time(os.getpid())))
+        self.assertFalse(metrics.is_running(os.getpid(), metrics.get_start_time(os.getpid()) + 1))
+
+    def test_rejection_is_counted(self):
+        self.client.post(IMAGES_URL, {'image': make_upload(b'not an image')}, REMOTE_ADDR='203.0.113.5')
+        key = ('rejected_requests_total', (('route', 'image-list-create'), ('reason', 'invalid_format')))
+        self.assertEqual(metrics.registry.counters.get(key), 1)
+
+    def test_render_histogram(self):
+        metrics.registry.observe('db_queries_per_request', (('route', 'gallery'),), 3)
+        text = metrics.render(metrics.collect())
+        self.assertIn('# TYPE db_queries_per_request histogram', text)
+        self.assertIn('db_queries_per_request_bucket{route="gallery",le="2"} 0', text)
+        self.assertIn('db_queries_per_request_bucket{route="gallery",le="4"} 1', text)
+        self.assertIn('db_queries_per_request_sum{route="gallery"} 3', text)
+
+    def test_workers_summed_and_exited_ones_archived(self):
+        metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, metrics_dir)
+        snapshot = {'counters': [['http_requests_total', [['route', 'gallery']], 2]], 'histograms': []}
+        for pid in ('101', '102'):
+            with open(os.path.join(metrics_dir, f'{pid}-5000.json'), 'w') as snapshot_file:
+                json.dump(snapshot, snapshot_file)
+
+        key = ('http_requests_total', (('route', 'gallery'),))
+        with override_settings(METRICS_DIR=metrics_dir), \
+                mock.patch('apps.core.metrics.get_start_time', side_effect=lambda pid: 5000 if pid == 101 else 0):
+            self.assertEqual(metrics.collect()[0][key], 4)
+            self.assertNotIn('102-5000.json', os.listdir(metrics_dir))
+            # Counters of the exited worker are kept
+            self.assertEqual(metrics.collect()[0][key], 4)
+
+
+class ContentAddressedStorageTests(MediaTestCase):
+    def test_temporary_upload_stored_once(self):
+        names = []
+        for _ in range(2):
+            with TemporaryUploadedFile('sticker.png', 'image/png', 0, None) as upload:
+                upload.write(make_png())
+                upload.flush()
+                names.append(content_addressed_storage.save('images/sticker.png', upload))
+        self.assertEqual(names[0], names[1])
+        self.assertTrue(names[0].endswith('.png'))
+        with content_addressed_storage.open(names[0]) as stored:
+            self.assertEqual(stored.read(), make_png())
+
+    def test_temporary_upload_on_other_filesystem(self):
+        link = os.link
+
+        def cross_device_link(path, target):
+            if path == upload.temporary_file_path():
+                raise OSError(errno.EXDEV, 'Invalid cross-device link')
+            link(path, target)
+
+        with TemporaryUploadedFile('sticker.png', 'image/png', 0, None) as upload:
+            upload.write(make_png())
+            upload.flush()
+            with mock.patch('apps.core.storage.os.link', side_effect=cross_device_link):
+                name = content_addressed_storage.save('images/sticker.png', upload)
+        with content_addressed_storage.open(name) as stored:
+            self.assertEqual(stored.read(), make_png())
+        # The copy written next to it is gone
+        self.assertFalse(any(entry.endswith('.part') for entry in os.listdir(content_addressed_storage.path('images'))))
+
+
+class DeletionJournalTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.name = content_addressed_storage.save('images/sticker.png', ContentFile(make_png()))
+
+    def test_deletes_journaled_file(self):
+        journal_file_deletions([self.name])
+        self.assertEqual(process_deletion_journal(), (1, 0))
+        self.assertFalse(content_addressed_storage.exists(self.name))
+        self.assertFalse(MediaDeletion.objects.exists())
+
+    def test_keeps_referenced_file(self):
+        Image.objects.create(image=self.name, ip_address='203.0.113.5')
+        journal_file_deletions([self.name])
+        self.assertEqual(process_deletion_journal(), (1, 0))
+        self.assertTrue(content_addressed_storage.exists(self.name))
+
+    def test_failure_is_retried_later(self):
+        journal_file_deletions([self.name])
+        with mock.patch.object(ContentAddressedStorage, 'delete_unreferenced', side_effect=OSError('busy')), \
+                self.assertLogs('apps.core.files', 'ERROR'):
+            self.assertEqual(process_deletion_journal(), (0, 1))
+        entry = MediaDeletion.objects.get()
+        self.assertEqual((entry.attempts, entry.last_error), (1, 'busy'))
+        self.assertGreater(entry.next_attempt_at, timezone.now())
+        # Not due yet
+        self.assertEqual(process_deletion_journal(), (0, 0))
+        self.assertTrue(content_addressed_storage.exists(self.name))
+
+    def test_claimed_entries_wait_for_the_claim_to_run_out(self):
+        journal_file_deletions([self.name])
+        self.assertEqual([entry.name for entry in claim_journal_entries()], [self.name])
+        # Another worker skips them until the claim of a dead worker expires
+        self.assertEqual(process_deletion_journal(), (0, 0))
+        MediaDeletion.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(process_deletion_journal(), (1, 0))
+
+    def test_delete_unreferenced_puts_back_referenced_file(self):
+        self.assertFalse(content_addressed_storage.delete_unreferenced(self.name, lambda: True))
+        self.assertTrue(content_addressed_storage.exists(self.name))
+        self.assertTrue(content_addressed_storage.delete_unreferenced(self.name, lambda: False))
+        self.assertFalse(content_addressed_storage.exists(self.name))
+
+    def test_save_restores_file_deleted_meanwhile(self):
+        content = make_png()
+        with self.captureOnCommitCallbacks() as callbacks:
+            image = Image(image=make_upload(content), ip_address='203.0.113.5')
+            image.save()
+        # The journal removed the reused file before the new row was committed
+        os.remove(image.image.path)
+        for callback in callbacks:
+            callback()
+        with open(image.image.path, 'rb') as image_file:
+            self.assertEqual(image_file.read(), content)
+
+    def test_rolled_back_deletion_is_not_journaled(self):
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            journal_file_deletions([self.name])
+            raise RuntimeError
+        self.assertFalse(MediaDeletion.objects.exists())
+
+    @override_settings(MEDIA_GC_ORPHAN_GRACE=-1)
+    def test_collect_orphans(self):
+        referenced = content_addressed_storage.save('images/other.png', ContentFile(make_png('blue')))
+        Image.objects.create(image=referenced, ip_address='203.0.113.5')
+        orphaned_variants = os.path.join(settings.MEDIA_ROOT, 'variants', 'images', 'gone')
+        os.makedirs(orphaned_variants)
+        open(os.path.join(orphaned_variants, 'thumbnail.webp'), 'wb').close()
+
+        self.assertEqual(collect_orphans(dry_run=True), ([self.name], [orphaned_variants]))
+        self.assertFalse(MediaDeletion.objects.exists())
+        collect_orphans()
+        self.assertEqual(process_deletion_journal(), (1, 0))
+        self.assertFalse(content_addressed_storage.exists(self.name))
+        self.assertTrue(content_addressed_storage.exists(referenced))
+        self.assertFalse(os.path.exists(orphaned_variants))
+
+
+class OrderIngestTests(TestCase):
+    data = {'name': 'Alice', 'phone': '+998 (90) 123-45-67-89', 'contact_method': 'telegram'}
+
+    def setUp(self):
+        spool_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spool_dir, ignore_errors=True)
+        self.enterContext(override_settings(ORDER_FORM_SPOOL_DIR=spool_dir, ORDER_FORM_INGEST_MODE='spool'))
+        # Without the flusher thread: tests flush on the main thread's connection
+        self.ingester = OrderFormIngester()
+        os.makedirs(spool_dir, exist_ok=True)
+        self.ingester.open_segment()
+        self.addCleanup(self.ingester.reset)
+
+    def write_segment(self, content):
+        with open(os.path.join(settings.ORDER_FORM_SPOOL_DIR, 'crashed.ndjson'), 'wb') as segment:
+            segment.write(content)
+
+    def test_submission_is_spooled_then_flushed(self):
+        with mock.patch('apps.core.views.order_ingester', self.ingester):
+            response = self.client.post(ORDER_FORMS_URL, self.data, content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        self.assertFalse(OrderForms.objects.exists())
+        with open(self.ingester.path, 'rb') as segment:
+            self.assertEqual(json.loads(segment.read())['ingest_id'], response.json()['submission_id'])
+
+        self.assertTrue(self.ingester.flush())
+        order = OrderForms.objects.get()
+        self.assertEqual(str(order.ingest_id), response.json()['submission_id'])
+        self.assertEqual(order.phone_digits, '99890123456789')
+
+    def test_replay_skips_truncated_last_line(self):
+        row = {'ingest_id': '5f0c6a9e-3c1e-4b7e-9a55-1a2b3c4d5e6f', 'name': 'Bob', 'phone': '+998901234567891',
+               'contact_method': 'whatsapp', 'created_at': timezone.now().isoformat()}
+        # The process died halfway through writing the second line
+        self.write_segment(json.dumps(row).encode() + b'\n{"ingest_id": "8b1')
+        self.assertEqual(replay_spool(), (1, 1))
+        self.assertEqual(OrderForms.objects.get().name, 'Bob')
+        self.assertEqual(os.listdir(settings.ORDER_FORM_SPOOL_DIR), [os.path.basename(self.ingester.path)])
+
+        # A segment loaded twice inserts nothing new
+        self.write_segment(json.dumps(row).encode() + b'\n')
+        self.assertEqual(replay_spool(), (1, 1))
+        self.assertEqual(OrderForms.objects.count(), 1)
+
+    def test_invalid_segment_quarantined(self):
+        row = {'ingest_id': '5f0c6a9e-3c1e-4b7e-9a55-1a2b3c4d5e6f', 'name': 'Bob', 'phone': '+998901234567891',
+               'contact_method': 'whatsapp', 'created_at': timezone.now().isoformat()}
+        self.write_segment(json.dumps({'name': 'No phone'}).encode() + b'\n')
+        with open(os.path.join(settings.ORDER_FORM_SPOOL_DIR, 'later.ndjson'), 'wb') as segment:
+            segment.write(json.dumps(row).encode() + b'\n')
+        with self.assertLogs('apps.core.ingest', 'ERROR'):
+            self.assertEqual(replay_spool(), (2, 1))
+        self.assertEqual(OrderForms.objects.get().name, 'Bob')
+        self.assertIn('crashed.bad', os.listdir(settings.ORDER_FORM_SPOOL_DIR))
+
+    def test_replay_continues_after_failing_segment(self):
+        self.write_segment(b'')
+        with mock.patch('apps.core.ingest.load_segment', side_effect=[OperationalError('down'), 0]) as load, \
+                self.assertLogs('apps.core.ingest', 'ERROR'):
+            self.assertEqual(replay_spool(), (1, 0))
+        self.assertEqual(load.call_count, 2)
+
+    def test_replayed_on_startup(self):
+        with mock.patch('apps.core.ingest.start_replay') as start_replay:
+            apps.get_app_config('core').ready()
+        start_replay.assert_called_once_with()
+
+    def test_replay_skips_segments_in_use(self):
+        self.ingester.submit(self.data)
+        self.assertEqual(replay_spool(), (0, 0))
+        self.assertFalse(OrderForms.objects.exists())
+
+
+class MediaServingTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.content = make_png(size=(200, 100))
+        self.image = Image(image=make_upload(self.content), ip_address='203.0.113.5', approved=True)
+        self.image.save()
+        self.url = get_media_url(self.image.image.name)
+
+    def get(self, url=None, **headers):
+        response = self.client.get(url or self.url, **headers)
+        response.body = b''.join(response.streaming_content) if response.streaming else response.content
+        return response
+
+    def test_parse_range(self):
+        self.assertEqual(parse_range('bytes=0-9', 100), (0, 9))
+        self.assertEqual(parse_range('bytes=90-', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=-10', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=50-500', 100), (50, 99))
+        self.assertIs(parse_range('bytes=100-', 100), False)
+        self.assertIsNone(parse_range('bytes=0-1,5-6', 100))
+        self.assertIsNone(parse_range(None, 100))
+
+    def test_serves_approved_image(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.body, self.content)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_range(self):
+        response = self.get(HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(self.content)}')
+        self.assertEqual(response.body, self.content[10:20])
+
+        response = self.get(HTTP_RANGE=f'bytes={len(self.content)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.content)}')
+
+    def test_if_range(self):
+        etag = self.get()['ETag']
+        self.assertEqual(self.get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag).status_code, 206)
+        # The file changed since the client's copy: send all of it
+        response = self.get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.body, self.content)
+
+    def test_private_file(self):
+        Image.objects.update(approved=False)
+        bump_gallery_version()
+        self.assertEqual(self.get().status_code, 404)
+        self.assertEqual(self.get(f'{self.url}?signature=forged').status_code, 404)
+
+        response = self.get(get_media_url(self.image.image.name, signed=True))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('private', response['Cache-Control'])
+
+    def test_outside_media_root(self):
+        self.assertEqual(self.get('/media/../config/settings.py').status_code, 404)
+        self.assertEqual(self.get('/media/images/missing.png').status_code, 404)
+
+
+class SchemaTests(TestCase):
+    def setUp(self):
+        self.addCleanup(CachedSchemaView._schemas.clear)
+        self.addCleanup(CachedSchemaView._rendered.clear)
+        CachedSchemaView._schemas.clear()
+        CachedSchemaView._rendered.clear()
+
+    def test_generated_once_per_version_and_language(self):
+        with mock.patch.object(CachedSchemaView.generator_class, 'get_schema',
+                               autospec=True, return_value={'openapi': '3.0.3'}) as get_schema:
+            for _ in range(2):
+                response = self.client.get('/api/schema/', {'format': 'json'})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(json.loads(response.content), {'openapi': '3.0.3'})
+                self.client.get('/api/schema/')
+                self.client.get('/api/schema/', {'format': 'json', 'lang': 'de'})
+        self.assertEqual(get_schema.call_count, 2)
+        self.assertEqual(set(CachedSchemaView._schemas), {(None, 'en-us'), (None, 'de')})
+
+    def test_unknown_version_and_language_not_cached(self):
+        with mock.patch.object(CachedSchemaView.generator_class, 'get_schema',
+                               autospec=True, return_value={'openapi': '3.0.3'}) as get_schema:
+            for query in ({'version': 'v9'}, {'lang': 'made-up'}, {'lang': 'de-at'}):
+                response = self.client.get('/api/schema/', {'format': 'json', **query})
+                self.assertEqual(response.status_code, 200)
+        self.assertEqual(get_schema.call_count, 3)
+        # de-at is served from the entry of its supported variant
+        self.assertEqual(set(CachedSchemaView._schemas), {(None, 'de')})
+
+    def test_served_with_filename(self):
+        with mock.patch.object(CachedSchemaView.generator_class, 'get_schema',
+                               autospec=True, return_value={'openapi': '3.0.3'}):
+            response = self.client.get('/api/schema/', {'format': 'json'})
+        self.assertEqual(response.status_code, 200)
+        self.assertRegex(response['Content-Disposition'], r'^inline; filename=".+\.json"$')
+
+    def test_read_from_file(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as schema_file:
+            json.dump({'openapi': '3.0.3', 'info': {'title': 'Prebuilt'}}, schema_file)
+            schema_file.flush()
+            with override_settings(OPENAPI_SCHEMA_FILE=schema_file.name):
+                response = self.client.get('/api/schema/', {'format': 'json'})
+        self.assertEqual(json.loads(response.content)['info']['title'], 'Prebuilt')
+
+
+class LoggingHandlerTests(SimpleTestCase):
+    def test_file_created_on_first_record(self):
+        logs_dir = os.path.join(tempfile.mkdtemp(), 'logs')
+        self.addCleanup(shutil.rmtree, os.path.dirname(logs_dir))
+        handler = LazyRotatingFileHandler(os.path.join(logs_dir, 'app.log'))
+        self.addCleanup(handler.close)
+        self.assertFalse(os.path.exists(logs_dir))
+        handler.emit(logging.makeLogRecord({'msg': 'started'}))
+        with open(os.path.join(logs_dir, 'app.log')) as log_file:
+            self.assertEqual(log_file.read(), 'started\n')
+
+    def test_records_reach_handlers_through_queue(self):
+        received = []
+        delivered = threading.Event()
+
+        class ListHandler(logging.Handler):
+            def emit(self, record):
+                received.append((record.getMessage(), threading.current_thread().name))
+                delivered.set()
+
+        target = ListHandler(logging.INFO)
+        target.name = 'test_list'
+        self.addCleanup(target.close)
+        handler = QueueListenerHandler(['test_list'])
+        args = {'id': 1}
+        handler.handle(logging.makeLogRecord({'msg': 'image %(id)s', 'args': args, 'levelno': logging.INFO}))
+        # Formatted when queued, not when written
+        args['id'] = 2
+        handler.handle(logging.makeLogRecord({'msg': 'debug', 'levelno': logging.DEBUG}))
+        self.assertTrue(delivered.wait(5))
+        self.assertEqual(received, [('image 1', 'log-listener')])
+
+        with self.assertRaises(ValueError):
+            QueueListenerHandler(['missing'])
+
+    def test_admin_emails_sent_by_listener(self):
+        handler = logging_handlers.get_handler_by_name('queue_mail_admins')
+        sent = threading.Event()
+        threads = []
+
+        def emit(record):
+            threads.append(threading.current_thread().name)
+            sent.set()
+
+        with mock.patch.object(handler.handlers[0], 'emit', side_effect=emit):
+            handler.handle(logging.makeLogRecord({'msg': 'failed', 'levelno': logging.ERROR}))
+            self.assertTrue(sent.wait(5))
+        self.assertEqual(threads, ['log-listener'])
+
+    @override_settings(LOG_QUEUE_SIZE=1)
+    def test_full_queue_drops_records(self):
+        listener = logging_handlers._Listener()
+        # Nothing to flush at exit
+        self.addCleanup(listener.reset)
+        record = logging.makeLogRecord({'msg': 'message'})
+        # The listener thread is never started, so nothing drains the queue
+        with mock.patch('config.logging_handlers.threading.Thread'):
+            for _ in range(3):
+                listener.put((), record)
+        self.assertEqual((listener.queue.qsize(), listener.dropped), (1, 2))
@@ -0,0 +1,136 @@
+"""
+Token-bucket rate limits for the public endpoints, see RateLimitMiddleware.
+
+Rates use DRF's notation, e.g. '10/min': a bucket of 10 tokens refilled
+at 10 per minute. The store is chosen with THROTTLE_STORE (dotted path):
+the default LocalBucketStore refills continuously but keeps buckets per
+process, CacheBucketStore shares fixed windows between the workers using
+THROTTLE_CACHE, like the upload ConcurrencyLimit always does.
+"""
+import heapq
+import math
+import random
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+PERIODS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+
+
+def parse_rate(rate):
+    """
+    '10/min' -> (10, 60)
+    """
+    count, period = rate.split('/')
+    return int(count), PERIODS[period[0]]
+
+
+class LocalBucketStore:
+    """
+    In-process buckets kept as GCRA "theoretical arrival times", one float per key.
+    A heap of (arrival, key) finds the buckets that have refilled
+    completely, so expiring them costs O(log n) per request; past
+    `max_keys` the buckets closest to refilled are dropped early.
+    """
+    max_keys = 100_000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.arrivals = {}
+        # (arrival, key), with stale entries for keys consumed again since
+        self.expiry = []
+
+    def consume(self, key, count, period):
+        """
+        Take one token; returns 0 when allowed, otherwise seconds until the next token
+        """
+        now = time.monotonic()
+        interval = period / count
+        with self.lock:
+            arrival = max(self.arrivals.get(key, now), now) + interval
+            if arrival - period > now:
+                return arrival - period - now
+
+            self.arrivals[key] = arrival
+            heapq.heappush(self.expiry, (arrival, key))
+            self.evict(now)
+        return 0
+
+    def evict(self, now):
+        """
+        Drop buckets that have refilled completely, then the closest to it while over `max_keys`
+        """
+        while self.expiry and (self.expiry[0][0] <= now or len(self.arrivals) > self.max_keys):
+            arrival, key = heapq.heappop(self.expiry)
+            if self.arrivals.get(key) == arrival:
+                del self.arrivals[key]
+
+
+class CacheBucketStore:
+    """
+    Buckets shared by all workers through a cache backend (THROTTLE_CACHE).
+    Uses atomic add/incr, so the bucket is refilled all at once at the start
+    of each period rather than continuously.
+    """
+
+    def __init__(self):
+        self.cache = caches[settings.THROTTLE_CACHE]
+
+    def consume(self, key, count, period):
+        now = time.time()
+        window = int(now // period)
+        cache_key = f'throttle:{key}:{window}'
+        self.cache.add(cache_key, 0, period + 1)
+        try:
+            used = self.cache.incr(cache_key)
+        except ValueError:
+            # Expired between add and incr
+            self.cache.add(cache_key, 1, period + 1)
+            used = 1
+        if used > count:
+            return (window + 1) * period - now
+        return 0
+
+
+class ConcurrencyLimit:
+    """
+    Non-blocking cap on requests in flight across the workers sharing
+    THROTTLE_CACHE: `limit` slot keys taken with an atomic add. A slot
+    held by a worker that died frees itself after `timeout` seconds.
+    """
+
+    def __init__(self, name, limit, timeout):
+        self.cache = caches[settings.THROTTLE_CACHE]
+        self.slots = [f'concurrency:{name}:{index}' for index in range(limit)]
+        self.timeout = timeout
+
+    def acquire(self):
+        """
+        Returns (slot, token) for the slot taken, True without a limit, or None when all are busy
+        """
+        if not self.slots:
+            return True
+        # Start at a random slot so concurrent requests don't all contend for the first
+        start = random.randrange(len(self.slots))
+        token = uuid.uuid4().hex
+        for slot in self.slots[start:] + self.slots[:start]:
+            if self.cache.add(slot, token, self.timeout):
+                return slot, token
+        return None
+
+    def release(self, held):
+        """
+        Free a slot returned by `acquire`, unless it timed out and another request has taken it since
+        """
+        if held is True:
+            return
+        slot, token = held
+        if self.cache.get(slot) == token:
+            self.cache.delete(slot)
+
+
+def get_retry_after(delay):
+    return max(1, math.ceil(delay))
@@ -0,0 +1,101 @@
+import os
+import re
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import UploadSession
+from .validators import HEADER_SIZE, sniff_image_format
+
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+READ_SIZE = 64 * 1024
+
+
+def get_session_path(session):
+    return os.path.join(settings.UPLOAD_SESSIONS_DIR, f'{session.pk}.part')
+
+
+def parse_content_range(header):
+    """
+    Parse `Content-Range: bytes start-end/total` into (start, end, total)
+    """
+    match = CONTENT_RANGE_RE.match(header or '')
+    if not match:
+        return None
+    start, end, total = (int(value) for value in match.groups())
+    if end < start:
+        return None
+    return start, end, total
+
+
+def write_chunk(session, start, stream, length):
+    """
+    Write `length` bytes from `stream` into the session file at `start`.
+    Returns the number of bytes actually received.
+    """
+    path = get_session_path(session)
+    os.makedirs(settings.UPLOAD_SESSIONS_DIR, exist_ok=True)
+
+    remaining = length
+    with open(path, 'r+b' if os.path.exists(path) else 'wb') as part:
+        part.seek(start)
+        while remaining:
+            data = stream.read(min(READ_SIZE, remaining))
+            if not data:
+                break
+            part.write(data)
+            remaining -= len(data)
+    return length - remaining
+
+
+def has_image_header(session):
+    """
+    Check the magic bytes as soon as the first chunk is in
+    """
+    with open(get_session_path(session), 'rb') as part:
+        return sniff_image_format(part.read(HEADER_SIZE)) is not None
+
+
+def discard_session(session):
+    try:
+        os.remove(get_session_path(session))
+    except FileNotFoundError:
+        pass
+    session.delete()
+
+
+def get_expired_filter():
+    """
+    Sessions older than UPLOAD_SESSION_TTL, or idle for UPLOAD_SESSION_IDLE_TTL
+    """
+    now = timezone.now()
+    return (Q(created_at__lt=now - timedelta(seconds=settings.UPLOAD_SESSION_TTL))
+            | Q(updated_at__lt=now - timedelta(seconds=settings.UPLOAD_SESSION_IDLE_TTL)))
+
+
+def delete_expired_sessions():
+    expired = UploadSession.objects.filter(get_expired_filter())
+    count = 0
+    for session in expired.iterator():
+        discard_session(session)
+        count += 1
+    return count
+
+
+class SessionUploadedFile(UploadedFile):
+    """
+    A completed upload session as an UploadedFile.
+    Exposing temporary_file_path lets the storage move the file into place
+    instead of copying it.
+    """
+
+    def __init__(self, session):
+        self._path = get_session_path(session)
+        super().__init__(open(self._path, 'rb'), session.filename, session.content_type, session.size)
+
+    def temporary_file_path(self):
+        return self._path
@@ -1,9 +1,25 @@
+from django.conf import settings
 from django.urls import path
 
-from apps.core.views import ImageListCreateView, OrderFormListCreateView
+from apps.core.views import (
+    ImageListCreateView,
+    OrderFormListCreateView,
+    UploadSessionCreateView,
+    UploadSessionFinalizeView,
+    UploadSessionView,
+)
+
+if settings.CORE_ASYNC_VIEWS:
+    from apps.core.async_views import (
+        AsyncImageListCreateView as ImageListCreateView,
+        AsyncOrderFormListCreateView as OrderFormListCreateView,
+    )
 
 urlpatterns = [
     path('images/', ImageListCreateView.as_view(), name='image-list-create'),
     path('order-forms/', OrderFormListCreateView.as_view(), name='orderform-list-create'),
+    path('uploads/', UploadSessionCreateView.as_view(), name='upload-session-create'),
+    path('uploads/<uuid:pk>/', UploadSessionView.as_view(), name='upload-session-detail'),
+    path('uploads/<uuid:pk>/finalize/', UploadSessionFinalizeView.as_view(), name='upload-session-finalize'),
 
 ]
@@ -0,0 +1,94 @@
+from collections import namedtuple
+
+from PIL import Image as PILImage
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_image_file_extension
+
+ImageInfo = namedtuple('ImageInfo', ['format', 'width', 'height'])
+
+HEADER_SIZE = 32
+
+ALLOWED_FORMATS = {
+    'jpeg': 'JPEG',
+    'png': 'PNG',
+    'gif': 'GIF',
+    'bmp': 'BMP',
+    'webp': 'WEBP',
+}
+
+MAGIC_NUMBERS = [
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),
+]
+
+
+def sniff_image_format(header):
+    """
+    Detect the image format from the first bytes of a file
+    """
+    for magic, image_format in MAGIC_NUMBERS:
+        if header.startswith(magic):
+            return image_format
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def reject(image_file, reason, message):
+    image_file.rejection_reason = reason
+    return None, message
+
+
+def inspect_image(image_file):
+    """
+    Validate an uploaded image from its header only, without decoding pixels.
+    Returns (ImageInfo, None) on success and (None, error_message) otherwise.
+    The ImageInfo is also attached to the file as `image_info` so later stages
+    (see InspectedImageField) don't parse the file again; a rejected file
+    gets a short `rejection_reason` for metrics instead.
+    """
+    if not image_file:
+        return None, "No image file provided."
+
+    if not image_file.content_type.startswith('image/'):
+        return reject(image_file, 'not_image', "File must be an image.")
+
+    if image_file.size > settings.IMAGE_MAX_UPLOAD_SIZE:
+        return reject(image_file, 'too_large',
+                      f"Image file size must be under {settings.IMAGE_MAX_UPLOAD_SIZE // (1024 * 1024)}MB.")
+
+    try:
+        validate_image_file_extension(image_file)
+
+        image_file.seek(0)
+        image_format = sniff_image_format(image_file.read(HEADER_SIZE))
+        if not image_format:
+            return reject(image_file, 'invalid_format', "File does not contain valid image data. "
+                                                        f"Allowed formats: {', '.join(ALLOWED_FORMATS)}")
+
+        image_file.seek(0)
+        # Image.open only parses the header; pixel data is decoded lazily
+        with PILImage.open(image_file, formats=[ALLOWED_FORMATS[image_format]]) as image:
+            width, height = image.size
+
+        if max(width, height) > settings.IMAGE_MAX_DIMENSION:
+            return reject(image_file, 'too_many_dimensions',
+                          f"Image dimensions must not exceed {settings.IMAGE_MAX_DIMENSION} pixels per side.")
+
+        if width * height > settings.IMAGE_MAX_PIXELS:
+            return reject(image_file, 'too_many_pixels', f"Image must not exceed {settings.IMAGE_MAX_PIXELS} pixels.")
+
+        image_file.seek(0)
+        image_file.image_info = ImageInfo(image_format, width, height)
+        return image_file.image_info, None
+
+    except ValidationError as e:
+        return reject(image_file, 'invalid_extension', f"Invalid image file: {str(e)}")
+    except PILImage.DecompressionBombError:
+        return reject(image_file, 'too_many_pixels', f"Image must not exceed {settings.IMAGE_MAX_PIXELS} pixels.")
+    except Exception as e:
+        return reject(image_file, 'invalid_image', f"Error validating image: {str(e)}")
@@ -1,59 +1,64 @@
-import imghdr
+from io import BytesIO
 
-from django.core.exceptions import ValidationError
-from django.core.validators import validate_image_file_extension
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
 from rest_framework import status
+from rest_framework.exceptions import NotFound
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from .models import Image, OrderForms
-from .pagination import CustomPagination
-from .serializers import OrderFormsSerializer, ImageSerializer
+from .admission import has_uploaded, is_oversized_request, known_uploaders
+from .client_ip import resolve_client_ip
+from .derivatives import schedule_variants
+from .gallery_cache import cached_gallery_response
+from .ingest import order_ingester
+from .metrics import record_rejection
+from .models import Image, OrderForms, UploadSession
+from .pagination import GalleryCursorPagination
+from .serializers import OrderFormsSerializer, ImageSerializer, UploadSessionSerializer
+from .uploads import (
+    SessionUploadedFile,
+    discard_session,
+    get_expired_filter,
+    has_image_header,
+    parse_content_range,
+    write_chunk,
+)
+from .validators import inspect_image
+
+ALREADY_UPLOADED_MESSAGE = 'You have already uploaded an image. Only one image per IP address is allowed.'
+UPLOADED_MESSAGE = 'Image uploaded successfully! It will be visible after approval.'
+ORDER_SUBMITTED_MESSAGE = 'Order form submitted successfully'
+ORDER_ACCEPTED_MESSAGE = 'Order form accepted'
 
 
 def get_client_ip(request):
-    """Get client IP address from request"""
-    x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
-    if x_forwarded_for:
-        ip = x_forwarded_for.split(',')[0]
-    else:
-        ip = request.META.get('REMOTE_ADDR')
-    return ip
+    """Get client IP address from request, as resolved by ClientIPMiddleware"""
+    client_ip = getattr(request, 'client_ip', None)
+    return client_ip or resolve_client_ip(request)
 
 
-def validate_image_format(image_file):
+def save_image(serializer, ip_address, image_info):
     """
-    Validate that the file is actually a valid image
-    Returns (is_valid, error_message)
+    Save a validated upload and queue its variants.
+    Returns None when a concurrent upload from the same IP won the race.
     """
-    if not image_file:
-        return False, "No image file provided."
-
-    if not image_file.content_type.startswith('image/'):
-        return False, "File must be an image."
-
     try:
+        image = serializer.save(
+            ip_address=ip_address,
+            width=image_info.width,
+            height=image_info.height,
+        )
+    except IntegrityError:
+        known_uploaders.add(ip_address)
+        return None
 
-        validate_image_file_extension(image_file)
-
-        image_type = imghdr.what(image_file)
-        if not image_type:
-            return False, "File does not contain valid image data."
-
-        allowed_formats = ['jpeg', 'jpg', 'png', 'gif', 'bmp', 'webp']
-        if image_type not in allowed_formats:
-            return False, f"Image format '{image_type}' is not supported. Allowed formats: {', '.join(allowed_formats)}"
-
-        if hasattr(image_file, 'seek'):
-            image_file.seek(0)
-
-        return True, None
-
-    except ValidationError as e:
-        return False, f"Invalid image file: {str(e)}"
-    except Exception as e:
-        return False, f"Error validating image: {str(e)}"
+    known_uploaders.add(ip_address)
+    if not image.variants:
+        schedule_variants(image)
+    return image
 
 
 class ImageListCreateView(APIView):
@@ -63,44 +68,62 @@ class ImageListCreateView(APIView):
     permission_classes = [AllowAny]
     queryset = Image.objects.all().order_by('-upload_date')
     serializer_class = ImageSerializer
-    pagination_class = CustomPagination
+    pagination_class = GalleryCursorPagination
+    # One query per page, variants are stored on the row
+    query_budget = {'GET': 2}
 
     def get(self, request, format=None):
         """
         List only approved images for regular users.
+        Pass `cursor` (empty for the first page) or `page_size` to page
+        through the gallery with keyset pagination.
+        Responses are cached per gallery version and carry an ETag.
         """
+        return cached_gallery_response(request, lambda: self.list_approved(request))
+
+    def list_approved(self, request):
         queryset = Image.objects.filter(approved=True)
+
+        paginator = self.pagination_class()
+        if paginator.is_requested(request):
+            page = paginator.paginate_queryset(queryset, request, view=self)
+            serializer = ImageSerializer(page, many=True, context={'request': request})
+            return paginator.get_paginated_response(serializer.data).data
+
         serializer = ImageSerializer(queryset, many=True, context={'request': request})
-        return Response(serializer.data)
+        return serializer.data
 
     def post(self, request, format=None):
         """
-        Create a new image with IP check (one image per IP)
+        Create a new image with IP check (one image per IP).
+        Both admission checks run before the request body is read.
         """
         ip_address = get_client_ip(request)
 
-        if Image.objects.filter(ip_address=ip_address).exists():
+        if has_uploaded(ip_address):
+            record_rejection(request, 'already_uploaded')
             return Response(
-                {'detail': 'You have already uploaded an image. Only one image per IP address is allowed.'},
+                {'detail': ALREADY_UPLOADED_MESSAGE},
                 status=status.HTTP_403_FORBIDDEN
             )
 
-        if 'image' not in request.FILES:
+        if is_oversized_request(request):
+            record_rejection(request, 'too_large')
             return Response(
-                {'detail': 'No image file provided.'},
-                status=status.HTTP_400_BAD_REQUEST
+                {'detail': f'Image file size must be under {settings.IMAGE_MAX_UPLOAD_SIZE // (1024 * 1024)}MB.'},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
             )
 
-        image_file = request.FILES['image']
-
-        if image_file.size > 5 * 1024 * 1024:
+        if 'image' not in request.FILES:
+            record_rejection(request, 'missing_file')
             return Response(
-                {'detail': 'Image file size must be under 5MB.'},
+                {'detail': 'No image file provided.'},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        is_valid, error_message = validate_image_format(image_file)
-        if not is_valid:
+        image_info, error_message = inspect_image(request.FILES['image'])
+        if error_message:
+            record_rejection(request, request.FILES['image'].rejection_reason)
             return Response(
                 {'detail': error_message},
                 status=status.HTTP_400_BAD_REQUEST
@@ -108,16 +131,20 @@ class ImageListCreateView(APIView):
 
         serializer = ImageSerializer(data=request.data, context={'request': request})
         if serializer.is_valid():
-            serializer.save(
-                ip_address=ip_address,
-            )
+            if save_image(serializer, ip_address, image_info) is None:
+                record_rejection(request, 'already_uploaded')
+                return Response(
+                    {'detail': ALREADY_UPLOADED_MESSAGE},
+                    status=status.HTTP_403_FORBIDDEN
+                )
             return Response(
                 {
-                    'detail': 'Image uploaded successfully! It will be visible after approval.',
+                    'detail': UPLOADED_MESSAGE,
                     'data': serializer.data
                 },
                 status=status.HTTP_201_CREATED
             )
+        record_rejection(request, 'invalid_data')
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
@@ -128,14 +155,225 @@ class OrderFormListCreateView(APIView):
     permission_classes = [AllowAny]
     queryset = OrderForms.objects.all().order_by('-created_at')
     serializer_class = OrderFormsSerializer
+    query_budget = {'POST': 1}
 
     def post(self, request, format=None):
         """
-        Create a new order form from POST data
+        Create a new order form from POST data.
+        With ORDER_FORM_INGEST_MODE = 'spool' it is queued for a batched insert
+        and the response is 202 with its `submission_id`.
         """
         serializer = OrderFormsSerializer(data=request.data)
         if serializer.is_valid():
+            if settings.ORDER_FORM_INGEST_MODE == 'spool':
+                return Response({
+                    'message': ORDER_ACCEPTED_MESSAGE,
+                    'submission_id': order_ingester.submit(serializer.validated_data)},
+                    status=status.HTTP_202_ACCEPTED)
             serializer.save()
             return Response({
-                'message': 'Order form submitted successfully'}, status=status.HTTP_201_CREATED)
+                'message': ORDER_SUBMITTED_MESSAGE}, status=status.HTTP_201_CREATED)
+        record_rejection(request, 'invalid_data')
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class UploadSessionCreateView(APIView):
+    """
+    API endpoint starting a resumable image upload
+    """
+    permission_classes = [AllowAny]
+
+    def post(self, request, format=None):
+        """
+        Open an upload session for `filename`, `content_type` and `size`.
+        Chunks are then PUT to the session with a Content-Range header and
+        the upload is completed with a POST to its finalize endpoint.
+        A new session replaces the previous one of the same IP address.
+        """
+        ip_address = get_client_ip(request)
+
+        if has_uploaded(ip_address):
+            record_rejection(request, 'already_uploaded')
+            return Response(
+                {'detail': ALREADY_UPLOADED_MESSAGE},
+                status=status.HTTP_403_FORBIDDEN
+            )
+
+        serializer = UploadSessionSerializer(data=request.data)
+        if serializer.is_valid():
+            for previous in UploadSession.objects.filter(ip_address=ip_address):
+                discard_session(previous)
+            try:
+                with transaction.atomic():
+                    serializer.save(ip_address=ip_address)
+            except IntegrityError:
+                record_rejection(request, 'upload_in_progress')
+                return Response(
+                    {'detail': 'Another upload from this IP address is starting.'},
+                    status=status.HTTP_409_CONFLICT
+                )
+            return Response(serializer.data, status=status.HTTP_201_CREATED)
+        record_rejection(request, 'invalid_data')
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class UploadSessionMixin:
+    def get_session(self, request, pk):
+        """
+        Sessions are only visible to the IP address that opened them
+        """
+        try:
+            return UploadSession.objects.exclude(get_expired_filter()).get(pk=pk, ip_address=get_client_ip(request))
+        except UploadSession.DoesNotExist:
+            raise NotFound('Upload session not found.')
+
+
+class UploadSessionView(UploadSessionMixin, APIView):
+    """
+    API endpoint receiving the chunks of a resumable upload
+    """
+    permission_classes = [AllowAny]
+
+    def get(self, request, pk, format=None):
+        """
+        Report how many bytes were received, to resume from there
+        """
+        session = self.get_session(request, pk)
+        return Response(UploadSessionSerializer(session).data)
+
+    def put(self, request, pk, format=None):
+        """
+        Write one chunk described by `Content-Range: bytes start-end/total`.
+        The chunk must start at the current offset; a retried chunk only
+        costs its own bytes.
+        """
+        session = self.get_session(request, pk)
+
+        content_range = parse_content_range(request.META.get('HTTP_CONTENT_RANGE'))
+        if content_range is None:
+            record_rejection(request, 'invalid_content_range')
+            return Response(
+                {'detail': 'Content-Range header must be "bytes start-end/total".'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        start, end, total = content_range
+        if total != session.size or end >= session.size:
+            record_rejection(request, 'invalid_content_range')
+            return Response(
+                {'detail': 'Content-Range does not match the upload size.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        if end - start + 1 > settings.UPLOAD_CHUNK_SIZE:
+            record_rejection(request, 'chunk_too_large')
+            return Response(
+                {'detail': f'Chunks must not exceed {settings.UPLOAD_CHUNK_SIZE} bytes.'},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+            )
+
+        if start != session.offset:
+            record_rejection(request, 'offset_mismatch')
+            return Response(
+                {'detail': 'Chunk does not start at the current offset.', 'offset': session.offset},
+                status=status.HTTP_409_CONFLICT
+            )
+
+        received = write_chunk(session, start, request.stream or BytesIO(), end - start + 1)
+        if received != end - start + 1:
+            record_rejection(request, 'incomplete_chunk')
+            return Response(
+                {'detail': 'Incomplete chunk, resend it from the current offset.', 'offset': session.offset},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        if start == 0 and not has_image_header(session):
+            discard_session(session)
+            record_rejection(request, 'invalid_format')
+            return Response(
+                {'detail': 'File does not contain valid image data.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        if not UploadSession.objects.filter(pk=session.pk, offset=start).update(
+                offset=end + 1, updated_at=timezone.now()):
+            try:
+                session.refresh_from_db()
+            except UploadSession.DoesNotExist:
+                # Replaced by a new session meanwhile, drop the file this chunk recreated
+                discard_session(session)
+                raise NotFound('Upload session not found.')
+            record_rejection(request, 'offset_mismatch')
+            return Response(
+                {'detail': 'Chunk does not start at the current offset.', 'offset': session.offset},
+                status=status.HTTP_409_CONFLICT
+            )
+
+        return Response({'offset': end + 1, 'size': session.size})
+
+    def delete(self, request, pk, format=None):
+        """
+        Abort the upload
+        """
+        discard_session(self.get_session(request, pk))
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class UploadSessionFinalizeView(UploadSessionMixin, APIView):
+    """
+    API endpoint turning a completed upload session into an Image
+    """
+    permission_classes = [AllowAny]
+
+    def post(self, request, pk, format=None):
+        """
+        Validate the assembled file and move it into storage as a new Image
+        """
+        session = self.get_session(request, pk)
+
+        if session.offset != session.size:
+            record_rejection(request, 'incomplete_upload')
+            return Response(
+                {'detail': 'Upload is incomplete.', 'offset': session.offset},
+                status=status.HTTP_409_CONFLICT
+            )
+
+        if has_uploaded(session.ip_address):
+            discard_session(session)
+            record_rejection(request, 'already_uploaded')
+            return Response(
+                {'detail': ALREADY_UPLOADED_MESSAGE},
+                status=status.HTTP_403_FORBIDDEN
+            )
+
+        image_file = SessionUploadedFile(session)
+        try:
+            image_info, error_message = inspect_image(image_file)
+            if error_message:
+                record_rejection(request, image_file.rejection_reason)
+                return Response(
+                    {'detail': error_message},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+            serializer = ImageSerializer(data={'image': image_file}, context={'request': request})
+            if not serializer.is_valid():
+                record_rejection(request, 'invalid_data')
+                return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+            if save_image(serializer, session.ip_address, image_info) is None:
+                record_rejection(request, 'already_uploaded')
+                return Response(
+                    {'detail': ALREADY_UPLOADED_MESSAGE},
+                    status=status.HTTP_403_FORBIDDEN
+                )
+            return Response(
+                {
+                    'detail': UPLOADED_MESSAGE,
+                    'data': serializer.data
+                },
+                status=status.HTTP_201_CREATED
+            )
+        finally:
+            image_file.close()
+            discard_session(session)
@@ -0,0 +1,91 @@
+"""
+Compare two benchmarks/load.py results, e.g. the base branch and a change.
+
+    python benchmarks/compare.py base.json head.json --threshold 10
+
+Prints the change of throughput, latency percentiles and queries per
+request for every scenario present in both files. Exits with status 1 when
+a scenario got slower or lost throughput by more than --threshold percent,
+made more queries per request, or returned more errors.
+"""
+import argparse
+import json
+import sys
+
+LATENCY_KEYS = ['p50', 'p95', 'p99']
+
+
+def change(base, head):
+    if base is None or head is None:
+        return None
+    if base == 0:
+        return 0.0 if head == 0 else float('inf')
+    return (head - base) / base * 100
+
+
+def format_change(value):
+    return 'n/a' if value is None else f'{value:+.1f}%'
+
+
+def compare(base, head, threshold):
+    """
+    Rows of (scenario, metric, base, head, change) and the regressions found
+    """
+    rows, regressions = [], []
+    for name, head_result in head['scenarios'].items():
+        base_result = base['scenarios'].get(name)
+        if base_result is None:
+            continue
+
+        throughput = change(base_result['throughput_rps'], head_result['throughput_rps'])
+        rows.append((name, 'throughput_rps', base_result['throughput_rps'], head_result['throughput_rps'], throughput))
+        if throughput is not None and throughput < -threshold:
+            regressions.append(f'{name}: throughput {format_change(throughput)}')
+
+        for key in LATENCY_KEYS:
+            base_value, head_value = base_result['latency_ms'][key], head_result['latency_ms'][key]
+            latency = change(base_value, head_value)
+            rows.append((name, f'{key}_ms', base_value, head_value, latency))
+            if latency is not None and latency > threshold:
+                regressions.append(f'{name}: {key} latency {format_change(latency)}')
+
+        base_queries, head_queries = base_result['queries_per_request'], head_result['queries_per_request']
+        rows.append((name, 'queries_per_request', base_queries, head_queries, change(base_queries, head_queries)))
+        if base_queries is not None and head_queries is not None and head_queries > base_queries:
+            regressions.append(f'{name}: {head_queries} queries per request, was {base_queries}')
+
+        base_error_rate = base_result['errors'] / max(base_result['requests'], 1)
+        head_error_rate = head_result['errors'] / max(head_result['requests'], 1)
+        if head_error_rate > base_error_rate:
+            regressions.append(f'{name}: {head_result["errors"]} errors, was {base_result["errors"]}')
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('base')
+    parser.add_argument('head')
+    parser.add_argument('--threshold', type=float, default=10, help='tolerated change, in percent')
+    args = parser.parse_args()
+
+    with open(args.base) as base_file, open(args.head) as head_file:
+        base, head = json.load(base_file), json.load(head_file)
+
+    rows, regressions = compare(base, head, args.threshold)
+    print(f'{base.get("commit") or args.base} -> {head.get("commit") or args.head}')
+    for key in ('base_url', 'concurrency', 'duration'):
+        if base.get(key) != head.get(key):
+            print(f'Warning: {key} differs ({base.get(key)} vs {head.get(key)}), results are not comparable')
+    print(f'{"scenario":<14}{"metric":<22}{"base":>12}{"head":>12}{"change":>10}')
+    for name, metric, base_value, head_value, value_change in rows:
+        print(f'{name:<14}{metric:<22}{str(base_value):>12}{str(head_value):>12}{format_change(value_change):>10}')
+
+    if regressions:
+        print(f'\nRegressions beyond {args.threshold}%:')
+        for regression in regressions:
+            print(f'  {regression}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,356 @@
+"""
+Load test of the API against a running server.
+
+    python manage.py seed_benchmark --clear --admin-password <password>
+    python manage.py runserver --noreload    # or gunicorn, against Postgres or SQLite
+    python benchmarks/load.py --admin-password <password> --concurrency 16 --duration 30 --output head.json
+    python benchmarks/compare.py base.json head.json
+
+Each scenario runs for --duration seconds with --concurrency threads, each
+on its own keep-alive connection, after an untimed warm-up. Uploads and
+order forms come from distinct X-Forwarded-For addresses in 198.18.0.0/15
+(RFC 2544 benchmarking range), so the server must trust the driver as a
+proxy (loopback is trusted by default) and the one-upload-per-IP rule and
+the per-IP throttles don't cut the run short. The gallery scenario follows
+the `next` links it receives, so it reads pages at many cursors rather than
+a couple of cached URLs. Responses other than 2xx and 3xx count as errors.
+Query counts are read from the server's /metrics endpoint and are left out
+when it is disabled. Results are printed as JSON, or written to --output.
+"""
+import argparse
+import http.client
+import ipaddress
+import json
+import os
+import random
+import statistics
+import subprocess
+import threading
+import time
+import uuid
+from io import BytesIO
+from pathlib import Path
+from urllib.parse import urlsplit
+
+ROOT = Path(__file__).resolve().parent.parent
+
+CLIENT_NETWORK = ipaddress.ip_network('198.18.0.0/15')
+
+SCENARIOS = ['gallery', 'upload', 'order', 'admin_list', 'admin_search']
+
+# Gallery pages remembered from `next` links
+MAX_GALLERY_PAGES = 1000
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def make_upload_image(size):
+    """
+    JPEG of about `size` bytes; each upload appends random bytes after it so
+    every request stores a new file instead of hitting an identical one
+    """
+    from PIL import Image
+
+    def render(side):
+        thumbnail = Image.frombytes('RGB', (16, 16), os.urandom(16 * 16 * 3))
+        noise = Image.frombytes('L', (side, side), os.urandom(side * side)).convert('RGB')
+        output = BytesIO()
+        Image.blend(thumbnail.resize((side, side), Image.BICUBIC), noise, 0.1).save(output, 'JPEG', quality=85)
+        return output.getvalue()
+
+    side = 512
+    data = render(side)
+    # Bytes grow with the pixel count, so one correction lands close to `size`
+    return render(max(16, int(side * (size / len(data)) ** 0.5)))
+
+
+def encode_multipart(field, filename, content_type, data):
+    boundary = uuid.uuid4().hex
+    body = b''.join([
+        f'--{boundary}\r\n'.encode(),
+        f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'.encode(),
+        f'Content-Type: {content_type}\r\n\r\n'.encode(),
+        data,
+        f'\r\n--{boundary}--\r\n'.encode(),
+    ])
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+class Client:
+    """
+    One keep-alive connection, reopened after errors
+    """
+
+    def __init__(self, base_url, timeout):
+        parts = urlsplit(base_url)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.netloc = parts.netloc
+        self.prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.connection = None
+
+    def request(self, method, path, body=None, headers=None):
+        if self.connection is None:
+            self.connection = self.connection_class(self.netloc, timeout=self.timeout)
+        try:
+            self.connection.request(method, f'{self.prefix}{path}', body=body, headers=headers or {})
+            response = self.connection.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.connection = None
+            raise
+
+
+class Scenario:
+    """
+    Builds the requests of one scenario; `next_request` must be thread safe
+    """
+
+    def __init__(self, name, options, token=None):
+        self.name = name
+        self.options = options
+        self.token = token
+        self.lock = threading.Lock()
+        self.addresses = iter(range(
+            int(CLIENT_NETWORK.network_address) + random.randrange(CLIENT_NETWORK.num_addresses // 2),
+            int(CLIENT_NETWORK.broadcast_address),
+        ))
+        self.upload_image = make_upload_image(options.upload_size) if name == 'upload' else None
+        self.prefix = urlsplit(options.base_url).path.rstrip('/')
+        self.gallery_pages = []
+
+    def next_address(self):
+        with self.lock:
+            return str(ipaddress.ip_address(next(self.addresses)))
+
+    def auth_headers(self):
+        return {'Authorization': f'Bearer {self.token}'}
+
+    def next_request(self):
+        """
+        (method, path, body, headers)
+        """
+        if self.name == 'gallery':
+            with self.lock:
+                path = random.choice(self.gallery_pages) if self.gallery_pages and random.random() < 0.8 else None
+            if path is None:
+                path = f'/api/v1/core/images/?cursor=&page_size={random.choice([20, 50])}'
+            return 'GET', path, None, {}
+
+        if self.name == 'upload':
+            address = self.next_address()
+            body, content_type = encode_multipart(
+                'image', f'load-{address}.jpg', 'image/jpeg', self.upload_image + os.urandom(16)
+            )
+            return 'POST', '/api/v1/core/images/', body, {
+                'Content-Type': content_type, 'X-Forwarded-For': address,
+            }
+
+        if self.name == 'order':
+            body = json.dumps({
+                'name': f'Benchmark load {random.randrange(10 ** 6)}',
+                'phone': f'+998 {random.randrange(10, 100)} {random.randrange(10 ** 6, 10 ** 7)} 00',
+                'contact_method': random.choice(['telegram', 'whatsapp', 'both']),
+            })
+            return 'POST', '/api/v1/core/order-forms/', body, {
+                'Content-Type': 'application/json', 'X-Forwarded-For': self.next_address(),
+            }
+
+        if self.name == 'admin_list':
+            resource = random.choice(['images', 'order-forms'])
+            return 'GET', f'/api/v1/administration/{resource}/?page={random.randrange(1, 20)}', None, \
+                self.auth_headers()
+
+        if self.name == 'admin_search':
+            if random.random() < 0.5:
+                digits = f'{random.randrange(10, 100)}{random.randrange(100, 1000)}'
+                path = f'/api/v1/administration/order-forms/?search={digits}'
+            else:
+                path = f'/api/v1/administration/images/?search=benchmark-{random.randrange(50)}'
+            return 'GET', path, None, self.auth_headers()
+
+        raise ValueError(f'Unknown scenario {self.name}')
+
+    def handle_response(self, status, body):
+        """
+        Remember the gallery page linked as `next`, for later requests
+        """
+        if self.name != 'gallery' or status != 200:
+            return
+        try:
+            next_url = json.loads(body).get('next')
+        except (ValueError, AttributeError):
+            return
+        if not next_url:
+            return
+        parts = urlsplit(next_url)
+        path = f'{parts.path[len(self.prefix):]}?{parts.query}'
+        with self.lock:
+            if len(self.gallery_pages) < MAX_GALLERY_PAGES:
+                self.gallery_pages.append(path)
+
+
+def run_scenario(scenario, options, duration):
+    """
+    Drive the scenario for `duration` seconds; returns latencies, statuses and errors
+    """
+    latencies, statuses, errors = [], {}, []
+    results_lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker():
+        client = Client(options.base_url, options.timeout)
+        local_latencies, local_statuses, local_errors = [], {}, []
+        while time.perf_counter() < deadline:
+            method, path, body, headers = scenario.next_request()
+            start = time.perf_counter()
+            try:
+                status, response = client.request(method, path, body, headers)
+            except (OSError, http.client.HTTPException) as e:
+                local_errors.append(type(e).__name__)
+                continue
+            local_latencies.append(time.perf_counter() - start)
+            local_statuses[status] = local_statuses.get(status, 0) + 1
+            scenario.handle_response(status, response)
+        with results_lock:
+            latencies.extend(local_latencies)
+            errors.extend(local_errors)
+            for status, count in local_statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    threads = [threading.Thread(target=worker) for _ in range(options.concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, statuses, errors, time.perf_counter() - started
+
+
+def read_query_totals(options):
+    """
+    (queries, requests) summed over every route but /metrics, or None
+    """
+    try:
+        status, body = Client(options.base_url, options.timeout).request('GET', '/metrics')
+    except (OSError, http.client.HTTPException):
+        return None
+    if status != 200:
+        return None
+
+    queries = requests = 0
+    for line in body.decode().splitlines():
+        if not line.startswith('db_queries_per_request_') or 'route="metrics"' in line:
+            continue
+        name, value = line.rsplit(' ', 1)
+        if name.startswith('db_queries_per_request_sum'):
+            queries += float(value)
+        elif name.startswith('db_queries_per_request_count'):
+            requests += float(value)
+    return queries, requests
+
+
+def get_token(options):
+    body = json.dumps({'username': options.admin_username, 'password': options.admin_password})
+    status, response = Client(options.base_url, options.timeout).request(
+        'POST', '/api/v1/auth/token/', body, {'Content-Type': 'application/json'}
+    )
+    if status != 200:
+        raise SystemExit(f'Could not log in as {options.admin_username} ({status}), run seed_benchmark first')
+    return json.loads(response)['access']
+
+
+def summarize(latencies, statuses, errors, elapsed, queries):
+    """
+    `errors` counts failed connections and responses other than 2xx and 3xx
+    """
+    latencies.sort()
+    total = len(latencies)
+    summary = {
+        'requests': total,
+        'errors': len(errors) + sum(count for status, count in statuses.items() if not 200 <= status < 400),
+        'status_codes': {str(status): count for status, count in sorted(statuses.items())},
+        'throughput_rps': round(total / elapsed, 1) if elapsed else 0,
+        'latency_ms': {
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'mean': statistics.fmean(latencies) if latencies else None,
+            'max': latencies[-1] if latencies else None,
+        },
+        'queries_per_request': queries,
+    }
+    summary['latency_ms'] = {key: round(value * 1000, 2) if value is not None else None
+                             for key, value in summary['latency_ms'].items()}
+    return summary
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--base-url', default='http://localhost:8000')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f'comma separated, from {", ".join(SCENARIOS)}')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=20, help='seconds per scenario')
+    parser.add_argument('--warmup', type=float, default=2, help='untimed seconds before each scenario')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--upload-size', type=int, default=300 * 1024, help='approximate upload bytes')
+    parser.add_argument('--admin-username', default='benchmark')
+    parser.add_argument('--admin-password', help='required by the admin scenarios')
+    parser.add_argument('--output', help='write the JSON results to this file')
+    options = parser.parse_args()
+
+    names = [name.strip() for name in options.scenarios.split(',') if name.strip()]
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+
+    token = None
+    if any(name.startswith('admin_') for name in names):
+        if not options.admin_password:
+            parser.error('--admin-password is required by the admin scenarios')
+        token = get_token(options)
+    results = {}
+    for name in names:
+        scenario = Scenario(name, options, token)
+        if options.warmup:
+            run_scenario(scenario, options, options.warmup)
+
+        before = read_query_totals(options)
+        latencies, statuses, errors, elapsed = run_scenario(scenario, options, options.duration)
+        after = read_query_totals(options)
+
+        queries = None
+        if before and after and after[1] > before[1]:
+            queries = round((after[0] - before[0]) / (after[1] - before[1]), 2)
+        results[name] = summarize(latencies, statuses, errors, elapsed, queries)
+
+    report = {
+        'commit': get_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'base_url': options.base_url,
+        'concurrency': options.concurrency,
+        'duration': options.duration,
+        'scenarios': results,
+    }
+    output = json.dumps(report, indent=2)
+    if options.output:
+        Path(options.output).write_text(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
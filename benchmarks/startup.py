@@ -0,0 +1,122 @@
+"""
+Worker cold start and per-request middleware overhead.
+
+    python benchmarks/startup.py --settings config.settings_production
+
+Boot time is measured in fresh interpreters (imports, django.setup() and
+the WSGI application, which loads the middleware). Middleware overhead is
+the time per request through the configured stack minus the same request
+with no middleware, by default for the gallery list, which is served from
+the page cache after the warm-up requests.
+Results are printed as JSON. The environment (.env) must be configured as
+for manage.py.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+BOOT_SNIPPET = """
+import sys, time
+start = time.perf_counter()
+from django.core.wsgi import get_wsgi_application
+get_wsgi_application()
+print(time.perf_counter() - start, len(sys.modules))
+"""
+
+
+def measure_boot(settings_module, runs):
+    python_path = os.pathsep.join(filter(None, [str(ROOT), os.environ.get('PYTHONPATH')]))
+    env = {**os.environ, 'DJANGO_SETTINGS_MODULE': settings_module, 'PYTHONPATH': python_path}
+    times, modules = [], 0
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', BOOT_SNIPPET], env=env, cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout.split()
+        times.append(float(output[0]))
+        modules = int(output[1])
+    return {
+        'runs': runs,
+        'median_ms': round(statistics.median(times) * 1000, 1),
+        'min_ms': round(min(times) * 1000, 1),
+        'modules_loaded': modules,
+    }
+
+
+def time_requests(handler, path, host, count):
+    from wsgiref.util import setup_testing_defaults
+
+    statuses = set()
+
+    def start_response(status, headers, exc_info=None):
+        statuses.add(status)
+
+    durations = []
+    for _ in range(count):
+        environ = {'PATH_INFO': path, 'REQUEST_METHOD': 'GET', 'HTTP_HOST': host, 'SERVER_NAME': host}
+        setup_testing_defaults(environ)
+        start = time.perf_counter()
+        response = handler(environ, start_response)
+        b''.join(response)
+        response.close()
+        durations.append(time.perf_counter() - start)
+
+    failed = [status for status in statuses if not status.startswith('2')]
+    if failed:
+        raise SystemExit(f'GET {path} answered {", ".join(sorted(failed))}, pick another --path')
+    return statistics.median(durations)
+
+
+def measure_middleware(settings_module, path, host, count):
+    os.environ['DJANGO_SETTINGS_MODULE'] = settings_module
+    sys.path.insert(0, str(ROOT))
+
+    import django
+    from django.conf import settings
+    from django.core.handlers.wsgi import WSGIHandler
+    from django.test.utils import override_settings
+
+    django.setup()
+    full = WSGIHandler()
+    with override_settings(MIDDLEWARE=[]):
+        bare = WSGIHandler()
+
+    # Warm up caches and lazy imports on both paths
+    time_requests(full, path, host, 50)
+    time_requests(bare, path, host, 50)
+    full_time = time_requests(full, path, host, count)
+    bare_time = time_requests(bare, path, host, count)
+    return {
+        'path': path,
+        'requests': count,
+        'middleware': len(settings.MIDDLEWARE),
+        'median_us': round(full_time * 1e6, 1),
+        'no_middleware_median_us': round(bare_time * 1e6, 1),
+        'overhead_us': round((full_time - bare_time) * 1e6, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--settings', default='config.settings')
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters to boot')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--path', default='/api/v1/core/images/',
+                        help='GET endpoint that answers without the database once cached')
+    parser.add_argument('--host', default='localhost', help='must be in ALLOWED_HOSTS')
+    args = parser.parse_args()
+
+    print(json.dumps({
+        'settings': args.settings,
+        'boot': measure_boot(args.settings, args.runs),
+        'request': measure_middleware(args.settings, args.path, args.host, args.requests),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+"""
+Logging handlers used by LOGGING in settings.
+
+Request threads only put records on an in-memory queue (QueueListenerHandler);
+one listener thread per process owns the files and writes them. Several
+worker processes can share a log file: LockedRotatingFileHandler serializes
+writes and rotation with a lock file.
+"""
+import atexit
+import fcntl
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler
+
+from django.conf import settings
+
+
+class LazyRotatingFileHandler(RotatingFileHandler):
+    """
+    RotatingFileHandler that opens its file, and creates its directory,
+    on the first record instead of when logging is configured
+    """
+
+    def __init__(self, filename, *args, **kwargs):
+        kwargs['delay'] = True
+        super().__init__(filename, *args, **kwargs)
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        return super()._open()
+
+
+class LockedRotatingFileHandler(LazyRotatingFileHandler):
+    """
+    Rotating file handler that is safe with several processes on one file:
+    each write holds an flock on `<file>.lock`, and a file rotated by
+    another process is reopened before writing
+    """
+
+    def __init__(self, filename, *args, **kwargs):
+        super().__init__(filename, *args, **kwargs)
+        self.lock_file = None
+
+    def acquire_file_lock(self):
+        if self.lock_file is None:
+            os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+            self.lock_file = open(f'{self.baseFilename}.lock', 'a')
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+
+    def release_file_lock(self):
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def reopen_if_rotated(self):
+        if self.stream is None:
+            return
+        try:
+            current = os.stat(self.baseFilename).st_ino
+        except FileNotFoundError:
+            current = None
+        if current != os.fstat(self.stream.fileno()).st_ino:
+            self.stream.close()
+            self.stream = None
+
+    def emit(self, record):
+        try:
+            self.acquire_file_lock()
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            self.reopen_if_rotated()
+            super().emit(record)
+        finally:
+            self.release_file_lock()
+
+    def close(self):
+        super().close()
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line, for log shippers
+    """
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'module': record.module,
+            'process': record.process,
+            'thread': record.thread,
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        if getattr(record, 'status_code', None):
+            entry['status_code'] = record.status_code
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _Listener:
+    """
+    The process's listener thread, handing queued records to the handlers
+    of the QueueListenerHandler that queued them. Started with a queue of
+    LOG_QUEUE_SIZE records on the first one, and again in forked workers,
+    since threads don't survive fork.
+    """
+    _stop = object()
+
+    def __init__(self):
+        self.reset()
+        os.register_at_fork(after_in_child=self.reset)
+        atexit.register(self.stop)
+
+    def reset(self):
+        self.queue = None
+        self.thread = None
+        self.start_lock = threading.Lock()
+        self.dropped_lock = threading.Lock()
+        self.dropped = 0
+
+    def put(self, handlers, record):
+        if self.thread is None:
+            with self.start_lock:
+                if self.thread is None:
+                    self.queue = queue.Queue(settings.LOG_QUEUE_SIZE)
+                    self.thread = threading.Thread(target=self.run, name='log-listener', daemon=True)
+                    self.thread.start()
+        try:
+            self.queue.put_nowait((handlers, record))
+        except queue.Full:
+            # Never block a request on logging
+            with self.dropped_lock:
+                self.dropped += 1
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is self._stop:
+                return
+            handlers, record = item
+            if self.dropped:
+                with self.dropped_lock:
+                    dropped, self.dropped = self.dropped, 0
+                sys.stderr.write(f'Log queue full, dropped {dropped} records\n')
+            for handler in handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        """
+        Write what is still queued before the process exits
+        """
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(self._stop)
+            self.thread.join(timeout=5)
+
+
+_listener = _Listener()
+
+
+def get_handler_by_name(name):
+    # logging.getHandlerByName is only available from Python 3.12
+    if hasattr(logging, 'getHandlerByName'):
+        return logging.getHandlerByName(name)
+    return logging._handlers.get(name)
+
+
+class QueueListenerHandler(logging.Handler):
+    """
+    Queue records for `handlers` (names from LOGGING['handlers'], which
+    dictConfig creates first as they sort before 'queue_*'), for the listener
+    thread to write. The caller only pays for formatting the message.
+    """
+
+    def __init__(self, handlers, level=logging.NOTSET):
+        super().__init__(level)
+        self.handlers = tuple(get_handler_by_name(name) for name in handlers)
+        if None in self.handlers:
+            raise ValueError(f'Unknown handlers in {handlers}')
+
+    def prepare(self, record):
+        # Freeze the message now: its args may change once the request moves on
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def emit(self, record):
+        try:
+            _listener.put(self.handlers, self.prepare(record))
+        except Exception:
+            self.handleError(record)
@@ -0,0 +1,102 @@
+import json
+import os
+import threading
+
+import yaml
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils import translation
+from drf_spectacular.settings import patched_settings, spectacular_settings
+from drf_spectacular.views import SCHEMA_KWARGS, SpectacularAPIView
+from drf_spectacular.utils import extend_schema
+from rest_framework.settings import api_settings
+
+
+class CachedSchemaView(SpectacularAPIView):
+    """
+    SpectacularAPIView building the public schema once per process, from
+    the artifact at OPENAPI_SCHEMA_FILE (`manage.py spectacular --file <path>`)
+    or by generating it, and keeping each rendered format. Schemas that
+    depend on the user (SERVE_PUBLIC off) or on a list urlconf are left
+    to SpectacularAPIView.
+    """
+    _schemas = {}
+    _rendered = {}
+    _lock = threading.Lock()
+
+    def load_schema_file(self):
+        with open(settings.OPENAPI_SCHEMA_FILE, encoding='utf-8') as schema_file:
+            if settings.OPENAPI_SCHEMA_FILE.endswith('.json'):
+                return json.load(schema_file)
+            return yaml.safe_load(schema_file)
+
+    def get_schema(self, version):
+        key = (version, translation.get_language())
+        if key not in self._schemas:
+            with self._lock:
+                if key not in self._schemas:
+                    if version is None and os.path.exists(settings.OPENAPI_SCHEMA_FILE):
+                        self._schemas[key] = self.load_schema_file()
+                    else:
+                        generator = self.generator_class(urlconf=self.urlconf, api_version=version,
+                                                         patterns=self.patterns)
+                        with patched_settings(self.custom_settings):
+                            self._schemas[key] = generator.get_schema(request=None, public=True)
+        return self._schemas[key]
+
+    def get_version(self, request):
+        """
+        Version from the view, the versioning scheme or `?version=`, like SpectacularAPIView
+        """
+        if self.api_version or request.version:
+            return self.api_version or request.version
+        version = request.query_params.get('version')
+        if not api_settings.ALLOWED_VERSIONS or version in api_settings.ALLOWED_VERSIONS:
+            return version
+        return None
+
+    def get_language(self, request):
+        """
+        Language of LANGUAGES asked for with `?lang=`, or the active one.
+        Raises LookupError for other values.
+        """
+        language = request.query_params.get('lang') if settings.USE_I18N else None
+        if not language:
+            return translation.get_language()
+        return translation.get_supported_language_variant(language)
+
+    def is_cached_version(self, request):
+        """
+        Without ALLOWED_VERSIONS any `?version=` is accepted, so only the
+        default schema is cached
+        """
+        return bool(self.api_version or request.version or api_settings.ALLOWED_VERSIONS
+                    or not request.query_params.get('version'))
+
+    @extend_schema(**SCHEMA_KWARGS)
+    def get(self, request, *args, **kwargs):
+        if not self.serve_public or isinstance(self.urlconf, (list, tuple)):
+            return super().get(request, *args, **kwargs)
+        # Cache entries are keyed by version and language: values outside
+        # the configured ones are generated for each request instead
+        try:
+            language = self.get_language(request)
+        except LookupError:
+            return super().get(request, *args, **kwargs)
+        if not self.is_cached_version(request):
+            return super().get(request, *args, **kwargs)
+
+        with translation.override(language):
+            version = self.get_version(request)
+            renderer, media_type = request.accepted_renderer, request.accepted_media_type
+            key = (version, translation.get_language(), media_type)
+            if key not in self._rendered:
+                self._rendered[key] = renderer.render(self.get_schema(version), media_type,
+                                                      {'request': request, 'view': self})
+
+        title = spectacular_settings.TITLE or 'schema'
+        filename = f'{title} ({version}).{renderer.format}' if version else f'{title}.{renderer.format}'
+        content_type = f'{media_type}; charset={renderer.charset}' if renderer.charset else media_type
+        response = HttpResponse(self._rendered[key], content_type=content_type)
+        response['Content-Disposition'] = f'inline; filename="{filename}"'
+        return response
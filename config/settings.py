@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 import os
+import sys
 from datetime import timedelta
 from os import getenv
 from os.path import join as join_path
@@ -64,7 +65,6 @@ INSTALLED_APPS = [
     'rest_framework',
     'rest_framework_simplejwt',
     'django_filters',
-    'debug_toolbar',
     'corsheaders',
     'drf_spectacular',
     'apps.core',
@@ -74,17 +74,27 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
-    "debug_toolbar.middleware.DebugToolbarMiddleware",
+    'apps.core.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'apps.core.middleware.QueryBudgetMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'apps.core.middleware.ClientIPMiddleware',
+    'apps.core.middleware.RateLimitMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Development-only tooling, left out of the app registry and request path unless DEBUG
+DEV_APPS = ['debug_toolbar']
+DEV_MIDDLEWARE = ['debug_toolbar.middleware.DebugToolbarMiddleware']
+if DEBUG:
+    INSTALLED_APPS += DEV_APPS
+    MIDDLEWARE = DEV_MIDDLEWARE + MIDDLEWARE
+
 ROOT_URLCONF = 'config.urls'
 
 TEMPLATES = [
@@ -107,6 +117,18 @@ TEMPLATES = [
 WSGI_APPLICATION = 'config.wsgi.application'
 ASGI_APPLICATION = 'config.asgi.application'
 
+# Serve the public core endpoints with async views, for ASGI deployments
+CORE_ASYNC_VIEWS = bool(int(getenv('CORE_ASYNC_VIEWS', 0)))
+
+# 'direct' saves each order form in its own transaction; 'spool' appends it to a
+# local spool that is bulk-inserted in batches (see apps/core/ingest.py)
+ORDER_FORM_INGEST_MODE = getenv('ORDER_FORM_INGEST_MODE', 'direct')
+ORDER_FORM_SPOOL_DIR = getenv('ORDER_FORM_SPOOL_DIR', join_path(BASE_DIR, 'order_spool'))
+ORDER_FORM_FLUSH_INTERVAL = int(getenv('ORDER_FORM_FLUSH_INTERVAL', 50))  # ms
+ORDER_FORM_FLUSH_ROWS = int(getenv('ORDER_FORM_FLUSH_ROWS', 500))
+# fsync every submission; otherwise the spool survives process crashes but not power loss
+ORDER_FORM_SPOOL_FSYNC = bool(int(getenv('ORDER_FORM_SPOOL_FSYNC', 0)))
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql',
@@ -118,6 +140,28 @@ DATABASES = {
     }
 }
 
+# psycopg 3 connection pool per worker process; without it, persistent connections
+DB_POOL = bool(int(getenv('DB_POOL', 1)))
+if DB_POOL:
+    DATABASES['default']['OPTIONS'] = {
+        'pool': {
+            'min_size': int(getenv('DB_POOL_MIN_SIZE', 2)),
+            'max_size': int(getenv('DB_POOL_MAX_SIZE', 10)),
+            'timeout': int(getenv('DB_POOL_TIMEOUT', 10)),
+            'max_idle': int(getenv('DB_POOL_MAX_IDLE', 10 * 60)),
+        },
+    }
+else:
+    DATABASES['default']['CONN_MAX_AGE'] = int(getenv('CONN_MAX_AGE', 60))
+# Health check before a connection is reused; with the pool, Django imports
+# psycopg_pool on first use and passes ConnectionPool.check_connection
+DATABASES['default']['CONN_HEALTH_CHECKS'] = True
+
+TESTING = sys.argv[1:2] == ['test']
+
+# Per-request query budgets (see QueryBudgetMiddleware): 'off', 'log' or 'raise'
+QUERY_BUDGET_MODE = getenv('QUERY_BUDGET_MODE', 'raise' if TESTING else 'log')
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -143,18 +187,28 @@ USE_I18N = True
 
 USE_TZ = True
 
+# Prebuilt OpenAPI schema (`manage.py spectacular --file`); generated once per process when absent
+OPENAPI_SCHEMA_FILE = getenv('OPENAPI_SCHEMA_FILE', '')
+
 STATIC_URL = '/static/'
 STATIC_ROOT = join_path(BASE_DIR, 'static')
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = join_path(BASE_DIR, 'media')
+# Hand file transfers to the front proxy: 'nginx' (X-Accel-Redirect to an internal
+# location at MEDIA_ACCEL_PREFIX aliasing MEDIA_ROOT) or 'sendfile' (X-Sendfile)
+MEDIA_ACCEL = getenv('MEDIA_ACCEL', '')
+MEDIA_ACCEL_PREFIX = getenv('MEDIA_ACCEL_PREFIX', '/protected-media/')
+MEDIA_CACHE_MAX_AGE = int(getenv('MEDIA_CACHE_MAX_AGE', 365 * 24 * 60 * 60))
+# Lifetime of the signed media URLs handed to staff for unapproved images
+MEDIA_SIGNED_URL_MAX_AGE = int(getenv('MEDIA_SIGNED_URL_MAX_AGE', 60 * 60))
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 REST_FRAMEWORK = {
 
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'apps.authentication.authentication.ClaimsJWTAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
@@ -163,8 +217,104 @@ REST_FRAMEWORK = {
 
 }
 
+# Local memory by default; point every worker at a shared backend (e.g. Redis)
+# so gallery invalidation reaches all of them at once
+CACHES = {
+    'default': {
+        'BACKEND': getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': getenv('CACHE_LOCATION', 'sticker'),
+    }
+}
+
+GALLERY_CACHE_TIMEOUT = int(getenv('GALLERY_CACHE_TIMEOUT', 300))
+
+PAGINATION_COUNT_CACHE_TIMEOUT = int(getenv('PAGINATION_COUNT_CACHE_TIMEOUT', 60))
+PAGINATION_ESTIMATE_THRESHOLD = int(getenv('PAGINATION_ESTIMATE_THRESHOLD', 10000))
+
+IMAGE_MAX_UPLOAD_SIZE = int(getenv('IMAGE_MAX_UPLOAD_SIZE', 5 * 1024 * 1024))
+# Allowance for multipart boundaries and headers on top of the image itself
+UPLOAD_MULTIPART_OVERHEAD = 64 * 1024
+# Seconds the one-upload-per-IP admission check remembers an uploader IP in the
+# default cache; with a per-process cache, also how long a deleted image's IP
+# can stay rejected by the other workers
+UPLOAD_ADMISSION_CACHE_TIMEOUT = int(getenv('UPLOAD_ADMISSION_CACHE_TIMEOUT', 300))
+# Proxies whose X-Forwarded-For entries are believed (see apps/core/client_ip.py).
+# Only loopback by default: list the load balancer's addresses or private
+# ranges explicitly, anything else on them could forge client addresses
+TRUSTED_PROXIES = [cidr for cidr in getenv('TRUSTED_PROXIES', '127.0.0.0/8,::1/128').split(',') if cidr.strip()]
+# Per-IP token buckets for writes to the public endpoints, by URL name (DRF rate notation)
+THROTTLE_RULES = {
+    'image-list-create': getenv('THROTTLE_UPLOAD_RATE', '10/min'),
+    'upload-session-create': getenv('THROTTLE_UPLOAD_RATE', '10/min'),
+    'upload-session-detail': getenv('THROTTLE_UPLOAD_CHUNK_RATE', '300/min'),
+    'upload-session-finalize': getenv('THROTTLE_UPLOAD_RATE', '10/min'),
+    'orderform-list-create': getenv('THROTTLE_ORDER_FORM_RATE', '20/min'),
+}
+# Buckets are kept per process by default; apps.core.throttling.CacheBucketStore shares
+# them between workers through THROTTLE_CACHE, which the upload cap always uses and
+# must then be a shared backend
+THROTTLE_STORE = getenv('THROTTLE_STORE', 'apps.core.throttling.LocalBucketStore')
+THROTTLE_CACHE = getenv('THROTTLE_CACHE', 'default')
+# Uploads in flight across all workers; 0 disables the cap
+UPLOAD_CONCURRENCY_LIMIT = int(getenv('UPLOAD_CONCURRENCY_LIMIT', 8))
+# Seconds after which the slot of an upload whose worker died is free again
+UPLOAD_SLOT_TIMEOUT = int(getenv('UPLOAD_SLOT_TIMEOUT', 300))
+# Resumable uploads: chunks are appended to files in UPLOAD_SESSIONS_DIR
+UPLOAD_CHUNK_SIZE = int(getenv('UPLOAD_CHUNK_SIZE', 1024 * 1024))
+UPLOAD_SESSIONS_DIR = join_path(BASE_DIR, 'upload_sessions')
+# One session per IP; it expires UPLOAD_SESSION_TTL seconds after it was opened,
+# or sooner once no chunk arrived for UPLOAD_SESSION_IDLE_TTL seconds
+UPLOAD_SESSION_TTL = int(getenv('UPLOAD_SESSION_TTL', 60 * 60))
+UPLOAD_SESSION_IDLE_TTL = int(getenv('UPLOAD_SESSION_IDLE_TTL', 10 * 60))
+# Decompression bomb guards, checked from the image header before any decoding
+IMAGE_MAX_PIXELS = int(getenv('IMAGE_MAX_PIXELS', 40_000_000))
+IMAGE_MAX_DIMENSION = int(getenv('IMAGE_MAX_DIMENSION', 10000))
+
+# Hamming distance (bits out of 64) under which images count as near-duplicates
+SIMILAR_IMAGES_MAX_DISTANCE = int(getenv('SIMILAR_IMAGES_MAX_DISTANCE', 6))
+SIMILAR_IMAGES_DISTANCE_LIMIT = 12
+
+# Bulk moderation: rows per UPDATE/DELETE and ids accepted per request
+BULK_MODERATION_BATCH_SIZE = int(getenv('BULK_MODERATION_BATCH_SIZE', 1000))
+BULK_MODERATION_MAX_IDS = int(getenv('BULK_MODERATION_MAX_IDS', 50000))
+# Moderation queue: images handed out per claim by default and at most, and how
+# long a claim is held before the images go back to the queue
+MODERATION_CLAIM_BATCH_SIZE = int(getenv('MODERATION_CLAIM_BATCH_SIZE', 20))
+MODERATION_CLAIM_MAX = int(getenv('MODERATION_CLAIM_MAX', 100))
+MODERATION_CLAIM_LEASE = int(getenv('MODERATION_CLAIM_LEASE', 10 * 60))
+# Rows fetched per round trip by the streaming admin exports
+EXPORT_CHUNK_SIZE = int(getenv('EXPORT_CHUNK_SIZE', 2000))
+
+# Worker processes rendering image variants, 0 renders them inline after commit
+IMAGE_VARIANT_WORKERS = int(getenv('IMAGE_VARIANT_WORKERS', 2))
+
+# Deletion journal for media files, see apps/core/files.py
+MEDIA_GC_BATCH_SIZE = int(getenv('MEDIA_GC_BATCH_SIZE', 200))
+MEDIA_GC_MAX_ATTEMPTS = int(getenv('MEDIA_GC_MAX_ATTEMPTS', 5))
+MEDIA_GC_RETRY_DELAY = int(getenv('MEDIA_GC_RETRY_DELAY', 30))
+# Seconds a worker holds journal entries it is deleting before others may retry them
+MEDIA_GC_CLAIM_TIMEOUT = int(getenv('MEDIA_GC_CLAIM_TIMEOUT', 300))
+MEDIA_GC_ORPHAN_GRACE = int(getenv('MEDIA_GC_ORPHAN_GRACE', 24 * 60 * 60))
+
+# Per-route latency, DB, upload and rejection metrics in the Prometheus format at
+# /metrics, for scrapers connecting from METRICS_ALLOWED_CIDRS or sending
+# METRICS_TOKEN as a bearer token, which requests through a proxy always need
+# (see apps/core/metrics.py). Workers share them
+# through files in METRICS_DIR, on tmpfs so they don't outlive the container;
+# empty keeps them per process
+METRICS_ENABLED = bool(int(getenv('METRICS_ENABLED', 1)))
+METRICS_DIR = getenv('METRICS_DIR', '/dev/shm/sticker-metrics' if os.path.isdir('/dev/shm') else '')
+METRICS_FLUSH_INTERVAL = int(getenv('METRICS_FLUSH_INTERVAL', 5))
+METRICS_ALLOWED_CIDRS = [cidr for cidr in getenv('METRICS_ALLOWED_CIDRS', '127.0.0.0/8,::1/128').split(',')
+                         if cidr.strip()]
+METRICS_TOKEN = getenv('METRICS_TOKEN', '')
+
+# Created on the first write to a log file, not at import
 LOGS_DIR = Path(os.path.join(BASE_DIR, 'logs'))
-LOGS_DIR.mkdir(exist_ok=True)
+# Write the log files as JSON lines instead of text
+LOG_JSON = bool(int(getenv('LOG_JSON', 0)))
+# Records waiting for the log listener thread; beyond it they are dropped, not waited on
+LOG_QUEUE_SIZE = int(getenv('LOG_QUEUE_SIZE', 10_000))
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -182,6 +332,9 @@ LOGGING = {
             'style': '{',
             'datefmt': '%Y-%m-%d %H:%M:%S',
         },
+        'json': {
+            '()': 'config.logging_handlers.JsonFormatter',
+        },
     },
     'filters': {
         'require_debug_true': {
@@ -200,27 +353,27 @@ LOGGING = {
         },
         'file_debug': {
             'level': 'DEBUG',
-            'class': 'logging.handlers.RotatingFileHandler',
+            'class': 'config.logging_handlers.LockedRotatingFileHandler',
             'filename': os.path.join(LOGS_DIR, 'debug.log'),
             'maxBytes': 1024 * 1024 * 5,
             'backupCount': 5,
-            'formatter': 'verbose',
+            'formatter': 'json' if LOG_JSON else 'verbose',
         },
         'file_info': {
             'level': 'INFO',
-            'class': 'logging.handlers.RotatingFileHandler',
+            'class': 'config.logging_handlers.LockedRotatingFileHandler',
             'filename': os.path.join(LOGS_DIR, 'info.log'),
             'maxBytes': 1024 * 1024 * 5,
             'backupCount': 5,
-            'formatter': 'standard',
+            'formatter': 'json' if LOG_JSON else 'standard',
         },
         'file_error': {
             'level': 'ERROR',
-            'class': 'logging.handlers.RotatingFileHandler',
+            'class': 'config.logging_handlers.LockedRotatingFileHandler',
             'filename': os.path.join(LOGS_DIR, 'error.log'),
             'maxBytes': 1024 * 1024 * 5,
             'backupCount': 5,
-            'formatter': 'verbose',
+            'formatter': 'json' if LOG_JSON else 'verbose',
         },
         'mail_admins': {
             'level': 'ERROR',
@@ -228,39 +381,62 @@ LOGGING = {
             'class': 'django.utils.log.AdminEmailHandler',
             'formatter': 'verbose',
         },
+        # Loggers use these: records are queued and the file_* and mail_admins
+        # handlers write or send them on the listener thread, off the request path
+        'queue_debug': {
+            '()': 'config.logging_handlers.QueueListenerHandler',
+            'handlers': ['file_debug'],
+        },
+        'queue_info': {
+            '()': 'config.logging_handlers.QueueListenerHandler',
+            'handlers': ['file_info'],
+        },
+        'queue_error': {
+            '()': 'config.logging_handlers.QueueListenerHandler',
+            'handlers': ['file_error'],
+        },
+        'queue_mail_admins': {
+            '()': 'config.logging_handlers.QueueListenerHandler',
+            'handlers': ['mail_admins'],
+        },
 
     },
     'loggers': {
         'django': {
-            'handlers': ['console', 'file_info', 'file_error', 'mail_admins'],
+            'handlers': ['console', 'queue_info', 'queue_error', 'queue_mail_admins'],
             'level': 'INFO',
             'propagate': True,
         },
         'django.request': {
-            'handlers': ['file_error', 'mail_admins'],
+            'handlers': ['queue_error', 'queue_mail_admins'],
             'level': 'ERROR',
             'propagate': False,
         },
         'django.server': {
-            'handlers': ['console', 'file_info'],
+            'handlers': ['console', 'queue_info'],
             'level': 'INFO',
             'propagate': False,
         },
         'django.template': {
-            'handlers': ['file_debug'],
+            'handlers': ['queue_debug'],
             'level': 'INFO',
             'propagate': True,
         },
         'django.db.backends': {
-            'handlers': ['file_debug'],
+            'handlers': ['queue_debug'],
             'level': 'INFO',
             'propagate': False,
         },
         'django.security': {
-            'handlers': ['file_info', 'mail_admins'],
+            'handlers': ['queue_info', 'queue_mail_admins'],
             'level': 'INFO',
             'propagate': False,
-        }
+        },
+        'apps': {
+            'handlers': ['console', 'queue_info', 'queue_error'],
+            'level': 'INFO',
+            'propagate': False,
+        },
     },
 }
 
@@ -288,6 +464,8 @@ SIMPLE_JWT = {
     'AUTH_TOKEN_CLASSES': ('rest_framework_simplejwt.tokens.AccessToken',),
     'TOKEN_TYPE_CLAIM': 'token_type',
     'TOKEN_USER_CLASS': 'rest_framework_simplejwt.models.TokenUser',
+    'TOKEN_OBTAIN_SERIALIZER': 'apps.authentication.serializers.ClaimsTokenObtainPairSerializer',
+    'TOKEN_REFRESH_SERIALIZER': 'apps.authentication.serializers.ClaimsTokenRefreshSerializer',
 
     'JTI_CLAIM': 'jti',
 
@@ -295,3 +473,10 @@ SIMPLE_JWT = {
     'SLIDING_TOKEN_LIFETIME': timedelta(days=1),
     'SLIDING_TOKEN_REFRESH_LIFETIME': timedelta(days=7),
 }
+
+# Revoked tokens (apps/authentication/revocation.py) are reloaded by each worker
+# at most this often, so a revocation reaches all of them within that many seconds
+AUTH_REVOCATION_TTL = int(getenv('AUTH_REVOCATION_TTL', 30))
+# Users loaded for tokens issued without claims are kept this long per process
+AUTH_USER_CACHE_TTL = int(getenv('AUTH_USER_CACHE_TTL', 60))
+AUTH_USER_CACHE_SIZE = 10_000
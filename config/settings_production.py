@@ -0,0 +1,17 @@
+"""
+Production profile: DJANGO_SETTINGS_MODULE=config.settings_production
+
+Same as settings.py, with development tooling stripped whatever DEBUG is
+in the environment and the OpenAPI schema read from a prebuilt artifact:
+
+    python manage.py spectacular --file openapi-schema.yml
+"""
+from .settings import *  # noqa: F401,F403
+from .settings import BASE_DIR, DEV_APPS, DEV_MIDDLEWARE, INSTALLED_APPS, MIDDLEWARE, getenv, join_path
+
+DEBUG = False
+
+INSTALLED_APPS = [app for app in INSTALLED_APPS if app not in DEV_APPS]
+MIDDLEWARE = [middleware for middleware in MIDDLEWARE if middleware not in DEV_MIDDLEWARE]
+
+OPENAPI_SCHEMA_FILE = getenv('OPENAPI_SCHEMA_FILE', join_path(BASE_DIR, 'openapi-schema.yml'))
@@ -21,20 +21,25 @@ from django.conf import settings
 from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path, include
-from drf_spectacular.views import SpectacularAPIView, SpectacularRedocView, SpectacularSwaggerView
+from drf_spectacular.views import SpectacularRedocView, SpectacularSwaggerView
+
+from apps.core.media import serve_media
+from apps.core.metrics import metrics_view
+from config.schema import CachedSchemaView
 
 urlpatterns = [
     path('administration/', admin.site.urls),
-    path('api/schema/', SpectacularAPIView.as_view(), name='schema'),
+    path('api/schema/', CachedSchemaView.as_view(), name='schema'),
     path('api/schema/swagger-ui/', SpectacularSwaggerView.as_view(url_name='schema'), name='swagger-ui'),
     path('api/schema/redoc/', SpectacularRedocView.as_view(url_name='schema'), name='redoc'),
     path('api/v1/auth/', include('apps.authentication.urls')),
     path('api/v1/core/', include('apps.core.urls')),
     path('api/v1/administration/', include('apps.administration.urls')),
+    path('metrics', metrics_view, name='metrics'),
+    path(f"{settings.MEDIA_URL.lstrip('/')}<path:path>", serve_media, name='media'),
 
 ]
 urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
-urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
 if settings.DEBUG:
     urlpatterns += [
         path("__debug__/", include("debug_toolbar.urls")),